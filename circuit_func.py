@@ -57,7 +57,8 @@ function modified:
 from scipy import integrate
 from scipy.linalg import expm
 import os, sys
-from tensor_network_functions import mps_func, misc
+from concurrent.futures import ThreadPoolExecutor
+from tensor_network_functions import mps_func, misc, symmetric_tensor
 
 import numpy as np
 np.seterr(all='raise')
@@ -149,6 +150,165 @@ def make_U(H, t):
     d = H[0].shape[0]
     return [expm(-t * h.reshape((d**2, -1))).reshape([d] * 4) for h in H]
 
+def get_trotter_sequence(order):
+    '''
+    Goal:
+        The Trotter splitting of exp(-t (H_even + H_odd)) of a single
+        time step, where H_even (H_odd) is the sum of the bond hamiltonians
+        on the bonds (0, 1), (2, 3), ... ((1, 2), (3, 4), ...).
+    Input:
+        order: 1, 2, or 4 (Forest-Ruth / Suzuki, from five 2nd order steps)
+    Return:
+        list of (parity, coefficient), i.e.
+        exp(-t H) ~ prod exp(-coefficient t H_parity), the first one applied first.
+    '''
+    if order == 1:
+        return [(0, 1.), (1, 1.)]
+    elif order == 2:
+        return [(0, 0.5), (1, 1.), (0, 0.5)]
+    elif order == 4:
+        p = 1. / (4. - 4. ** (1. / 3.))
+        sequence = []
+        for coefficient in [p, p, 1. - 4. * p, p, p]:
+            sequence += [(parity, c * coefficient) for parity, c in get_trotter_sequence(2)]
+
+        return sequence
+    else:
+        raise NotImplementedError
+
+def fuse_trotter_sequence(sequence):
+    '''
+    Goal:
+        merge the consecutive layers of the same parity, e.g. the half
+        steps between two 2nd order time steps, as they commute.
+    '''
+    fused_sequence = []
+    for parity, coefficient in sequence:
+        if fused_sequence and fused_sequence[-1][0] == parity:
+            fused_sequence[-1] = (parity, fused_sequence[-1][1] + coefficient)
+        else:
+            fused_sequence.append((parity, coefficient))
+
+    return fused_sequence
+
+def apply_U_sweep(A_list, U_list, parity, direction, chi=None, trunc_err_target=None,
+                  normalized=True):
+    '''
+    [modification inplace]
+    Goal:
+        Apply the gates U_list[i] on the bonds (i, i+1) with i = parity,
+        parity + 2, ..., as apply_U, but keeping the mixed canonical form,
+        so that the truncation is optimal. The bonds are visited in the
+        given direction and the orthogonality center is moved between the
+        gates with QR, so alternating the direction of the layers avoids
+        sweeps back.
+    Input:
+        A_list: mps_func.MPS with known center
+        direction: 'right' or 'left'
+        chi, trunc_err_target: see apply_gate
+    Return:
+        tot_trunc_err
+    '''
+    L = len(A_list)
+    sites = list(range(parity, L-1, 2))
+    tot_trunc_err = 0.
+    if direction == 'right':
+        for i in sites:
+            mps_func.move_orthogonality_center(A_list, None, i)
+            tot_trunc_err += apply_gate(A_list, U_list[i], i, move='right', chi=chi,
+                                        normalized=normalized,
+                                        trunc_err_target=trunc_err_target)
+    elif direction == 'left':
+        for i in sites[::-1]:
+            mps_func.move_orthogonality_center(A_list, None, i + 1)
+            tot_trunc_err += apply_gate(A_list, U_list[i], i, move='left', chi=chi,
+                                        normalized=normalized,
+                                        trunc_err_target=trunc_err_target)
+    else:
+        raise
+
+    return tot_trunc_err
+
+def tebd_iter(A_list, H_list, dt, num_steps, order=2, real_time=False, chi=None,
+              trunc_err_target=None, measure_every=1):
+    '''
+    Goal:
+        TEBD time evolution of the mps A_list with the bond hamiltonians
+        H_list, e.g. from get_H, in the imaginary time exp(-t H) or in the
+        real time exp(-i t H).
+        The half steps of the Trotter splitting between two time steps
+        are fused, except at the steps which are yielded.
+    Input:
+        A_list: mps, not modified.
+        dt: time step
+        order: order of the Trotter splitting, see get_trotter_sequence.
+        chi, trunc_err_target: truncation of each bond, see apply_gate
+        measure_every: yield every measure_every steps
+    Yield:
+        (step, A_list, tot_trunc_err) for step = 0, measure_every, ...
+        and num_steps. A_list is a mps_func.MPS, normalized, and a new list
+        each time; its tensors are not modified later.
+    '''
+    A_list = mps_func.MPS(A_list)
+    mps_func.right_canonicalize(A_list, no_trunc=True, normalized=True)
+    factor = 1j * dt if real_time else dt
+    U_cache = {}
+    direction = 'right'
+    tot_trunc_err = 0.
+    yield 0, mps_func.MPS(A_list), tot_trunc_err
+
+    step = 0
+    while step < num_steps:
+        num_fused = min(measure_every, num_steps - step)
+        sequence = fuse_trotter_sequence(get_trotter_sequence(order) * num_fused)
+        for parity, coefficient in sequence:
+            if coefficient not in U_cache:
+                U_cache[coefficient] = make_U(H_list, coefficient * factor)
+
+            tot_trunc_err += apply_U_sweep(A_list, U_cache[coefficient], parity, direction,
+                                           chi=chi, trunc_err_target=trunc_err_target)
+            direction = 'left' if direction == 'right' else 'right'
+
+        step += num_fused
+        yield step, mps_func.MPS(A_list), tot_trunc_err
+
+def tebd(A_list, H_list, dt, num_steps, order=2, real_time=False, chi=None,
+         trunc_err_target=None, measure_every=1, measure=None):
+    '''
+    Goal:
+        Run tebd_iter and only keep the observables measure(A_list) of
+        the yielded states, instead of the states.
+    Input:
+        see tebd_iter
+        measure: function of the mps; None for tebd_measure, i.e. the
+            energy and the entanglement.
+    Return:
+        A_list: the final mps
+        record: list of (step, time, tot_trunc_err, measure(A_list))
+    '''
+    if measure is None:
+        measure = lambda A_list: tebd_measure(A_list, H_list)
+
+    record = []
+    for step, A_list, tot_trunc_err in tebd_iter(A_list, H_list, dt, num_steps, order=order,
+                                                 real_time=real_time, chi=chi,
+                                                 trunc_err_target=trunc_err_target,
+                                                 measure_every=measure_every):
+        record.append((step, step * dt, tot_trunc_err, measure(A_list)))
+
+    return A_list, record
+
+def tebd_measure(A_list, H_list):
+    '''
+    return:
+        dict of the energy, i.e. the sum of expectation_values of H_list,
+        and the entanglement at each cut, see get_entanglement.
+    '''
+    A_list = mps_func.MPS(A_list)
+    mps_func.left_canonicalize(A_list, no_trunc=True, normalized=True)
+    energy = np.sum(mps_func.expectation_values(A_list, H_list, check_norm=False))
+    return {'energy': energy, 'entanglement': mps_func.get_entanglement(A_list)}
+
 def polar(A):
     '''
     return:
@@ -174,7 +334,8 @@ def random_2site_U(d, factor=1e-2):
     # Q, _ = np.linalg.qr(0.5 - M)
     # return Q.reshape([d] * 4)
 
-def circuit_2_state(circuit, product_state):
+def circuit_2_state(circuit, product_state, inplace=False, num_threads=None,
+                    fuse=False, max_block_size=4, d=2):
     '''
     Input:
         circuit is a list of list of U, i.e.
@@ -182,6 +343,12 @@ def circuit_2_state(circuit, product_state):
         circuit[0] corresponds to layer-0,
         circuit[1] corresponds to layer-1, and so on.
 
+        inplace: if True, the layers are applied with apply_U_all_exact_inplace
+            on a single complex copy of the state, using num_threads threads.
+        fuse: if True, the circuit is first fused by fuse_circuit into
+            blocks of at most max_block_size sites.
+        d: the local dimension
+
     Goal:
         We compute the exact representaion of U(cirucit)|product_state>
 
@@ -199,13 +366,29 @@ def circuit_2_state(circuit, product_state):
     else:
         iter_state = product_state
 
+    if fuse:
+        block_list, info = fuse_circuit(circuit, max_block_size=max_block_size)
+        if inplace:
+            iter_state = np.array(iter_state, dtype=np.complex128).reshape([-1])
+
+        return apply_blocks_exact(iter_state, block_list, inplace=inplace,
+                                  num_threads=num_threads, d=d)
+
+    if inplace:
+        iter_state = np.array(iter_state, dtype=np.complex128).reshape([-1])
+        for dep_idx in range(depth):
+            apply_U_all_exact_inplace(iter_state, circuit[dep_idx],
+                                      num_threads=num_threads, d=d)
+
+        return iter_state
+
     for dep_idx in range(depth):
         U_list = circuit[dep_idx]
-        iter_state = apply_U_all_exact(iter_state, U_list, cache=False)
+        iter_state = apply_U_all_exact(iter_state, U_list, cache=False, d=d)
 
     return iter_state
 
-def circuit_2_mps(circuit, product_state, chi=None):
+def circuit_2_mps(circuit, product_state, chi=None, batched=False, skip_identity=False):
     '''
     Input:
         circuit is a list of list of U, i.e.
@@ -222,28 +405,175 @@ def circuit_2_mps(circuit, product_state, chi=None):
 
         [ToDo] : add a truncation according to chi?
 
+        batched: apply each layer with apply_U_all_batched, which is
+        suitable for the brickwall circuit. In this case the mps is in
+        right canonical form instead.
+
+        skip_identity: apply the identity gates, e.g. of the brickwall
+        circuit, with a QR instead of the SVD, see apply_U_all.
+
+        See circuit_2_mps_iter for the version that does not keep
+        all layers in memory.
+
     return:
         list of mps representation of each layer; each in left canonical form
         mps_of_layer[0] gives the product state |psi0>
         mps_of_layer[1] gives the U(0) |psi0>
     '''
-    depth = len(circuit)
-    L = len(circuit[0]) + 1
-    # A_list = [np.array([1., 0.]).reshape([2, 1, 1]) for i in range(L)]
+    return list(circuit_2_mps_iter(circuit, product_state, chi=chi, batched=batched,
+                                   skip_identity=skip_identity))
+
+def circuit_2_mps_iter(circuit, product_state, chi=None, batched=False,
+                       skip_identity=False):
+    '''
+    Goal:
+        Generator version of circuit_2_mps. The mps of each layer is
+        yielded once it is computed, so only one layer is kept in memory.
+    Input:
+        see circuit_2_mps
+    Yield:
+        the mps representation of layer 0, 1, ..., depth;
+        the first one is the product state.
+    '''
+    A_list = mps_func.MPS([t.copy() for t in product_state])
+    yield mps_func.MPS([A.copy() for A in A_list])
+    for U_list in circuit:
+        A_list = apply_layer_2_mps(A_list, U_list, chi=chi, batched=batched,
+                                   skip_identity=skip_identity)
+        yield mps_func.MPS([A.copy() for A in A_list], center=A_list.center)
+
+def circuit_2_mps_fused(circuit, product_state, chi=None):
+    '''
+    Goal:
+        Compute the mps representation of U(circuit)|product_state>
+        with the circuit fused by fuse_circuit(max_block_size=2), i.e.
+        without the identity gates and with gates on the same bond merged.
+        Only the final mps is returned, since the fused circuit no longer
+        has well-defined layers.
+    Return:
+        A_list, tot_trunc_err
+    '''
+    block_list, info = fuse_circuit(circuit, max_block_size=2)
     A_list = [t.copy() for t in product_state]
+    mps_func.right_canonicalize(A_list, no_trunc=True, normalized=False)
+    return apply_blocks_mps(A_list, block_list, chi=chi, normalized=False)
 
-    mps_of_layer = []
-    mps_of_layer.append([A.copy() for A in A_list])
-    # A_list is modified inplace always.
-    # so we always have to copy A tensors.
-    for dep_idx in range(depth):
-        U_list = circuit[dep_idx]
-        ### A_list is modified inplace
-        mps_func.right_canonicalize(A_list, normalized=False)
-        A_list, trunc_error = apply_U_all(A_list, U_list, cache=False, chi=chi, normalized=False)
-        mps_of_layer.append([A.copy() for A in A_list])
+def apply_layer_2_mps(A_list, U_list, chi=None, batched=False, skip_identity=False):
+    '''
+    Goal:
+        Compute the mps of the next layer, i.e. U_list |A_list>,
+        as done for each layer in circuit_2_mps.
+        A_list itself is not modified.
+        skip_identity: see apply_U_all.
+    Return:
+        the new list of tensors, as a mps_func.MPS; the right
+        canonicalization is skipped if A_list is already a MPS
+        in right canonical form, e.g. from the batched layer.
+    '''
+    A_list = mps_func.MPS(A_list)
+    mps_func.right_canonicalize(A_list, no_trunc=True, normalized=False)
+    A_list, trunc_error = apply_U_all(A_list, U_list, cache=False, chi=chi, normalized=False,
+                                      batched=batched, skip_identity=skip_identity)
+    return A_list
+
+def apply_conj_layer_2_mps(A_list, U_list):
+    '''
+    Goal:
+        Compute the mps (U_list)^\dagger |A_list>, removing the layer
+        from the top as done to top_mps in var_layer(direction='down').
+        A_list should be in left canonical form; it is not modified.
+    Return:
+        the new list of tensors in left canonical form
+    '''
+    L = len(A_list)
+    A_list = [t for t in A_list]
+    for idx in range(L - 2, -1, -1):
+        gate_conj = U_list[idx].reshape([4, 4]).T.conj()
+        gate_conj = gate_conj.reshape([2, 2, 2, 2])
+        apply_gate(A_list, gate_conj, idx, move='left')
+
+    A_list, trunc_err = mps_func.left_canonicalize(A_list)
+    return A_list
+
+class MPSLayerStore(object):
+    '''
+    A memory bounded replacement of a list of mps of each layer,
+    e.g. the list returned by circuit_2_mps.
 
-    return mps_of_layer
+    Only every checkpoint_every-th layer is stored, either in memory or,
+    if spill_dir is given, on disk as .npy files which are loaded back as
+    read-only np.memmap. The other layers are recomputed on demand from
+    the closest stored layer below via
+
+        advance(layer_idx, mps) --> mps of layer (layer_idx + 1)
+
+    The recomputed layers of the last accessed block are kept, so that
+    going through the layers in increasing or decreasing order costs
+    one layer application per access.
+
+    store[i] returns a new list of tensors; the tensors should be treated
+    as read-only.
+    '''
+    def __init__(self, advance, checkpoint_every=1, spill_dir=None):
+        assert checkpoint_every >= 1
+        self.advance = advance
+        self.checkpoint_every = checkpoint_every
+        self.spill_dir = spill_dir
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+
+        self.num_layers = 0
+        self.checkpoints = {}
+        self.block_start = None
+        self.block = []
+
+    def __len__(self):
+        return self.num_layers
+
+    def append(self, mps):
+        layer_idx = self.num_layers
+        self.num_layers += 1
+        if layer_idx % self.checkpoint_every != 0:
+            return
+
+        if self.spill_dir is None:
+            self.checkpoints[layer_idx] = [t.copy() for t in mps]
+        else:
+            file_list = []
+            for site, t in enumerate(mps):
+                filename = os.path.join(self.spill_dir,
+                                        'layer%d_site%d.npy' % (layer_idx, site))
+                np.save(filename, t)
+                file_list.append(filename)
+
+            self.checkpoints[layer_idx] = file_list
+
+    def load_checkpoint(self, layer_idx):
+        if self.spill_dir is None:
+            return list(self.checkpoints[layer_idx])
+        else:
+            return [np.load(f, mmap_mode='r') for f in self.checkpoints[layer_idx]]
+
+    def __getitem__(self, layer_idx):
+        if layer_idx < 0:
+            layer_idx += self.num_layers
+
+        if not 0 <= layer_idx < self.num_layers:
+            raise IndexError(layer_idx)
+
+        if layer_idx in self.checkpoints:
+            return self.load_checkpoint(layer_idx)
+
+        block_start = layer_idx - layer_idx % self.checkpoint_every
+        if self.block_start != block_start:
+            self.block_start = block_start
+            self.block = [self.load_checkpoint(block_start)]
+
+        while block_start + len(self.block) <= layer_idx:
+            last_idx = block_start + len(self.block) - 1
+            self.block.append(self.advance(last_idx, self.block[-1]))
+
+        return list(self.block[layer_idx - block_start])
 
 def circuit_2_mpo(circuit, mpo, chi=None):
     '''
@@ -339,21 +669,20 @@ def var_circuit(target_mps, bottom_mps, circuit, product_state,
 
     print("Sweeping from top to bottom, overlap (before) : ",
           mps_func.overlap(target_mps, bottom_mps))
+    env_cache = EnvCache(L)
     for var_dep_idx in range(current_depth-1, -1, -1):
-        Lp_cache = [np.ones([1, 1])] + [None] * (L-1)
-        Rp_cache = [None] * (L-1) + [np.ones([1, 1])]
         for idx in range(L - 2, -1, -1):
             remove_gate = circuit[var_dep_idx][idx]
             remove_gate_conj = remove_gate.reshape([4, 4]).T.conj()
             remove_gate_conj = remove_gate_conj.reshape([2, 2, 2, 2])
-            apply_gate(bottom_mps, remove_gate_conj, idx, move='left')
+            apply_gate(bottom_mps, remove_gate_conj, idx, move='left', env_cache=env_cache)
             # now bottom_mps is mps without remove_gate,
             # we can now variational finding the optimal gate to replace it.
 
             if brickwall and (var_dep_idx + idx) % 2 == 1:
                 new_gate = np.eye(4).reshape([2, 2, 2, 2])
             else:
-                new_gate, Lp_cache, Rp_cache = var_gate_w_cache(top_mps, idx, bottom_mps, Lp_cache, Rp_cache)
+                new_gate = var_gate_w_env(top_mps, idx, bottom_mps, env_cache)
                 circuit[var_dep_idx][idx] = new_gate
 
             # conjugate the gate
@@ -362,11 +691,13 @@ def var_circuit(target_mps, bottom_mps, circuit, product_state,
             new_gate_conj = new_gate_conj.reshape([2, 2, 2, 2])
             # new_gate_conj = np.einsum('ijkl->klij', new_gate).conj()
 
-            apply_gate(top_mps, new_gate_conj, idx, move='left')
+            apply_gate(top_mps, new_gate_conj, idx, move='left', env_cache=env_cache)
 
 
-        mps_func.left_canonicalize(top_mps)
-        mps_func.left_canonicalize(bottom_mps)
+        ## only gauge fixing, the gates applied next truncate the numerical zeros
+        mps_func.left_canonicalize(top_mps, no_trunc=True)
+        mps_func.left_canonicalize(bottom_mps, no_trunc=True)
+        env_cache.reset()
 
     max_chi_bot = np.amax([np.amax(t.shape) for t in bottom_mps])
     max_chi_top = np.amax([np.amax(t.shape) for t in top_mps])
@@ -381,15 +712,15 @@ def var_circuit(target_mps, bottom_mps, circuit, product_state,
     print("Sweeping from bottom to top, overlap (before) : ",
           mps_func.overlap(top_mps, bottom_mps)
          )
+    env_cache = EnvCache(L)
     for var_dep_idx in range(0, current_depth):
-        mps_func.right_canonicalize(top_mps)
-        mps_func.right_canonicalize(bottom_mps)
+        mps_func.right_canonicalize(top_mps, no_trunc=True)
+        mps_func.right_canonicalize(bottom_mps, no_trunc=True)
+        env_cache.reset()
 
-        Lp_cache = [np.ones([1, 1])] + [None] * (L-1)
-        Rp_cache = [None] * (L-1) + [np.ones([1, 1])]
         for idx in range(L-1):
             gate = circuit[var_dep_idx][idx]
-            apply_gate(top_mps, gate, idx, move='right')
+            apply_gate(top_mps, gate, idx, move='right', env_cache=env_cache)
             ## This remove the gate from top_mps
             ## Because <\phi | U_{ij} | \psi> = inner( U_{ij}^\dagger |\phi>, |\psi> ) 
             ## applying U would remove the U_{ij}^\dagger, and
@@ -398,11 +729,11 @@ def var_circuit(target_mps, bottom_mps, circuit, product_state,
             if brickwall and (var_dep_idx + idx) % 2 == 1:
                 new_gate = np.eye(4).reshape([2, 2, 2, 2])
             else:
-                new_gate, Lp_cache, Rp_cache = var_gate_w_cache(top_mps, idx, bottom_mps, Lp_cache, Rp_cache)
+                new_gate = var_gate_w_env(top_mps, idx, bottom_mps, env_cache)
 
             circuit[var_dep_idx][idx] = new_gate
 
-            apply_gate(bottom_mps, new_gate, idx, move='right')
+            apply_gate(bottom_mps, new_gate, idx, move='right', env_cache=env_cache)
 
     ## finish sweeping
     ## bottom_mps is mps_final
@@ -561,7 +892,8 @@ def var_circuit_mpo(target_mpo, circuit,
     return iter_mpo2, circuit
 
 def var_circuit_exact(target_state, iter_state, circuit, product_state,
-                      brickwall=False, verbose=False,
+                      brickwall=False, verbose=False, inplace=False, num_threads=None,
+                      d=2,
                      ):
     '''
     Goal:
@@ -591,6 +923,10 @@ def var_circuit_exact(target_state, iter_state, circuit, product_state,
         circuit: list of list of unitary
         product_state: the initial product state that the circuit acts on.
         breakwall: whether using breakwall type of circuit
+        inplace: if True, the gates are applied with apply_gate_exact_inplace
+            on complex copies of the states, and the environments are
+            computed in chunks, using num_threads threads (None for all cores).
+        d: the local dimension; the gates are d**2 x d**2 matrices.
     Output:
         iter_state: the state U(circuit)|product state> of the updated circuit
         circuit: list of list of unitary
@@ -600,6 +936,18 @@ def var_circuit_exact(target_state, iter_state, circuit, product_state,
     top_state = target_state
     bottom_state = iter_state
 
+    if inplace:
+        if num_threads is None:
+            num_threads = os.cpu_count()
+
+        top_state = np.array(target_state, dtype=np.complex128)
+        bottom_state = np.array(iter_state, dtype=np.complex128)
+        def apply_gate_fn(state, gate, idx):
+            return apply_gate_exact_inplace(state, gate, idx, num_threads=num_threads, d=d)
+    else:
+        def apply_gate_fn(state, gate, idx):
+            return apply_gate_exact(state, gate, idx, d=d)
+
     if verbose:
         print("Sweeping from top to bottom, overlap (before) : ",
               overlap_exact(target_state, iter_state))
@@ -611,30 +959,33 @@ def var_circuit_exact(target_state, iter_state, circuit, product_state,
             # [TODO:delete] remove_gate_conj = remove_gate.reshape([4, 4]).T.conj()
             # [TODO:delete] remove_gate_conj = remove_gate_conj.reshape([2, 2, 2, 2])
 
-            bottom_state = apply_gate_exact(bottom_state, remove_gate_conj, idx)
+            bottom_state = apply_gate_fn(bottom_state, remove_gate_conj, idx)
             # now bottom_state is state without remove_gate,
             # we can now variational finding the optimal gate to replace it.
 
             if brickwall and (var_dep_idx + idx) % 2 == 1:
                 # new_gate = np.eye(4).reshape([2, 2, 2, 2])
-                new_gate = np.eye(4).reshape([4, 4])
+                new_gate = np.eye(d**2)
             else:
-                new_gate = var_gate_exact(top_state, idx, bottom_state)
+                new_gate = var_gate_exact(top_state, idx, bottom_state, num_threads=num_threads,
+                                          d=d)
                 # new_gate, Lp_cache, Rp_cache = var_gate_w_cache(top_mps, idx, bottom_mps, Lp_cache, Rp_cache)
                 circuit[var_dep_idx][idx] = new_gate
 
             # conjugate the gate
             # <psi|U = (U^\dagger |psi>)^\dagger
-            new_gate_conj = new_gate.reshape([4, 4]).T.conj()
+            new_gate_conj = new_gate.reshape([d**2, d**2]).T.conj()
             # [TODO:remove] new_gate_conj = new_gate_conj.reshape([2, 2, 2, 2])
             # new_gate_conj = np.einsum('ijkl->klij', new_gate).conj()
 
-            top_state = apply_gate_exact(top_state, new_gate_conj, idx)
+            top_state = apply_gate_fn(top_state, new_gate_conj, idx)
 
     overlap_abs = np.abs(overlap_exact(bottom_state, product_state))
     # print("overlap_abs = ", overlap_abs)
     assert np.isclose(overlap_abs, 1, rtol=1e-8)
     bottom_state = product_state
+    if inplace:
+        bottom_state = np.array(product_state, dtype=np.complex128)
 
     if verbose:
         print("Sweeping from bottom to top, overlap (before) : ",
@@ -643,7 +994,7 @@ def var_circuit_exact(target_state, iter_state, circuit, product_state,
     for var_dep_idx in range(0, current_depth):
         for idx in range(L-1):
             gate = circuit[var_dep_idx][idx]
-            top_state = apply_gate_exact(top_state, gate, idx)
+            top_state = apply_gate_fn(top_state, gate, idx)
             ## This remove the gate from top_state
             ## Because <\phi | U_{ij} | \psi> = inner( U_{ij}^\dagger |\phi>, |\psi> ) 
             ## applying U would remove the U_{ij}^\dagger, and
@@ -651,18 +1002,20 @@ def var_circuit_exact(target_state, iter_state, circuit, product_state,
 
             if brickwall and (var_dep_idx + idx) % 2 == 1:
                 # new_gate = np.eye(4).reshape([2, 2, 2, 2])
-                new_gate = np.eye(4).reshape([4, 4])
+                new_gate = np.eye(d**2)
             else:
-                new_gate = var_gate_exact(top_state, idx, bottom_state)
+                new_gate = var_gate_exact(top_state, idx, bottom_state, num_threads=num_threads,
+                                          d=d)
 
             circuit[var_dep_idx][idx] = new_gate
 
-            bottom_state = apply_gate_exact(bottom_state, new_gate, idx)
+            bottom_state = apply_gate_fn(bottom_state, new_gate, idx)
 
     ## finish sweeping
     return bottom_state, circuit
 
-def var_circuit2(target_mps, product_state, circuit, brickwall=False):
+def var_circuit2(target_mps, product_state, circuit, brickwall=False,
+                 checkpoint_every=1, spill_dir=None):
     #[TODO] extend this to brickwall
     """
     Goal:
@@ -673,6 +1026,10 @@ def var_circuit2(target_mps, product_state, circuit, brickwall=False):
         target_mps: can be not normalized, but should be in left canonical form.
         product_state
         circuit
+        checkpoint_every: only every checkpoint_every-th layer of the bottom
+            and top mps is stored; the others are recomputed, see MPSLayerStore.
+        spill_dir: if given, the stored layers are kept on disk in this
+            directory instead of in memory.
 
     Output:
         new_circuit
@@ -680,16 +1037,28 @@ def var_circuit2(target_mps, product_state, circuit, brickwall=False):
     L = len(target_mps)
     circuit_depth = len(circuit)
 
+    if spill_dir is None:
+        bottom_dir, top_dir = None, None
+    else:
+        bottom_dir = os.path.join(spill_dir, 'bottom')
+        top_dir = os.path.join(spill_dir, 'top')
+
     top_mps = [t.copy() for t in target_mps]  # in left canonical form
-    bottom_mps_cache = circuit_2_mps(circuit, product_state) # in left canonical form
+    # bottom_mps_cache [x] --> product_state + x-layer
+    bottom_mps_cache = MPSLayerStore(lambda x, mps: apply_layer_2_mps(mps, circuit[x]),
+                                     checkpoint_every=checkpoint_every,
+                                     spill_dir=bottom_dir)
+    for mps in circuit_2_mps_iter(circuit, product_state):
+        bottom_mps_cache.append(mps)
     # All mps in bottom_mps_cache is in left canonical form
 
-    #[TODO] Is this necessary?
-    # When append to top_mps_cache, we always need to use copy
-    # such that the cache is really an independent list.
-    # (The other way may be to create a new list everytime in var_layer and return it.)
-    top_mps_cache = []
-    top_mps_cache.append([t.copy() for t in top_mps])
+    # top_mps_cache [0] --> target_mps
+    # top_mps_cache [1] --> target_mps + 1-layer
+    # top_mps_cache [x] --> target_mps + x-layer
+    top_mps_cache = MPSLayerStore(lambda x, mps: apply_conj_layer_2_mps(mps, circuit[circuit_depth-1-x]),
+                                  checkpoint_every=checkpoint_every,
+                                  spill_dir=top_dir)
+    top_mps_cache.append(top_mps)
 
     for dep_idx in range(circuit_depth-1, -1, -1):
         top_mps, new_layer = var_layer(top_mps,
@@ -701,12 +1070,9 @@ def var_circuit2(target_mps, product_state, circuit, brickwall=False):
                                       )
         assert(len(new_layer) == L-1)
         circuit[dep_idx] = new_layer
-        top_mps_cache.append([t.copy() for t in top_mps])
+        top_mps_cache.append(top_mps)
 
     assert( len(top_mps_cache)  == circuit_depth + 1)
-    # top_mps_cache [0] --> target_mps
-    # top_mps_cache [1] --> target_mps + 1-layer
-    # top_mps_cache [x] --> target_mps + x-layer
     bottom_mps = bottom_mps_cache[0]
     for dep_idx in range(0, circuit_depth):
         bottom_mps, new_layer = var_layer(top_mps_cache[-2-dep_idx],
@@ -785,19 +1151,20 @@ def var_layer(top_mps, layer_gate, bottom_mps, direction,
     '''
     L = len(layer_gate) + 1
 
-    Lp_cache = [np.ones([1, 1])] + [None] * (L-1)
-    Rp_cache = [None] * (L-1) + [np.ones([1, 1])]
+    env_cache = EnvCache(L)
 
     if direction == 'down':
         # Form upward cache
 
-        # we copy the tensor in bottom_mps, so that bottom_mps is not modified.
-        # [Notice] apply_U_all function modified the A_list inplace.
-        # [Todo] maybe change the behavior above. not inplace?
-        A_list, trunc_err = mps_func.right_canonicalize([t.copy() for t in bottom_mps])
+        # we copy the list bottom_mps, so that bottom_mps is not modified.
+        # [Notice] apply_U_all function modified the A_list inplace,
+        # by replacing the tensors in the list; the tensors themselves
+        # are never modified inplace, so they do not need to be copied.
+        A_list, trunc_err = mps_func.right_canonicalize(mps_func.MPS(bottom_mps), no_trunc=True)
         upward_cache_list, trunc_error = apply_U_all(A_list,
                                                      layer_gate,
-                                                     cache=True)
+                                                     cache=True,
+                                                     skip_identity=brickwall)
 
         assert(len(upward_cache_list) == L)
         # There are L states, because with L-1 gates, including not applying gate
@@ -808,11 +1175,13 @@ def var_layer(top_mps, layer_gate, bottom_mps, direction,
 
         for idx in range(L - 2, -1, -1):
             mps_cache = upward_cache_list[idx]
+            # mps_cache differs from upward_cache_list[idx+1] on (idx, idx+1)
+            env_cache.update(idx, idx + 1)
             if brickwall and (dep_idx + idx) % 2 == 1:
                 new_gate = np.eye(4).reshape([2,2,2,2])
                 new_layer[idx] = new_gate
             else:
-                new_gate, Lp_cache, Rp_cache = var_gate_w_cache(top_mps, idx, mps_cache, Lp_cache, Rp_cache)
+                new_gate = var_gate_w_env(top_mps, idx, mps_cache, env_cache)
                 # new_gate = var_gate(top_mps, idx, mps_cache)
                 new_layer[idx] = new_gate
 
@@ -822,7 +1191,7 @@ def var_layer(top_mps, layer_gate, bottom_mps, direction,
             new_gate_conj = new_gate_conj.reshape([2, 2, 2, 2])
             # new_gate_conj = np.einsum('ijkl->klij', new_gate).conj()
 
-            apply_gate(top_mps, new_gate_conj, idx, move='left')
+            apply_gate(top_mps, new_gate_conj, idx, move='left', env_cache=env_cache)
 
         # top_mps ends up in right canonical form
         top_mps, trunc_err = mps_func.left_canonicalize(top_mps)
@@ -832,53 +1201,95 @@ def var_layer(top_mps, layer_gate, bottom_mps, direction,
         return top_mps, new_layer
     elif direction == 'up':
         # Form downward cache
-        downward_cache_list = []
-        downward_cache_list.append([t.copy() for t in top_mps])
+        downward_cache_list = MPSDiffCache(top_mps)
         for idx in range(L-2, -1, -1):
             conj_gate = layer_gate[idx].reshape([4,4]).T.conj()
             conj_gate = conj_gate.reshape([2, 2, 2, 2])
             apply_gate(top_mps, conj_gate, idx, move='left')
-            downward_cache_list.append([t.copy() for t in top_mps])
+            downward_cache_list.record(top_mps, idx)
 
         assert(len(downward_cache_list) == L)
         new_layer = [None] * (L-1)
 
-        bottom_mps, trunc_err = mps_func.right_canonicalize([t.copy() for t in bottom_mps])
+        bottom_mps, trunc_err = mps_func.right_canonicalize(mps_func.MPS(bottom_mps), no_trunc=True)
         for idx in range(L-1):
             top_mps = downward_cache_list[-2-idx]
+            # top_mps differs from downward_cache_list[-1-idx] on (idx, idx+1)
+            env_cache.update(idx, idx + 1)
             if brickwall and (dep_idx + idx) % 2 == 1:
                 new_gate = np.eye(4).reshape([2,2,2,2])
                 new_layer[idx] = new_gate
             else:
-                new_gate, Lp_cache, Rp_cache = var_gate_w_cache(top_mps, idx, bottom_mps, Lp_cache, Rp_cache)
+                new_gate = var_gate_w_env(top_mps, idx, bottom_mps, env_cache)
                 # new_gate = var_gate(top_mps, idx, bottom_mps)
                 new_layer[idx] = new_gate
 
-            apply_gate(bottom_mps, new_gate, idx, move='right')
+            apply_gate(bottom_mps, new_gate, idx, move='right', env_cache=env_cache)
 
         return bottom_mps, new_layer
 
     else:
         raise NotImplementedError
 
-def var_gate_exact(top_state, site, bottom_state):
+def var_gate_exact(top_state, site, bottom_state, num_threads=None, d=2):
     '''
     Goal:
         to find argmax_{gate} <top_state | gate | down_state>
         where gate is actting on (site, site+1)
     Input:
         top_state: (did not have conjugation yet!!!)
-        site: gate is applying on (site, site+1)
+        site: gate is applying on (site, site+1);
+            or a list of arbitrary sites, see apply_gate_exact.
         bottom_state
+        num_threads: if given, the environment is accumulated over chunks of
+            the states in a thread pool, without a conjugated copy of the
+            full top_state.
+        d: the local dimension
     Return:
-        new_gate
+        new_gate, a matrix of size d**k x d**k for k sites
     '''
     total_dim = top_state.size
-    L = int(np.log2(total_dim))
-    top_theta = np.reshape(top_state, [(2**site), 4, 2**(L-(site+2))])
-    bottom_theta = np.reshape(bottom_state, [(2**site), 4, 2**(L-(site+2))])
+    L = get_system_size(total_dim, d)
+    if np.ndim(site) == 0:
+        sites = [site, site + 1]
+    else:
+        sites = [int(s) for s in site]
+
+    num_sites = len(sites)
+    dim = d ** num_sites
+    if not is_contiguous_sites(sites):
+        ## strided views with the axes of the sites moved to the end,
+        ## the environment is accumulated over chunks of the views.
+        top_theta = np.moveaxis(np.reshape(top_state, [d] * L), sites,
+                                list(range(L - num_sites, L)))
+        bottom_theta = np.moveaxis(np.reshape(bottom_state, [d] * L), sites,
+                                   list(range(L - num_sites, L)))
+        def chunk_env(chunks):
+            top_chunk = np.reshape(chunks[0], [-1, dim])
+            bottom_chunk = np.reshape(chunks[1], [-1, dim])
+            return np.dot(top_chunk.T.conj(), bottom_chunk)  # upper_p, lower_p
+
+        min_num_chunks = 1 if num_threads is None else num_threads
+        chunk_list = zip(split_state_strided(top_theta, num_sites, min_num_chunks=min_num_chunks),
+                         split_state_strided(bottom_theta, num_sites, min_num_chunks=min_num_chunks))
+        if num_threads is None:
+            M = sum(map(chunk_env, chunk_list))
+        else:
+            M = sum(get_thread_pool(num_threads).map(chunk_env, chunk_list))
+    else:
+        site = sites[0]
+        top_theta = np.reshape(top_state, [(d**site), dim, d**(L-(site+num_sites))])
+        bottom_theta = np.reshape(bottom_state, [(d**site), dim, d**(L-(site+num_sites))])
+
+        if num_threads is None:
+            M = np.tensordot(top_theta.conj(), bottom_theta, axes=([0, 2], [0, 2]))  # [ ..., upper_p, ...], [..., lower_p, ...] --> upper_p, lower_p
+        else:
+            def chunk_env(chunks):
+                return np.tensordot(chunks[0].conj(), chunks[1], axes=([0, 2], [0, 2]))
 
-    M = np.tensordot(top_theta.conj(), bottom_theta, axes=([0, 2], [0, 2]))  # [ ..., upper_p, ...], [..., lower_p, ...] --> upper_p, lower_p
+            chunk_list = zip(split_theta_exact(top_theta, min_num_chunks=num_threads),
+                             split_theta_exact(bottom_theta, min_num_chunks=num_threads))
+            M = sum(get_thread_pool(num_threads).map(chunk_env, chunk_list))
 
     # [TODO:remove below] now convention upper_p, lower_p
     # M = M.T  # if the convention is lower_p, upper_p
@@ -890,7 +1301,79 @@ def var_gate_exact(top_state, site, bottom_state):
 
     return new_gate
 
-def var_gate_w_cache(new_mps, site, mps_ket, Lp_cache, Rp_cache):
+class EnvCache(object):
+    '''
+    Cache of the left and right environments of <bra | ket>, where both mps
+    are in the convention [p, l, r].
+
+        Lp[i]: contraction of the sites 0, ..., i-1,   [ket, bra]
+        Rp[i]: contraction of the sites i+1, ..., L-1, [ket, bra]
+
+    The environments are computed lazily and kept until a site they contain
+    is updated. Whenever the tensors of the bra or the ket are modified, e.g.
+    by apply_gate(..., env_cache=env), call update(sites) so that only the
+    environments depending on these sites are dropped.
+
+    The lists Lp, Rp follow the same convention as the Lp_cache, Rp_cache
+    used in var_gate_w_cache, with None marking an environment that is not
+    computed yet.
+    '''
+    def __init__(self, L, Lp=None, Rp=None):
+        self.L = L
+        if Lp is None:
+            Lp = [np.ones([1, 1])] + [None] * (L-1)
+        if Rp is None:
+            Rp = [None] * (L-1) + [np.ones([1, 1])]
+
+        self.Lp = Lp
+        self.Rp = Rp
+
+    def reset(self):
+        '''
+        drop all environments, e.g. after the mps is recanonicalized.
+        '''
+        self.update(*range(self.L))
+
+    def update(self, *sites):
+        '''
+        mark the sites as modified in the bra or the ket.
+        '''
+        for site in sites:
+            # Lp is computed from left to right, so the valid environments
+            # always form a prefix of the list; similar for Rp.
+            for i in range(site + 1, self.L):
+                if self.Lp[i] is None:
+                    break
+                self.Lp[i] = None
+
+            for i in range(site - 1, -1, -1):
+                if self.Rp[i] is None:
+                    break
+                self.Rp[i] = None
+
+    def left_env(self, bra, ket, site):
+        '''
+        return:
+            Lp[site], the contraction of the sites 0, ..., site-1
+        '''
+        for i in range(site):
+            if self.Lp[i+1] is None:
+                self.Lp[i+1] = misc.contract('ab,pac,pbd->cd', self.Lp[i], ket[i], bra[i].conj())
+
+        return self.Lp[site]
+
+    def right_env(self, bra, ket, site):
+        '''
+        return:
+            Rp[site], the contraction of the sites site+1, ..., L-1
+        '''
+        for i in range(self.L-1, site, -1):
+            if self.Rp[i-1] is None:
+                self.Rp[i-1] = misc.contract('pac,cd,pbd->ab', ket[i], self.Rp[i], bra[i].conj())
+
+        return self.Rp[site]
+
+def var_gate_w_env(new_mps, site, mps_ket, env_cache):
     '''
     Goal:
         to find argmax_{gate} <new_mps | gate | mps_ket>
@@ -899,54 +1382,62 @@ def var_gate_w_cache(new_mps, site, mps_ket, Lp_cache, Rp_cache):
         new_mps: list of tensors of the new_mps, convention [p, l, r]
         site: gate is applying on (site, site+1)
         mps_ket: list of tensors of the mps_ket, convention [p, l, r]
-        Lp_cache: matrix
-        Rp_cache: matrix
+        env_cache: EnvCache of <new_mps | mps_ket>
     Return:
         new_gate
     '''
-    L = len(new_mps)
-    # Lp = np.ones([1, 1])
-    # Lp_list = [Lp]
-    # Lp_cache = [Lp, ... ]
-
-    for i in range(site):
-        Lp = Lp_cache[i]
-        if Lp_cache[i+1] is None:
-            Lp = np.tensordot(Lp, mps_ket[i], axes=(0, 1))
-            Lp = np.tensordot(Lp, new_mps[i].conj(), axes=([0, 1], [1,0]))
-            Lp_cache[i+1] = Lp
-        else:
-            pass
-
-    # Rp = np.ones([1, 1])
-    # Rp_list = [Rp]
-
-    for i in range(L-1, site+1, -1):
-        Rp = Rp_cache[i]
-        if Rp_cache[i-1] is None:
-            Rp = np.tensordot(mps_ket[i], Rp, axes=(2, 0))
-            Rp = np.tensordot(Rp, new_mps[i].conj(), axes=([0, 2], [0, 2]))
-            Rp_cache[i-1] = Rp
-
-    L_env = Lp_cache[site]
-    # L_env = Lp_list[site]
-    R_env = Rp_cache[site+1]
-    # R_env = Rp_list[L-2-site]
-
-    theta_top = np.tensordot(new_mps[site].conj(), new_mps[site + 1].conj(), axes=(2,1)) # p l, q r
-    theta_bot = np.tensordot(mps_ket[site], mps_ket[site + 1],axes=(2,1))
+    L_env = env_cache.left_env(new_mps, mps_ket, site)
+    R_env = env_cache.right_env(new_mps, mps_ket, site+1)
 
-    M = np.tensordot(L_env, theta_bot, axes=([0], [1])) #l, p, q, r
-    M = np.tensordot(M, R_env, axes=([3], [0])) #l, p, q, r
-    M = np.tensordot(M, theta_top, axes=([0, 3], [1, 3])) #lower_p, lower_q, upper_p, upper_q
-    M = M.reshape([4, 4])
+    M = var_gate_env(L_env, mps_ket[site], mps_ket[site + 1], R_env,
+                     new_mps[site].conj(), new_mps[site + 1].conj())
+    d = M.shape[0]
+    M = M.reshape([d * d, d * d])
 
     ### For detailed explanation of the formula, see function var_gate
     U, _, Vd = misc.svd(M, full_matrices=False)
     new_gate = np.dot(U, Vd).conj()
-    new_gate = new_gate.reshape([2, 2, 2, 2])
+    new_gate = new_gate.reshape([d, d, d, d])
 
-    return new_gate, Lp_cache, Rp_cache
+    return new_gate
+
+def var_gate_env(L_env, ket_1, ket_2, R_env, bra_1, bra_2):
+    '''
+    Goal:
+        the environment of a two site gate in <bra | gate | ket>,
+        contracted in the order from misc.get_contraction_plan, i.e.
+        without forming the two site tensors of the bra and the ket.
+    Input:
+        L_env, R_env: [ket, bra], see EnvCache
+        ket_1, ket_2: the tensors of the ket on (site, site+1), [p, l, r]
+        bra_1, bra_2: the tensors of the bra, already conjugated
+    Return:
+        M: lower_p, lower_q, upper_p, upper_q
+    '''
+    return misc.contract('ax,pab,qbc,cy,Pxz,Qzy->pqPQ', L_env, ket_1, ket_2, R_env,
+                         bra_1, bra_2)
+
+def var_gate_w_cache(new_mps, site, mps_ket, Lp_cache, Rp_cache):
+    '''
+    Goal:
+        to find argmax_{gate} <new_mps | gate | mps_ket>
+        where gate is actting on (site, site+1)
+    Input:
+        new_mps: list of tensors of the new_mps, convention [p, l, r]
+        site: gate is applying on (site, site+1)
+        mps_ket: list of tensors of the mps_ket, convention [p, l, r]
+        Lp_cache: matrix
+        Rp_cache: matrix
+    Return:
+        new_gate
+
+    See also EnvCache and var_gate_w_env, which keep track of the
+    modified sites instead of threading the lists by hand.
+    '''
+    L = len(new_mps)
+    env_cache = EnvCache(L, Lp_cache, Rp_cache)
+    new_gate = var_gate_w_env(new_mps, site, mps_ket, env_cache)
+    return new_gate, env_cache.Lp, env_cache.Rp
 
 def var_gate_mpo_w_cache(mpo, site, Lp_cache, Rp_cache):
     '''
@@ -1020,28 +1511,23 @@ def var_gate(new_mps, site, mps_ket):
     Lp_list = [Lp]
 
     for i in range(L):
-        Lp = np.tensordot(Lp, mps_ket[i], axes=(0, 1))
-        Lp = np.tensordot(Lp, new_mps[i].conj(), axes=([0, 1], [1,0]))
+        Lp = misc.contract('ab,pac,pbd->cd', Lp, mps_ket[i], new_mps[i].conj())
         Lp_list.append(Lp)
 
     Rp = np.ones([1, 1])
     Rp_list = [Rp]
 
     for i in range(L-1, -1, -1):
-        Rp = np.tensordot(mps_ket[i], Rp, axes=(2, 0))
-        Rp = np.tensordot(Rp, new_mps[i].conj(), axes=([0, 2], [0, 2]))
+        Rp = misc.contract('pac,cd,pbd->ab', mps_ket[i], Rp, new_mps[i].conj())
         Rp_list.append(Rp)
 
     L_env = Lp_list[site]
     R_env = Rp_list[L-2-site]
 
-    theta_top = np.tensordot(new_mps[site].conj(), new_mps[site + 1].conj(), axes=(2,1)) # p l, q r
-    theta_bot = np.tensordot(mps_ket[site], mps_ket[site + 1],axes=(2,1))
-
-    M = np.tensordot(L_env, theta_bot, axes=([0], [1])) #l, p, q, r
-    M = np.tensordot(M, R_env, axes=([3], [0])) #l, p, q, r
-    M = np.tensordot(M, theta_top, axes=([0, 3], [1, 3])) #lower_p, lower_q, upper_p, upper_q
-    M = M.reshape([4, 4])
+    M = var_gate_env(L_env, mps_ket[site], mps_ket[site + 1], R_env,
+                     new_mps[site].conj(), new_mps[site + 1].conj())
+    d = M.shape[0]
+    M = M.reshape([d * d, d * d])
 
     ##### The formula should work for the first layer; where the unitary there has redundant
     ##### degree of freedom.
@@ -1062,11 +1548,12 @@ def var_gate(new_mps, site, mps_ket):
     ######################################################################
     U, _, Vd = misc.svd(M, full_matrices=False)
     new_gate = np.dot(U, Vd).conj()
-    new_gate = new_gate.reshape([2, 2, 2, 2])
+    new_gate = new_gate.reshape([d, d, d, d])
 
     return new_gate
 
-def apply_gate(A_list, gate, idx, move, no_trunc=False, chi=None, normalized=False):
+def apply_gate(A_list, gate, idx, move, no_trunc=False, chi=None, normalized=False,
+               env_cache=None, trunc_err_target=None, svd_method='full'):
     '''
     [modification inplace]
     Goal:
@@ -1078,10 +1565,40 @@ def apply_gate(A_list, gate, idx, move, no_trunc=False, chi=None, normalized=Fal
         move: the direction to combine tensor after SVD
         no_trunc: if True, then even numerical zeros are not truncated
         chi: the truncation bond dimension provided.
+        env_cache: EnvCache in which A_list is the bra or the ket;
+            the environments depending on (idx, idx+1) are dropped.
+        trunc_err_target: if given, keep the smallest number of singular
+            values (at most chi) such that the discarded weight is below
+            trunc_err_target.
+        svd_method: the method of misc.svd, with chi as the rank; 'auto'
+            or 'randomized' are faster for chi << d*chi_bond but approximate.
+
+        If A_list is a mps_func.MPS with the orthogonality center on
+        idx or idx+1, the center is moved to idx+1 (move='right') or
+        idx (move='left'); otherwise the gauge becomes unknown.
+        If A_list is a mps_func.VidalMPS, see VidalMPS.apply_gate; it has
+        no orthogonality center, so move is only checked to be 'right' or
+        'left', and env_cache plays no role. The mps of symmetric_tensor.BlockTensor
+        are dispatched to symmetric_tensor.apply_gate.
 
     Return:
         trunc_error
     '''
+    if isinstance(A_list, mps_func.VidalMPS):
+        assert move in ['right', 'left']
+        return A_list.apply_gate(gate, idx, no_trunc=no_trunc, chi=chi,
+                                 trunc_err_target=trunc_err_target, normalized=normalized)
+    elif isinstance(A_list[idx], symmetric_tensor.BlockTensor):
+        center = mps_func.get_center(A_list)
+        trunc_error = symmetric_tensor.apply_gate(A_list, gate, idx, move, no_trunc=no_trunc,
+                                                  chi=chi, normalized=normalized,
+                                                  trunc_err_target=trunc_err_target)
+        if center in [idx, idx + 1]:
+            mps_func.set_center(A_list, idx + 1 if move == 'right' else idx)
+
+        return trunc_error
+
+    center = mps_func.get_center(A_list)
     d1, chi1, chi2 = A_list[idx].shape
     d2, chi2, chi3 = A_list[idx + 1].shape
 
@@ -1095,19 +1612,34 @@ def apply_gate(A_list, gate, idx, move, no_trunc=False, chi=None, normalized=Fal
     # theta = np.tensordot(gate, theta, axes=([0,1],[0,2]))  # [i,j,i',j'] [i, D1, j, D2] -> [i',j',D1, D2]
     # theta = np.reshape(np.transpose(theta,(0,2,1,3)),(d1*chi1, d2*chi3))  # [i',D1,j',D2]
 
-    X, Y, Z = misc.svd(theta, full_matrices=0)
+    X, Y, Z = misc.svd(theta, full_matrices=0, rank=None if no_trunc else chi,
+                       method=svd_method)
+    if np.size(Y) < min(theta.shape):
+        ## truncated svd; the norm and the discarded weight come from theta
+        Y_norm = np.linalg.norm(theta)
+    else:
+        Y_norm = np.linalg.norm(Y)
 
     if no_trunc:
         chi2 = np.size(Y)
     else:
-        chi2 = np.sum((Y/np.linalg.norm(Y))>1e-14)
+        chi2 = np.sum((Y/Y_norm)>1e-14)
         if chi is not None:
             chi2 = np.amin([chi2, chi])
 
+        if trunc_err_target is not None:
+            # discarded[n] = weight discarded when keeping n singular values
+            Y_sq = np.sort(Y)[::-1] ** 2
+            discarded = (Y_norm ** 2 - np.cumsum(Y_sq) + Y_sq) / Y_norm ** 2
+            chi2 = min(chi2, max(1, np.sum(discarded > trunc_err_target)))
+
 
     arg_sorted_idx = (np.argsort(Y)[::-1])[:chi2]
     trunc_idx = (np.argsort(Y)[::-1])[chi2:]
-    trunc_error = np.sum(Y[trunc_idx] ** 2) / np.sum(Y**2)
+    if np.size(Y) < min(theta.shape):
+        trunc_error = max(1. - np.sum(Y[arg_sorted_idx] ** 2) / Y_norm ** 2, 0.)
+    else:
+        trunc_error = np.sum(Y[trunc_idx] ** 2) / np.sum(Y**2)
 
     Y = Y[arg_sorted_idx]  # chi2
     if normalized:
@@ -1125,6 +1657,12 @@ def apply_gate(A_list, gate, idx, move, no_trunc=False, chi=None, normalized=Fal
     else:
         raise
 
+    if center in [idx, idx + 1]:
+        mps_func.set_center(A_list, idx + 1 if move == 'right' else idx)
+
+    if env_cache is not None:
+        env_cache.update(idx, idx + 1)
+
     ## Sometimes both scipy and numpy seems to breakdown for SVD.
     ## Should due to the lapack or blas problem on workstation.
 
@@ -1136,23 +1674,100 @@ def apply_gate(A_list, gate, idx, move, no_trunc=False, chi=None, normalized=Fal
 
     return trunc_error
 
-def apply_gate_exact(state, gate, idx):
+def apply_identity_gate(A_list, idx, move, normalized=False, env_cache=None):
+    '''
+    [modification inplace]
+    Goal:
+        Apply the identity gate on the MPS A_list as apply_gate does,
+        i.e. only move the orthogonality center from idx to idx+1
+        (move='right') or from idx+1 to idx (move='left').
+        This only takes a QR decomposition instead of the SVD,
+        and no truncation is made.
+    Input:
+        see apply_gate
+    Return:
+        trunc_error, which is 0.
+    '''
+    if move == 'right':
+        mps_func.move_orthogonality_center(A_list, idx, idx + 1, normalized=normalized)
+    elif move == 'left':
+        mps_func.move_orthogonality_center(A_list, idx + 1, idx, normalized=normalized)
+    else:
+        raise
+
+    if env_cache is not None:
+        env_cache.update(idx, idx + 1)
+
+    return 0.
+
+def get_system_size(total_dim, d=2):
+    '''
+    return:
+        L, the number of sites of a state vector of size total_dim = d**L
+    '''
+    L = int(np.round(np.log(total_dim) / np.log(d)))
+    assert d ** L == total_dim
+    return L
+
+def get_gate_sites(gate, idx, d=2):
+    '''
+    return:
+        the list of sites the gate is acting on, where the number of sites k
+        is given by the size d**(2k) of the gate.
+        idx is either the first site of the contiguous sites
+        (idx, idx+1, ..., idx+k-1), or the list of k sites itself.
+    '''
+    num_sites = int(np.round(np.log(np.size(gate)) / np.log(d) / 2))
+    assert d ** (2 * num_sites) == np.size(gate)
+    if np.ndim(idx) == 0:
+        return list(range(idx, idx + num_sites))
+
+    sites = [int(site) for site in idx]
+    assert len(sites) == num_sites and len(set(sites)) == num_sites
+    return sites
+
+def is_contiguous_sites(sites):
+    '''
+    return:
+        whether sites is (idx, idx+1, ..., idx+k-1)
+    '''
+    return sites == list(range(sites[0], sites[0] + len(sites)))
+
+def apply_gate_exact(state, gate, idx, d=2):
     '''
     Goal:
         Apply gate on the state vector
-        assuming local dimension d=2
+        with local dimension d
     Input:
         state: a vector
         gate: the gate to apply
-        idx: the gate is applying on (idx, idx+1)
+        idx: the gate is applying on (idx, idx+1);
+            a k-site gate of size d**k x d**k, e.g. a block from
+            fuse_circuit, is applying on (idx, idx+1, ..., idx+k-1);
+            idx can also be a list of k arbitrary sites, e.g. [5, 0] for a
+            long-range gate, where the gate indices follow the order of the
+            list, [i5', i0', i5, i0].
+        d: the local dimension
 
     Return:
         state
     '''
     total_dim = state.size
-    L = int(np.log2(total_dim))
-    theta = np.reshape(state, [(2**idx), 4, 2**(L-(idx+2))])
-    gate = np.reshape(gate, [4, 4])
+    L = get_system_size(total_dim, d)
+    sites = get_gate_sites(gate, idx, d)
+    num_sites = len(sites)
+    dim = d ** num_sites
+    if not is_contiguous_sites(sites):
+        ## the gate is contracted on the axes of the sites directly,
+        ## without swapping the sites next to each other.
+        theta = np.reshape(state, [d] * L)
+        gate = np.reshape(gate, [d] * (2 * num_sites))
+        theta = np.tensordot(gate, theta, [list(range(num_sites, 2 * num_sites)), sites])
+        return np.moveaxis(theta, list(range(num_sites)), sites).flatten()
+
+    idx = sites[0]
+    theta = np.reshape(state, [(d**idx), dim, d**(L-(idx+num_sites))])
+    gate = np.reshape(gate, [dim, dim])
 
     theta = np.tensordot(gate, theta, [1, 1])  ## [ij] [..., j, ...] --> [i, ..., ...]
     state = (np.transpose(theta, [1, 0, 2])).flatten()
@@ -1162,7 +1777,187 @@ def apply_gate_exact(state, gate, idx):
     # state = (np.transpose(theta, [0, 2, 1])).flatten()
     return state
 
-def apply_gate_mpo(A_list, gate, idx, pos, move, no_trunc=False, chi=None, normalized=False):
+def get_thread_pool(num_threads=None):
+    '''
+    return:
+        a ThreadPoolExecutor with num_threads workers, shared between calls.
+        None means using all cores.
+    '''
+    if num_threads is None:
+        num_threads = os.cpu_count()
+
+    if num_threads not in get_thread_pool.pools:
+        get_thread_pool.pools[num_threads] = ThreadPoolExecutor(max_workers=num_threads)
+
+    return get_thread_pool.pools[num_threads]
+
+get_thread_pool.pools = {}
+
+def split_theta_exact(theta, max_chunk_size=2**20, min_num_chunks=1):
+    '''
+    Goal:
+        Split the view theta of shape [left, dim, right] into
+        chunks along the left or the right axis.
+    Return:
+        list of views of theta, each with at most ~max_chunk_size elements
+    '''
+    left, dim, right = theta.shape
+    if left >= right:
+        step = max(1, min(max_chunk_size // (dim * right), -(-left // min_num_chunks)))
+        return [theta[i:i+step] for i in range(0, left, step)]
+    else:
+        step = max(1, min(max_chunk_size // (dim * left), -(-right // min_num_chunks)))
+        return [theta[:, :, i:i+step] for i in range(0, right, step)]
+
+def apply_gate_to_chunks(chunk_list, gate):
+    '''
+    [modification inplace]
+    apply the matrix gate on axis 1 of each chunk [left, dim, right].
+    '''
+    for chunk in chunk_list:
+        chunk[...] = np.matmul(gate, chunk)  ## [ij] [..., j, ...] --> [..., i, ...]
+
+def split_state_strided(theta, num_sites, max_chunk_size=2**20, min_num_chunks=1):
+    '''
+    Goal:
+        Split the strided view theta of shape [d, ..., d], with the num_sites
+        sites of a gate moved to the last axes, into chunks by fixing the
+        leading axes.
+    Return:
+        list of views of theta, each with at most ~max_chunk_size elements
+        if possible, and containing all the last num_sites axes.
+    '''
+    shape = theta.shape
+    num_leading = 0
+    while (num_leading < len(shape) - num_sites and
+           (int(np.prod(shape[num_leading:])) > max_chunk_size or
+            int(np.prod(shape[:num_leading])) < min_num_chunks)):
+        num_leading += 1
+
+    return [theta[index] for index in np.ndindex(*shape[:num_leading])]
+
+def apply_gate_to_strided_chunks(chunk_list, gate):
+    '''
+    [modification inplace]
+    apply the matrix gate on the last axes of each chunk, see
+    split_state_strided. The chunks are not contiguous, so each is
+    gathered in a chunk-sized temporary and written back.
+    '''
+    for chunk in chunk_list:
+        theta = np.reshape(chunk, [-1, gate.shape[1]])
+        chunk[...] = np.dot(theta, gate.T).reshape(chunk.shape)  ## [..., j] [ij] --> [..., i]
+
+def apply_gate_exact_inplace(state, gate, idx, num_threads=None, d=2):
+    '''
+    [modification inplace]
+    Goal:
+        Apply gate on the state vector as apply_gate_exact, but without
+        creating new copies of the full state.
+        with local dimension d
+    Input:
+        state: a contiguous vector, with a dtype that can hold the result,
+            e.g. complex for complex gates.
+        gate: the gate to apply
+        idx: the gate is applying on (idx, idx+1), or on idx, ..., idx+k-1
+            for a k-site gate, or on a list of arbitrary sites,
+            see apply_gate_exact.
+            For non-contiguous sites, the axes of the sites are moved to
+            the end of a strided view of the state, i.e. only the strides
+            are permuted and no swap of the amplitudes is needed.
+        num_threads: number of threads; the gate is applied on chunks of the
+            state in parallel, with a chunk-sized temporary per thread.
+            None means using all cores.
+        d: the local dimension
+
+    Return:
+        state
+    '''
+    assert state.flags.c_contiguous
+    assert np.can_cast(np.result_type(state, gate), state.dtype)
+    total_dim = state.size
+    L = get_system_size(total_dim, d)
+    sites = get_gate_sites(gate, idx, d)
+    num_sites = len(sites)
+    dim = d ** num_sites
+    gate = np.reshape(gate, [dim, dim])
+    if num_threads is None:
+        num_threads = os.cpu_count()
+
+    if is_contiguous_sites(sites):
+        idx = sites[0]
+        theta = np.reshape(state, [(d**idx), dim, d**(L-(idx+num_sites))])
+        apply_fn = apply_gate_to_chunks
+        chunk_list = split_theta_exact(theta, min_num_chunks=num_threads)
+    else:
+        theta = np.moveaxis(np.reshape(state, [d] * L), sites,
+                            list(range(L - num_sites, L)))
+        apply_fn = apply_gate_to_strided_chunks
+        chunk_list = split_state_strided(theta, num_sites, min_num_chunks=num_threads)
+
+    if num_threads == 1:
+        apply_fn(chunk_list, gate)
+        return state
+
+    pool = get_thread_pool(num_threads)
+    jobs = [pool.submit(apply_fn, [chunk], gate) for chunk in chunk_list]
+    for job in jobs:
+        job.result()
+
+    return state
+
+def apply_U_all_exact_inplace(exact_state, U_list, num_threads=None, d=2):
+    '''
+    [modification inplace]
+    Goal:
+        apply a list of two site gates in U_list according to the order to sites
+        [(0, 1), (1, 2), (2, 3), ... ], as apply_U_all_exact(cache=False),
+        without creating new copies of the full state.
+    Input:
+        exact_state: a contiguous vector, see apply_gate_exact_inplace
+        U_list: a list of two site unitary gates
+        num_threads: number of threads, None means using all cores.
+        d: the local dimension
+
+    The gates on (i, i+1) with i < k touch the leading qubits 0, ..., k-1,
+    and are applied one by one on the whole state. The other gates only act
+    on the qubits k, ..., L-1, and are applied fused: each thread takes a
+    contiguous block of d**(L-k) amplitudes and applies all of them on the
+    block while it is in cache.
+
+    Return:
+        exact_state
+    '''
+    L = len(U_list) + 1
+    if num_threads is None:
+        num_threads = os.cpu_count()
+
+    # number of leading qubits, such that there are enough blocks
+    num_leading = min(L - 2, max(1, int(np.ceil(np.log2(4 * num_threads) / np.log2(d)))))
+    for site_i in range(num_leading):
+        apply_gate_exact_inplace(exact_state, U_list[site_i], site_i,
+                                 num_threads=num_threads, d=d)
+
+    L_block = L - num_leading
+    gate_list = [np.reshape(U_list[site_i], [d**2, d**2]) for site_i in range(num_leading, L-1)]
+    def apply_block(block):
+        for site_i, gate in enumerate(gate_list):
+            theta = np.reshape(block, [(d**site_i), d**2, d**(L_block-(site_i+2))])
+            apply_gate_to_chunks(split_theta_exact(theta), gate)
+
+    block_list = np.reshape(exact_state, [d**num_leading, d**L_block])
+    if num_threads == 1:
+        for block in block_list:
+            apply_block(block)
+    else:
+        pool = get_thread_pool(num_threads)
+        jobs = [pool.submit(apply_block, block) for block in block_list]
+        for job in jobs:
+            job.result()
+
+    return exact_state
+
+def apply_gate_mpo(A_list, gate, idx, pos, move, no_trunc=False, chi=None, normalized=False,
+                   svd_method='full'):
     '''
     [modification inplace]
     Goal:
@@ -1176,6 +1971,7 @@ def apply_gate_mpo(A_list, gate, idx, pos, move, no_trunc=False, chi=None, norma
         move: the direction to combine tensor after SVD
         no_trunc: if True, then even numerical zeros are not truncated
         chi: the truncation bond dimension provided.
+        svd_method: see apply_gate
 
     Return:
         trunc_error
@@ -1193,7 +1989,8 @@ def apply_gate_mpo(A_list, gate, idx, pos, move, no_trunc=False, chi=None, norma
         theta = np.tensordot(gate, theta, axes=([2,3],[2,5]))  #[q3, q4, p1, chi1, p2, chi3]
         theta = np.reshape(np.transpose(theta,(2,3,0,4,5,1)), (p1*chi1*q1, p2*chi3*q2))
 
-    X, Y, Z = misc.svd(theta, full_matrices=0)
+    X, Y, Z = misc.svd(theta, full_matrices=0, rank=None if no_trunc else chi,
+                       method=svd_method)
 
     if no_trunc:
         chi2 = np.size(Y)
@@ -1205,7 +2002,12 @@ def apply_gate_mpo(A_list, gate, idx, pos, move, no_trunc=False, chi=None, norma
 
     arg_sorted_idx = (np.argsort(Y)[::-1])[:chi2]
     trunc_idx = (np.argsort(Y)[::-1])[chi2:]
-    trunc_error = np.sum(Y[trunc_idx] ** 2) / np.sum(Y**2)
+    if np.size(Y) < min(theta.shape):
+        ## truncated svd; the discarded weight comes from the norm of theta
+        Y_norm = np.linalg.norm(theta)
+        trunc_error = max(1. - np.sum(Y[arg_sorted_idx] ** 2) / Y_norm ** 2, 0.)
+    else:
+        trunc_error = np.sum(Y[trunc_idx] ** 2) / np.sum(Y**2)
     Y = Y[arg_sorted_idx]  # chi2
     if normalized:
         Y = Y / np.linalg.norm(Y)
@@ -1231,7 +2033,7 @@ def overlap_exact(psi1, psi2):
     '''
     return np.dot(np.conjugate(psi1), psi2)
 
-def apply_U_all_exact(exact_state, U_list, cache=False):
+def apply_U_all_exact(exact_state, U_list, cache=False, d=2):
     #[TODO] Write also applying gates backward (L-2, L-1), (L-3, L-2), ...?
     '''
     Goal:
@@ -1243,6 +2045,7 @@ def apply_U_all_exact(exact_state, U_list, cache=False):
 
         U_list: a list of two site unitary gates
         cache: indicate whether the intermediate state should be store.
+        d: the local dimension
     Output:
         if cache is True, we will return a list of exact states,
         which gives the list of mps of length L, which corresponds to
@@ -1256,7 +2059,7 @@ def apply_U_all_exact(exact_state, U_list, cache=False):
     for site_i in range(L-1):
         gate = U_list[site_i]
         # apply gate on (site_i, site_i+1)
-        exact_state = apply_gate_exact(exact_state, gate, site_i)
+        exact_state = apply_gate_exact(exact_state, gate, site_i, d=d)
 
         if cache:
             list_states.append(exact_state.copy())
@@ -1268,7 +2071,69 @@ def apply_U_all_exact(exact_state, U_list, cache=False):
     else:
         return exact_state
 
-def apply_U_all(A_list, U_list, cache=False, no_trunc=False, chi=None, normalized=True):
+class MPSDiffCache(object):
+    '''
+    The sequence of states of a mps to which gates are applied one
+    after another, e.g. the intermediate states in apply_U_all.
+
+    Instead of a full copy of the mps for each state, only the two
+    tensors modified by each gate are recorded, together with the
+    tensors they replace. cache[k] gives the state after k gates as a new
+    list referencing the stored tensors, without copying any tensor.
+    The stored tensors are shared between the states, and should not be
+    modified inplace. (apply_gate never does, it replaces the tensors.)
+
+    Usage:
+        cache = MPSDiffCache(A_list)
+        apply_gate(A_list, gate, idx, move)
+        cache.record(A_list, idx)
+        ...
+        cache[k]
+    '''
+    def __init__(self, A_list):
+        self.latest = list(A_list)
+        self.view = list(A_list)
+        self.position = 0
+        # list of (idx, old tensors, new tensors)
+        self.diffs = []
+
+    def __len__(self):
+        return len(self.diffs) + 1
+
+    def record(self, A_list, idx, num_sites=2):
+        '''
+        record that the tensors on idx, ..., idx+num_sites-1 of A_list
+        have been replaced.
+        '''
+        sites = range(idx, idx + num_sites)
+        old_tensors = [self.latest[i] for i in sites]
+        new_tensors = [A_list[i] for i in sites]
+        for i in sites:
+            self.latest[i] = A_list[i]
+
+        self.diffs.append((idx, old_tensors, new_tensors))
+
+    def __getitem__(self, k):
+        if k < 0:
+            k += len(self)
+
+        if not 0 <= k < len(self):
+            raise IndexError(k)
+
+        while self.position < k:
+            idx, _, new_tensors = self.diffs[self.position]
+            self.view[idx:idx + len(new_tensors)] = new_tensors
+            self.position += 1
+
+        while self.position > k:
+            self.position -= 1
+            idx, old_tensors, _ = self.diffs[self.position]
+            self.view[idx:idx + len(old_tensors)] = old_tensors
+
+        return list(self.view)
+
+def apply_U_all(A_list, U_list, cache=False, no_trunc=False, chi=None, normalized=True,
+                batched=False, skip_identity=False):
     # Make this function as an application of apply_gate only.
     #[TODO] Write also applying gates backward (L-2, L-1), (L-3, L-2), ...?
     '''
@@ -1285,26 +2150,43 @@ def apply_U_all(A_list, U_list, cache=False, no_trunc=False, chi=None, normalize
 
         no_trunc: indicate whether truncation should take place
         chi: truncate to bond dimension chi, if chi is given. Must make sure no_trunc is True.
+        batched: if True (and cache is False), the layer is applied with
+            apply_U_all_batched, see there.
+        skip_identity: if True, the identity gates, e.g. in the brickwall
+            circuit, are applied with apply_identity_gate, i.e. a QR
+            instead of the SVD, unless the bond needs truncation to chi.
+            Then no_trunc plays no role for these gates, and the numerical
+            zeros of the bond are not dropped by the 1e-14 cutoff.
     Output:
         if cache is True, we will return a list_A_list,
         which gives the list of mps of length L, which corresponds to
         applying 0, 1, 2, ... L-1 gates.
+        list_A_list is a MPSDiffCache, which only stores the two tensors
+        modified by each gate. The tensors are shared between the states
+        and should not be modified inplace.
     '''
+    if batched and not cache:
+        return apply_U_all_batched(A_list, U_list, no_trunc=no_trunc, chi=chi,
+                                   normalized=normalized)
+
     L = len(A_list)
     if cache:
-        list_A_list = []
-        list_A_list.append([A.copy() for A in A_list])
+        list_A_list = MPSDiffCache(A_list)
 
     tot_trunc_err = 0.
     for i in range(L-1):
         gate = U_list[i]
-        trunc_error = apply_gate(A_list, gate, i, move='right', no_trunc=no_trunc,
-                                 chi=chi, normalized=normalized)
+        if (skip_identity and is_identity_gate(gate) and
+                (chi is None or A_list[i].shape[2] <= chi)):
+            trunc_error = apply_identity_gate(A_list, i, move='right', normalized=normalized)
+        else:
+            trunc_error = apply_gate(A_list, gate, i, move='right', no_trunc=no_trunc,
+                                     chi=chi, normalized=normalized)
 
         tot_trunc_err = tot_trunc_err + trunc_error
 
         if cache:
-            list_A_list.append([A.copy() for A in A_list])
+            list_A_list.record(A_list, i)
         else:
             pass
 
@@ -1313,6 +2195,318 @@ def apply_U_all(A_list, U_list, cache=False, no_trunc=False, chi=None, normalize
     else:
         return A_list, tot_trunc_err
 
+def is_identity_gate(gate, atol=1e-14):
+    '''
+    return:
+        True if the gate is the identity, e.g. the np.eye(4) inserted
+        in the brickwall circuit.
+    '''
+    gate = np.asarray(gate)
+    dim = int(np.sqrt(gate.size))
+    return np.allclose(gate.reshape([dim, dim]), np.eye(dim), rtol=0, atol=atol)
+
+def fuse_circuit(circuit, max_block_size=2, atol=1e-14):
+    '''
+    Goal:
+        Preprocess the circuit before the exact or the mps simulation.
+        1. The identity gates, e.g. in the brickwall circuit, are dropped.
+        2. Each gate is commuted back past the gates acting on disjoint
+           sites, and merged into the gate on the same bond if it meets one.
+           Gates merged into the identity are dropped as well.
+        3. If max_block_size > 2, consecutive blocks are fused greedily
+           into blocks on at most max_block_size contiguous sites.
+           This is for the exact simulation, where a k-site block costs
+           a single pass over the state.
+    Input:
+        circuit: list of list of U, see circuit_2_state
+        max_block_size: maximal number of sites of a fused block
+        atol: tolerance to identify the identity gates
+    Return:
+        block_list: list of [idx, num_sites, gate] in the order to apply,
+            where gate is a matrix of size d**num_sites acting on sites
+            idx, idx+1, ..., idx+num_sites-1
+        info: dict with the number of gates and blocks, and the estimated
+            cost before/after fusion; 'exact_flops' for the exact simulation
+            and 'mps_svd' for the number of two-site SVDs in the mps simulation.
+    '''
+    assert max_block_size >= 2
+    L = len(circuit[0]) + 1
+    d = int(np.round(np.size(circuit[0][0]) ** 0.25))
+
+    num_gates = 0
+    num_identity = 0
+    num_merged = 0
+    block_list = []
+    for U_list in circuit:
+        for idx, gate in enumerate(U_list):
+            num_gates += 1
+            if is_identity_gate(gate, atol=atol):
+                num_identity += 1
+                continue
+
+            gate = np.reshape(gate, [d**2, d**2])
+            pos = 0
+            for j in range(len(block_list) - 1, -1, -1):
+                b_idx, b_num_sites, b_gate = block_list[j]
+                if b_idx + b_num_sites <= idx or idx + 2 <= b_idx:
+                    continue
+
+                if b_idx == idx and b_num_sites == 2:
+                    block_list[j][2] = np.dot(gate, b_gate)
+                    num_merged += 1
+                    if is_identity_gate(block_list[j][2], atol=atol):
+                        del block_list[j]
+                    pos = None
+                else:
+                    pos = j + 1
+
+                break
+
+            if pos is not None:
+                block_list.insert(pos, [idx, 2, gate])
+
+    if max_block_size > 2:
+        fused_list = []
+        for block in block_list:
+            if fused_list:
+                a_idx, a_num_sites, a_gate = fused_list[-1]
+                b_idx, b_num_sites, b_gate = block
+                start = min(a_idx, b_idx)
+                stop = max(a_idx + a_num_sites, b_idx + b_num_sites)
+                if stop - start <= max_block_size:
+                    def embed(g, g_idx, g_num_sites):
+                        g = np.kron(np.eye(d**(g_idx - start)), g)
+                        return np.kron(g, np.eye(d**(stop - g_idx - g_num_sites)))
+
+                    fused_list[-1] = [start, stop - start,
+                                      np.dot(embed(b_gate, b_idx, b_num_sites),
+                                             embed(a_gate, a_idx, a_num_sites))]
+                    continue
+
+            fused_list.append(block)
+
+        block_list = fused_list
+
+    ## complex multiply-add of a [d**k, d**k] matrix on all amplitudes
+    flops_per_block = lambda num_sites: 8 * d**num_sites * d**L
+    info = {'num_gates': num_gates,
+            'num_identity': num_identity,
+            'num_merged': num_merged,
+            'num_blocks': len(block_list),
+            'exact_flops_before': num_gates * flops_per_block(2),
+            'exact_flops_after': sum([flops_per_block(b[1]) for b in block_list]),
+            'mps_svd_before': num_gates,
+            'mps_svd_after': sum([b[1] == 2 for b in block_list]),
+           }
+    return block_list, info
+
+def apply_blocks_exact(state, block_list, inplace=False, num_threads=None, d=2):
+    '''
+    Goal:
+        apply the blocks from fuse_circuit on the state vector.
+    Input:
+        state: a vector
+        block_list: see fuse_circuit; idx of a block can also be a list of
+            num_sites arbitrary sites, e.g. for long-range gates, see
+            apply_gate_exact.
+        inplace: if True, the blocks are applied with apply_gate_exact_inplace
+            on the state, which then should be a contiguous complex vector.
+        d: the local dimension
+    Return:
+        state
+    '''
+    for idx, num_sites, gate in block_list:
+        if inplace:
+            apply_gate_exact_inplace(state, gate, idx, num_threads=num_threads, d=d)
+        else:
+            state = apply_gate_exact(state, gate, idx, d=d)
+
+    return state
+
+def apply_blocks_mps(A_list, block_list, chi=None, normalized=True):
+    '''
+    [modification inplace]
+    Goal:
+        apply the two-site blocks from fuse_circuit(max_block_size=2) on
+        the MPS. Before each block, the orthogonality center is moved to
+        the block with apply_identity_gate, so each block takes a single SVD.
+    Input:
+        A_list: the MPS in right canonical form
+        block_list: see fuse_circuit
+        chi: truncate to bond dimension chi, if chi is given.
+    Return:
+        A_list, tot_trunc_err
+        A_list is in mixed canonical form.
+    '''
+    center = 0
+    tot_trunc_err = 0.
+    for idx, num_sites, gate in block_list:
+        assert num_sites == 2
+        while center < idx:
+            apply_identity_gate(A_list, center, move='right')
+            center += 1
+
+        while center > idx + 1:
+            apply_identity_gate(A_list, center - 1, move='left')
+            center -= 1
+
+        d = int(np.sqrt(np.sqrt(np.size(gate))))
+        trunc_error = apply_gate(A_list, np.reshape(gate, [d] * 4), idx, move='right',
+                                 chi=chi, normalized=normalized)
+        tot_trunc_err = tot_trunc_err + trunc_error
+        center = idx + 1
+
+    return A_list, tot_trunc_err
+
+def apply_U_all_batched(A_list, U_list, no_trunc=False, chi=None, normalized=True):
+    '''
+    [modification inplace]
+    Goal:
+        apply the layer U_list as apply_U_all does, for the case that
+        the non-identity gates act on disjoint bonds, i.e. a brickwall
+        layer. The identity gates are skipped, the remaining gates commute,
+        and all two-site blocks of the same shape are contracted and
+        decomposed together with a single batched SVD.
+
+        If two non-identity gates overlap, the layer is not of this type
+        and we fall back to the sequential apply_U_all, as well as if a
+        bond of an identity gate is larger than chi.
+
+        The blocks are decomposed while the orthogonality center is at the
+        site 0. A gate on the sites (i, i+1) does not change the left
+        environment R^dagger R of the bond (i-1, i), so if chi can bind,
+        i.e. min(d1 * chi1, d2 * chi3) > chi for any block, R is computed
+        for all blocks with a single sweep of QRs (R only) from the site 0,
+        and the SVD of R theta gives the optimal truncation of each block.
+        The new tensors are theta Z^dagger and Z, and the truncated sites
+        are brought back to the right canonical form with a LQ sweep.
+        As in TEBD, each block is truncated with the other blocks not
+        truncated yet, instead of after the blocks on its left as in
+        apply_U_all, so the truncation errors agree with apply_U_all to
+        the leading order only.
+    Input:
+        A_list: the MPS representation to which the U_list apply,
+                should be in right canonical form.
+                A_list stays in right canonical form.
+        U_list: a list of two site unitary gates
+        no_trunc: if True, then even numerical zeros are not truncated
+        chi: the truncation bond dimension provided.
+    Output:
+        A_list, tot_trunc_err
+    '''
+    L = len(A_list)
+    center = mps_func.get_center(A_list)
+    active_sites = [i for i in range(L-1) if not is_identity_gate(U_list[i])]
+    def fall_back():
+        return apply_U_all(A_list, U_list, cache=False, no_trunc=no_trunc,
+                           chi=chi, normalized=normalized)
+
+    for i, j in zip(active_sites[:-1], active_sites[1:]):
+        if j - i < 2:
+            return fall_back()
+
+    if chi is not None and np.amax(mps_func.get_bond_dims(A_list)) > chi:
+        return fall_back()
+
+    can_bind = chi is not None and any(
+        min(A_list[i].shape[0] * A_list[i].shape[1],
+            A_list[i + 1].shape[0] * A_list[i + 1].shape[2]) > chi for i in active_sites)
+
+    ## left_R[i] [chi1', chi1], with R^dagger R the left environment of the site i
+    left_R = {}
+    if can_bind:
+        R = np.ones([1, 1])
+        for i in range(active_sites[-1] + 1):
+            left_R[i] = R
+
+            d1, chi1, chi2 = A_list[i].shape
+            C = np.tensordot(R, A_list[i], axes=([1], [1]))  # [a, p, r]
+            R = np.linalg.qr(np.reshape(C, [-1, chi2]), mode='r')
+
+    # group the blocks of the same shape
+    groups = {}
+    for i in active_sites:
+        key = A_list[i].shape + A_list[i + 1].shape
+        if can_bind:
+            key = key + (left_R[i].shape[0],)
+
+        groups.setdefault(key, []).append(i)
+
+    tot_trunc_err = 0.
+    last_truncated = None
+    for key, sites in groups.items():
+        d1, chi1, chi2, d2, _, chi3 = key[:6]
+        num_blocks = len(sites)
+        A = np.stack([A_list[i] for i in sites])  # [n, d1, chi1, chi2]
+        B = np.stack([np.transpose(A_list[i + 1], [1, 0, 2]) for i in sites])  # [n, chi2, d2, chi3]
+        gates = np.stack([np.reshape(U_list[i], [d1 * d2, d1 * d2]) for i in sites])
+
+        theta = np.matmul(A.reshape([num_blocks, d1 * chi1, chi2]),
+                          B.reshape([num_blocks, chi2, d2 * chi3]))  # [n, (d1, chi1), (d2, chi3)]
+        theta = theta.reshape([num_blocks, d1, chi1, d2, chi3]).transpose([0, 1, 3, 2, 4])
+        theta = np.matmul(gates, theta.reshape([num_blocks, d1 * d2, chi1 * chi3]))  # [n, (i',j'), (D1, D2)]
+        theta = theta.reshape([num_blocks, d1, d2, chi1, chi3]).transpose([0, 1, 3, 2, 4])
+        theta = theta.reshape([num_blocks, d1, chi1, d2 * chi3])  # [n, i', D1, (j',D2)]
+        if can_bind:
+            R = np.stack([left_R[i] for i in sites])  # [n, a, D1]
+            weighted = np.matmul(R[:, None], theta)  # [n, i', a, (j',D2)]
+            weighted = weighted.reshape([num_blocks, -1, d2 * chi3])
+        else:
+            weighted = theta.reshape([num_blocks, d1 * chi1, d2 * chi3])
+
+        theta = theta.reshape([num_blocks, d1 * chi1, d2 * chi3])  # [n, (i',D1), (j',D2)]
+        ## the batched svd of numpy is only faster than one misc.svd per
+        ## block for blocks up to about 64 x 64
+        S = None
+        if min(weighted.shape[1:]) <= 64:
+            try:
+                X, S, Z = np.linalg.svd(weighted, full_matrices=False)
+            except np.linalg.LinAlgError:
+                S = None
+
+        if S is None:
+            X, S, Z = zip(*[misc.svd(t, full_matrices=False) for t in weighted])
+
+        for block_idx, i in enumerate(sites):
+            Y = S[block_idx]
+            arg_sorted_idx = np.argsort(Y)[::-1]
+            if no_trunc:
+                new_chi2 = np.size(Y)
+            else:
+                new_chi2 = num_nonzero = np.sum((Y/np.linalg.norm(Y))>1e-14)
+                if chi is not None:
+                    new_chi2 = np.amin([new_chi2, chi])
+
+                if new_chi2 < num_nonzero:
+                    last_truncated = max(i, last_truncated or 0)
+
+            trunc_idx = arg_sorted_idx[new_chi2:]
+            trunc_error = np.sum(Y[trunc_idx] ** 2) / np.sum(Y**2)
+            tot_trunc_err = tot_trunc_err + trunc_error
+
+            Z_i = Z[block_idx][arg_sorted_idx[:new_chi2], :]
+
+            ## theta Z^dagger instead of X Y, so that R is not inverted
+            A_list[i] = np.dot(theta[block_idx], np.conj(Z_i.T)).reshape([d1, chi1, new_chi2])
+            A_list[i + 1] = np.transpose(Z_i.reshape([new_chi2, d2, chi3]), [1, 0, 2])
+
+    if last_truncated is not None:
+        mps_func.move_orthogonality_center(A_list, last_truncated, 0)
+
+    if normalized:
+        ## A_list[0] carries the norm only if A_list was right canonical
+        if center == 0:
+            norm = np.linalg.norm(A_list[0])
+        else:
+            norm = np.sqrt(np.abs(mps_func.overlap(A_list, A_list)))
+
+        A_list[0] = A_list[0] / norm
+
+    if center == 0:
+        mps_func.set_center(A_list, 0)
+
+    return A_list, tot_trunc_err
+
 def apply_U_all_mpo(A_list, U_list, cache=False, no_trunc=False, chi=None, normalized=False):
     '''
     Goal:
@@ -1357,11 +2551,17 @@ def apply_U_all_mpo(A_list, U_list, cache=False, no_trunc=False, chi=None, norma
     else:
         return A_list, tot_trunc_err
 
-def apply_U(A_list, U_list, onset):
+def apply_U(A_list, U_list, onset, num_threads=1):
     '''
     There are two subset of gate.
     onset indicate whether we are applying even (0, 2, 4, ...)
     or odd (1, 3, 5, ...) gates
+
+    The gates of a subset act on disjoint bonds and are independent.
+    With num_threads > 1 (None for all cores) they are applied by the
+    threads of get_thread_pool, as tensordot and svd release the GIL.
+    Each gate is computed exactly as in the sequential loop, so the
+    result is the same bit for bit.
     '''
     L = len(A_list)
 
@@ -1380,34 +2580,51 @@ def apply_U(A_list, U_list, onset):
 
 
     bound = L-1
-    for i in range(onset,bound,2):
-        d1,chi1,chi2 = A_list[i].shape
-        d2,chi2,chi3 = A_list[i+1].shape
+    sites = list(range(onset, bound, 2))
+    if num_threads == 1 or len(sites) < 2:
+        results = [apply_U_bond(A_list[i], A_list[i+1], U_list[i]) for i in sites]
+    else:
+        results = get_thread_pool(num_threads).map(
+            lambda i: apply_U_bond(A_list[i], A_list[i+1], U_list[i]), sites)
 
-        theta = np.tensordot(A_list[i],A_list[i+1],axes=(2,1))
-        theta = np.tensordot(U_list[i],theta,axes=([0,1],[0,2]))
-        theta = np.reshape(np.transpose(theta,(0,2,1,3)),(d1*chi1, d2*chi3))
+    for i, (A, B) in zip(sites, results):
+        Ap_list[i] = A
+        Ap_list[i+1] = B
 
-        X, Y, Z = misc.svd(theta,full_matrices=0)
-        chi2 = np.sum(Y>1e-14)
+    return Ap_list
+
+def apply_U_bond(A1, A2, gate):
+    '''
+    Goal:
+        Apply the gate on the two sites A1, A2, as done for each bond in
+        apply_U.
+    Return:
+        the two new tensors, the singular values absorbed in the second one.
+    '''
+    d1,chi1,chi2 = A1.shape
+    d2,chi2,chi3 = A2.shape
 
-        # piv = np.zeros(len(Y), onp.bool)
-        # piv[(np.argsort(Y)[::-1])[:chi2]] = True
+    theta = np.tensordot(A1,A2,axes=(2,1))
+    theta = np.tensordot(gate,theta,axes=([0,1],[0,2]))
+    theta = np.reshape(np.transpose(theta,(0,2,1,3)),(d1*chi1, d2*chi3))
 
-        # Y = Y[piv]; invsq = np.sqrt(sum(Y**2))
-        # X = X[:,piv]
-        # Z = Z[piv,:]
+    X, Y, Z = misc.svd(theta,full_matrices=0)
+    chi2 = np.sum(Y>1e-14)
 
-        arg_sorted_idx = (np.argsort(Y)[::-1])[:chi2]
-        Y = Y[arg_sorted_idx]
-        X = X[: ,arg_sorted_idx]
-        Z = Z[arg_sorted_idx, :]
+    # piv = np.zeros(len(Y), onp.bool)
+    # piv[(np.argsort(Y)[::-1])[:chi2]] = True
 
-        X=np.reshape(X, (d1, chi1, chi2))
-        Ap_list[i]   = X.reshape([d1, chi1, chi2])
-        Ap_list[i+1] = np.dot(np.diag(Y), Z).reshape([chi2, d2, chi3]).transpose([1, 0, 2])
+    # Y = Y[piv]; invsq = np.sqrt(sum(Y**2))
+    # X = X[:,piv]
+    # Z = Z[piv,:]
 
-    return Ap_list
+    arg_sorted_idx = (np.argsort(Y)[::-1])[:chi2]
+    Y = Y[arg_sorted_idx]
+    X = X[: ,arg_sorted_idx]
+    Z = Z[arg_sorted_idx, :]
+
+    X=np.reshape(X, (d1, chi1, chi2))
+    return X.reshape([d1, chi1, chi2]), np.dot(np.diag(Y), Z).reshape([chi2, d2, chi3]).transpose([1, 0, 2])
 
 def var_A(A_list, Ap_list, sweep='left'):
     '''
@@ -1,7 +1,48 @@
+import numpy as np
 import scipy
+import scipy.linalg
+import scipy.sparse.linalg
+try:
+    import opt_einsum
+except ImportError:
+    opt_einsum = None
+
+def svd(theta, compute_uv=True, full_matrices=True, rank=None, method='full'):
+    """SVD with gesvd backup
+
+    rank: the number of leading singular values needed, e.g. the chi the
+        caller truncates to. It is only used by the truncated methods.
+        The caller should check the number of singular values returned;
+        fewer than min(theta.shape) means only the leading rank ones are
+        computed, in descending order.
+    method: 'full', 'randomized', 'arpack', 'gram' or 'auto'.
+        'full' is the scipy svd, returning all singular values; the default.
+        'randomized' and 'arpack' only compute the leading rank singular
+        triplets, which costs O(mn rank) instead of O(mn min(m, n)).
+        The randomized svd is approximate: for a decaying spectrum the
+        kept singular values are accurate to ~1e-10, but for a flat one,
+        e.g. a random 512 x 512 theta with rank 64, they are off by up to
+        4% and the truncation error is ~1% above the optimal one.
+        'gram' is for very wide or tall matrices, see gram_svd.
+        'auto' takes 'randomized' if rank is much smaller than the matrix,
+        see truncated_svd_is_faster, and 'full' otherwise; so it is
+        approximate as well, and the callers have to opt in.
+    """
+    if method == 'auto':
+        if rank is not None and truncated_svd_is_faster(theta.shape, rank):
+            method = 'randomized'
+        else:
+            method = 'full'
+
+    if method == 'randomized':
+        return randomized_svd(theta, rank, compute_uv=compute_uv)
+    elif method == 'arpack':
+        return arpack_svd(theta, rank, compute_uv=compute_uv)
+    elif method == 'gram':
+        return gram_svd(theta, compute_uv=compute_uv)
+    elif method != 'full':
+        raise NotImplementedError
 
-def svd(theta, compute_uv=True, full_matrices=True):
-    """SVD with gesvd backup"""
     try:
         return scipy.linalg.svd(theta,
                                 compute_uv=compute_uv,
@@ -13,3 +54,209 @@ def svd(theta, compute_uv=True, full_matrices=True):
                                 full_matrices=full_matrices,
                                 lapack_driver='gesvd')
 
+def truncated_svd_is_faster(shape, rank, min_dim=64, ratio=4):
+    """whether a truncated svd of the given rank pays off, i.e. the matrix
+    is not small and rank is a small fraction of its smaller dimension."""
+    n = min(shape)
+    return n >= min_dim and rank * ratio <= n
+
+def randomized_svd(theta, rank, compute_uv=True, n_oversamples=10, n_iter=4, seed=0):
+    """Randomized SVD (Halko, Martinsson, Tropp) of the leading rank
+    singular triplets, with n_iter power iterations.
+    A separate RandomState with a fixed seed is used, so the result is
+    reproducible and the global random state is not touched."""
+    m, n = theta.shape
+    k = min(rank + n_oversamples, m, n)
+    if k == min(m, n):
+        ## nothing to gain, return the full decomposition of theta
+        return svd(theta, compute_uv=compute_uv, full_matrices=False)
+
+    omega = np.random.RandomState(seed).randn(n, k)
+    Q, _ = np.linalg.qr(np.dot(theta, omega))
+    for _ in range(n_iter):
+        Q, _ = np.linalg.qr(np.dot(theta.T.conj(), Q))
+        Q, _ = np.linalg.qr(np.dot(theta, Q))
+
+    B = np.dot(Q.T.conj(), theta)
+    if not compute_uv:
+        return svd(B, compute_uv=False)[:rank]
+
+    U, S, Vh = svd(B, full_matrices=False)
+    return np.dot(Q, U[:, :rank]), S[:rank], Vh[:rank]
+
+def arpack_svd(theta, rank, compute_uv=True):
+    """Truncated SVD of the leading rank singular triplets with ARPACK,
+    falling back to the full SVD if rank is not smaller than the matrix."""
+    if rank >= min(theta.shape) - 1:
+        return svd(theta, compute_uv=compute_uv, full_matrices=False)
+
+    if not compute_uv:
+        S = scipy.sparse.linalg.svds(theta, k=rank, return_singular_vectors=False)
+        return np.sort(S)[::-1]
+
+    U, S, Vh = scipy.sparse.linalg.svds(theta, k=rank)
+    idx = np.argsort(S)[::-1]
+    return U[:, idx], S[idx], Vh[idx]
+
+def gram_svd(theta, compute_uv=True, max_chunk_size=2**22, rtol=1e-7):
+    """SVD of a wide (or tall) matrix from the eigendecomposition of its
+    small Gram matrix theta theta^dagger, which is accumulated over chunks
+    of columns. theta can be a np.memmap, which is then only read chunk by
+    chunk, twice.
+    The singular values below rtol * S[0] cannot be resolved from the Gram
+    matrix in double precision and are dropped, i.e. the returned
+    decomposition is truncated at a relative weight ~ rtol**2."""
+    m, n = theta.shape
+    if m > n:
+        result = gram_svd(theta.T.conj(), compute_uv=compute_uv,
+                          max_chunk_size=max_chunk_size, rtol=rtol)
+        if not compute_uv:
+            return result
+
+        U, S, Vh = result
+        return Vh.T.conj(), S, U.T.conj()
+
+    step = max(1, max_chunk_size // m)
+    G = np.zeros([m, m], dtype=np.result_type(theta.dtype, np.float64))
+    for col in range(0, n, step):
+        chunk = np.asarray(theta[:, col:col+step])
+        G += np.dot(chunk, chunk.T.conj())
+
+    w, U = np.linalg.eigh(G)
+    w, U = w[::-1], U[:, ::-1]
+    S = np.sqrt(np.maximum(w, 0.))
+    keep = S > rtol * S[0]
+    U, S = U[:, keep], S[keep]
+    if not compute_uv:
+        return S
+
+    Vh = np.empty([S.size, n], dtype=np.result_type(theta.dtype, U.dtype))
+    for col in range(0, n, step):
+        chunk = np.asarray(theta[:, col:col+step])
+        Vh[:, col:col+step] = np.dot(U.T.conj(), chunk) / S[:, None]
+
+    return U, S, Vh
+
+class ContractionPlan(object):
+    """The contraction order of einsum subscripts for operands of the given
+    shapes, found once and reused, see get_contraction_plan.
+
+    path: the pairwise contraction order, in the format of np.einsum_path
+    flops: the number of multiply-adds along the path
+    peak_size: the number of elements of the largest intermediate tensor,
+        including the result
+    naive_flops: the number of multiply-adds of a single loop over all
+        indices, i.e. of np.einsum without optimize
+
+    The path is found by opt_einsum if it is installed, and by
+    np.einsum_path otherwise ('optimal' for up to max_optimal operands,
+    'greedy' for more). It is translated into steps of np.tensordot, or
+    np.einsum for the steps with batch or traced indices, so that calling
+    the plan has no overhead beyond the contractions themselves.
+    """
+    def __init__(self, subscripts, shapes, max_optimal=6):
+        assert '->' in subscripts
+        self.subscripts = subscripts.replace(' ', '')
+        self.shapes = shapes
+        input_terms, output_term = self.subscripts.split('->')
+        input_terms = input_terms.split(',')
+        assert len(input_terms) == len(shapes)
+
+        if opt_einsum is not None:
+            path, _ = opt_einsum.contract_path(self.subscripts, *shapes, shapes=True)
+            self.path = ['einsum_path'] + list(path)
+        else:
+            dummy_operands = [np.broadcast_to(np.zeros(()), shape) for shape in shapes]
+            ## no memory limit, as in opt_einsum; the default limit of
+            ## np.einsum_path, the largest operand, can exclude the cheap paths.
+            optimize = 'optimal' if len(shapes) <= max_optimal else 'greedy'
+            self.path, _ = np.einsum_path(self.subscripts, *dummy_operands,
+                                          optimize=(optimize, 2**62))
+
+        index_sizes = {}
+        for term, shape in zip(input_terms, shapes):
+            index_sizes.update(zip(term, shape))
+
+        def get_size(indices):
+            return int(np.prod([index_sizes[c] for c in indices]))
+
+        self.naive_flops = get_size(set(self.subscripts) - set(',->'))
+        self.flops = 0
+        self.peak_size = get_size(output_term)
+        self.steps = []
+        terms = list(input_terms)
+        for contraction in self.path[1:]:
+            positions = sorted(contraction, reverse=True)
+            contracted = [terms.pop(k) for k in positions]
+            remaining = ''.join(terms) + output_term
+            indices = ''.join(contracted)
+            kept = ''.join(c for c in dict.fromkeys(indices) if c in remaining)
+            if len(contracted) == 2:
+                a, b = contracted
+                shared = [c for c in a if c in b]
+                new_term = ''.join(c for c in a + b if c not in shared)
+                is_tensordot = (len(set(a)) == len(a) and len(set(b)) == len(b) and
+                                sorted(new_term) == sorted(kept))
+            else:
+                is_tensordot = False
+
+            if is_tensordot:
+                axes = ([a.index(c) for c in shared], [b.index(c) for c in shared])
+                self.steps.append((positions, 'tensordot', axes))
+            else:
+                new_term = kept
+                self.steps.append((positions, 'einsum', ','.join(contracted) + '->' + new_term))
+
+            self.flops += get_size(set(indices))
+            self.peak_size = max(self.peak_size, get_size(new_term))
+            terms.append(new_term)
+
+        if terms[0] == output_term:
+            self.output_perm = None
+        else:
+            self.output_perm = [terms[0].index(c) for c in output_term]
+
+    def __call__(self, *operands):
+        operands = list(operands)
+        for positions, method, arg in self.steps:
+            ops = [operands.pop(k) for k in positions]
+            if method == 'tensordot':
+                operands.append(np.tensordot(ops[0], ops[1], axes=arg))
+            else:
+                operands.append(np.einsum(arg, *ops))
+
+        if self.output_perm is None:
+            return operands[0]
+        else:
+            return np.transpose(operands[0], self.output_perm)
+
+    def __repr__(self):
+        return ('ContractionPlan(%s, shapes=%s, flops=%d, peak_size=%d, naive_flops=%d)'
+                % (self.subscripts, self.shapes, self.flops, self.peak_size, self.naive_flops))
+
+def get_contraction_plan(subscripts, *shapes):
+    """the ContractionPlan of subscripts for the shapes, cached per
+    (subscripts, shapes), with at most max_cache_size plans kept."""
+    shapes = tuple(tuple(int(n) for n in shape) for shape in shapes)
+    key = (subscripts, shapes)
+    cache = get_contraction_plan.cache
+    if key not in cache:
+        if len(cache) >= get_contraction_plan.max_cache_size:
+            del cache[next(iter(cache))]
+
+        cache[key] = ContractionPlan(subscripts, shapes)
+
+    return cache[key]
+
+get_contraction_plan.cache = {}
+get_contraction_plan.max_cache_size = 1024
+
+def contract(subscripts, *operands):
+    """np.einsum(subscripts, *operands) along the cached contraction order
+    for the shapes of the operands, see get_contraction_plan."""
+    shapes = tuple(np.shape(op) for op in operands)
+    plan = get_contraction_plan.cache.get((subscripts, shapes))
+    if plan is None:
+        plan = get_contraction_plan(subscripts, *shapes)
+
+    return plan(*operands)
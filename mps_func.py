@@ -3,7 +3,7 @@ config.update("jax_enable_x64", True)
 import numpy as np
 import jax.numpy as jnp
 import jax
-from tensor_network_functions import circuit_func, misc
+from tensor_network_functions import circuit_func, misc, symmetric_tensor
 try:
     raise
     import tcl.tcl
@@ -78,6 +78,244 @@ def get_mps_amp_batch_jax(mps_list, config_batch):
 
     return jnp.trace(mat, axis1=0, axis2=2)
 
+def pad_mps_jax(mps_list, chi=None):
+    '''
+    [left, phys, right]
+
+    Goal:
+        pad the mps tensors with zeros to the uniform shape [chi, d, chi],
+        and stack them into a single array of shape [L, chi, d, chi].
+        The padded entries do not change the amplitudes, i.e. the trace
+        of the product of matrices.
+    Input:
+        mps_list: list of mps tensors
+        chi: the padded bond dimension; None takes the largest one.
+    '''
+    if chi is None:
+        chi = max([max(A.shape[0], A.shape[2]) for A in mps_list])
+
+    return jnp.stack([jnp.pad(A, [(0, chi - A.shape[0]), (0, 0), (0, chi - A.shape[2])])
+                      for A in mps_list])
+
+def get_mps_amp_batch_jax_fn(L, chi, d, batch_size, left_dim=1, log=False):
+    '''
+    Goal:
+        return the jit-compiled function (padded_mps, config_batch) -> amplitudes
+        for padded_mps of shape [L, chi, d, chi] from pad_mps_jax and
+        config_batch of shape [batch_size, L]. The sites are contracted with
+        lax.scan, so the compilation does not grow with L. The compiled
+        functions are cached per (L, chi, d, batch_size, left_dim, log).
+
+        left_dim is the left bond dimension of the first tensor before
+        padding, i.e. 1 for open boundary; only these rows are carried
+        through the contraction.
+
+        If log is True, the log amplitudes are returned instead; the
+        matrix product is rescaled at each site and the log of the scales
+        accumulated, so that it does not overflow or underflow.
+    '''
+    key = (L, chi, d, batch_size, left_dim, log)
+    if key in get_mps_amp_batch_jax_fn.cache:
+        return get_mps_amp_batch_jax_fn.cache[key]
+
+    def amp_fn(padded_mps, config_batch):
+        # [L, chi, d, chi], [batch, L]
+        init_mat = jnp.take(padded_mps[0, :left_dim], config_batch[:, 0], axis=1)  # [l, batch, chi]
+        init_log_scale = jnp.zeros([batch_size], dtype=jnp.real(padded_mps).dtype)
+
+        def step(carry, site_input):
+            mat, log_scale = carry
+            A, config = site_input
+            mat_i = jnp.take(A, config, axis=1)  # [chi, batch, chi]
+            mat = jnp.einsum('ibr,rbj->ibj', mat, mat_i)
+            if log:
+                scale = jnp.max(jnp.abs(mat), axis=(0, 2))
+                scale = jnp.where(scale > 0, scale, 1.)
+                mat = mat / scale[None, :, None]
+                log_scale = log_scale + jnp.log(scale)
+
+            return (mat, log_scale), None
+
+        (mat, log_scale), _ = jax.lax.scan(step, (init_mat, init_log_scale),
+                                           (padded_mps[1:], config_batch[:, 1:].T))
+        amp = jnp.trace(mat[:, :, :left_dim], axis1=0, axis2=2)
+        if log:
+            return jnp.log(amp.astype(jnp.result_type(amp, 1j))) + log_scale
+        else:
+            return amp
+
+    get_mps_amp_batch_jax_fn.cache[key] = jax.jit(amp_fn)
+    return get_mps_amp_batch_jax_fn.cache[key]
+
+get_mps_amp_batch_jax_fn.cache = {}
+
+def get_mps_amp_batch_jax_scan(mps_list, config_batch, log=False, left_dim=1):
+    '''
+    [left, phys, right]
+
+    Goal:
+        evaluate the probability amplitudes of the given configurations,
+        as get_mps_amp_batch_jax, with the compiled function from
+        get_mps_amp_batch_jax_fn.
+    Input:
+        mps_list: list of mps tensors, or the padded mps from pad_mps_jax,
+            which can be reused for many batches.
+        config_batch: 2d np array of config [num_data, system_size]
+        log: if True, return the (complex) log amplitudes
+        left_dim: the left bond dimension of the first tensor, only used
+            for the padded mps; it is read from the list otherwise.
+    '''
+    if isinstance(mps_list, (list, tuple)):
+        left_dim = mps_list[0].shape[0]
+        mps_list = pad_mps_jax(mps_list)
+
+    L, chi, d, _ = mps_list.shape
+    batch_size = config_batch.shape[0]
+    amp_fn = get_mps_amp_batch_jax_fn(L, chi, d, batch_size, left_dim=left_dim, log=log)
+    return amp_fn(mps_list, jnp.asarray(config_batch))
+
+def get_mps_amp_batch_prefix(mps_list, config_batch):
+    '''
+    [left, phys, right]
+
+    Goal:
+        evaluate the probability amplitude of the given configurations,
+        as get_mps_amp_batch_jax, contracting the shared prefixes only once.
+        The configurations are sorted lexicographically, and at each site
+        only the distinct prefixes are extended by one matrix.
+    Input:
+        mps_list: list of mps tensors
+        config_batch: 2d np array of config [num_data, system_size]
+    Return:
+        amplitudes in the order of config_batch
+    '''
+    config_batch = np.asarray(config_batch)
+    num_data, L = config_batch.shape
+    order = np.lexsort(config_batch.T[::-1])
+    sorted_config = config_batch[order]
+
+    # new_prefix[n] is True if the prefix of row n differs from row n-1
+    new_prefix = np.zeros([num_data], dtype=bool)
+    new_prefix[0] = True
+    prefix_idx = np.zeros([num_data], dtype=int)
+    mat = np.eye(mps_list[0].shape[0])[None]  # [num_prefix, l, l]
+    for idx in range(L):
+        new_prefix[1:] |= sorted_config[1:, idx] != sorted_config[:-1, idx]
+        rows = np.nonzero(new_prefix)[0]
+        # extend the parent prefix of each distinct prefix by one matrix
+        A = np.asarray(mps_list[idx])
+        mat = np.einsum('nil,lnr->nir', mat[prefix_idx[rows]],
+                        np.take(A, sorted_config[rows, idx], axis=1))
+        prefix_idx = np.cumsum(new_prefix) - 1
+
+    amp = np.empty([num_data], dtype=mat.dtype)
+    amp[order] = np.trace(mat, axis1=1, axis2=2)[prefix_idx]
+    return amp
+
+class MPSAmplitudeWalker(object):
+    '''
+    [left, phys, right]
+
+    Keep the amplitudes of a batch of configurations (walkers) together
+    with the left and right partial products of the matrices, so that
+    the amplitude ratios of local updates cost O(chi^2) per walker
+    instead of O(L chi^2). The partial products are only recomputed
+    where they are invalidated by accepted updates, e.g. sweeping the
+    proposals from left to right extends the left products by one site
+    per step.
+
+    left[i] = M_0 ... M_{i-1}, of shape [num_walkers, l, chi_i]
+    right[i] = M_i ... M_{L-1}, of shape [num_walkers, chi_i, l]
+    amp = Tr[left[i] right[i]] for any i.
+    '''
+    def __init__(self, mps_list, config_batch):
+        self.mps_list = [np.asarray(A) for A in mps_list]
+        self.config = np.array(config_batch, dtype=int)
+        self.num_walkers, self.L = self.config.shape
+        eye = np.eye(self.mps_list[0].shape[0])
+        self.left = [None] * (self.L + 1)
+        self.right = [None] * (self.L + 1)
+        self.left[0] = np.broadcast_to(eye, [self.num_walkers] + list(eye.shape))
+        self.right[self.L] = np.broadcast_to(eye, [self.num_walkers] + list(eye.shape))
+        # left[0, ..., left_valid] and right[right_valid, ..., L] are up to date
+        self.left_valid = 0
+        self.right_valid = self.L
+        self.proposal = None
+        self.amp = self.get_amp()
+
+    def get_mat(self, site, values):
+        '''
+        return the matrices of site for the given physical values, [num_walkers, l, r]
+        '''
+        return np.transpose(np.take(self.mps_list[site], values, axis=1), [1, 0, 2])
+
+    def get_left(self, site):
+        while self.left_valid < site:
+            i = self.left_valid
+            self.left[i + 1] = np.matmul(self.left[i], self.get_mat(i, self.config[:, i]))
+            self.left_valid += 1
+
+        return self.left[site]
+
+    def get_right(self, site):
+        while self.right_valid > site:
+            i = self.right_valid - 1
+            self.right[i] = np.matmul(self.get_mat(i, self.config[:, i]), self.right[i + 1])
+            self.right_valid -= 1
+
+        return self.right[site]
+
+    def get_amp(self):
+        '''
+        return the amplitudes of the current configurations
+        '''
+        site = self.left_valid
+        return np.trace(np.matmul(self.get_left(site), self.get_right(site)),
+                        axis1=1, axis2=2)
+
+    def ratio(self, sites, values):
+        '''
+        Goal:
+            propose to set the configurations on sites to values, and
+            return the amplitude ratios psi(new) / psi(old). The proposal
+            is kept for accept. The cost is O((max(sites) - min(sites) + 1) chi^2)
+            per walker, given the partial products are up to date.
+        Input:
+            sites: list of sites
+            values: int array [num_walkers, len(sites)]
+        '''
+        values = np.asarray(values).reshape([self.num_walkers, len(sites)])
+        new_config = self.config.copy()
+        new_config[:, sites] = values
+        start, stop = min(sites), max(sites) + 1
+        mat = self.get_left(start)
+        for i in range(start, stop):
+            mat = np.matmul(mat, self.get_mat(i, new_config[:, i]))
+
+        new_amp = np.trace(np.matmul(mat, self.get_right(stop)), axis1=1, axis2=2)
+        self.proposal = (sites, values, new_amp)
+        return new_amp / self.amp
+
+    def accept(self, mask=None):
+        '''
+        accept the last proposal for the walkers where mask is True,
+        or for all walkers if mask is None.
+        '''
+        sites, values, new_amp = self.proposal
+        if mask is None:
+            mask = np.ones([self.num_walkers], dtype=bool)
+
+        if not np.any(mask):
+            return
+
+        for j, site in enumerate(sites):
+            self.config[mask, site] = values[mask, j]
+
+        self.amp = np.where(mask, new_amp, self.amp)
+        # the products containing the updated sites are outdated
+        self.left_valid = min(self.left_valid, min(sites))
+        self.right_valid = max(self.right_valid, max(sites) + 1)
+        self.proposal = None
 
 def plrq_2_plr(A_list):
     new_A_list = []
@@ -129,8 +367,8 @@ def MPS_dot_left_env(mps_up, mps_down, site_l, cache_env_list=None):
 
     left_env = np.eye(1, dtype=dtype)
     for idx in range(0, site_l):
-        left_env = einsum('ij,ikl->jkl', left_env, mps_up[idx].conjugate())
-        left_env = einsum('ijk,ijl->kl', left_env, mps_down[idx])
+        left_env = misc.contract('ab,apc,bpd->cd', left_env, mps_up[idx].conjugate(),
+                                 mps_down[idx])
         if not (cache_env_list is None):
             cache_env_list[idx] = left_env
 
@@ -167,9 +405,8 @@ def MPS_dot_right_env(mps_up, mps_down, site_l, cache_env_list=None):
 
     right_env = np.eye(1, dtype=dtype)
     for idx in range(L - 1, site_l, -1):
-        right_env = einsum('kli, ij ->klj', mps_up[idx].conjugate(),
-                              right_env)
-        right_env = einsum('klj,mlj->km', right_env, mps_down[idx])
+        right_env = misc.contract('apc,cd,bpd->ab', mps_up[idx].conjugate(),
+                                  right_env, mps_down[idx])
         if not (cache_env_list is None):
             cache_env_list[idx] = right_env
 
@@ -222,7 +459,7 @@ def overlap_lpr(mps_1, mps_2):
     return np.trace(mps_temp)
 
 def MPS_compression_variational(mps_trial, mps_target, max_iter=30, tol=1e-4,
-                                verbose=0):
+                                verbose=0, method='one_site', chi=None, trunc_err_target=None):
     '''
     [left, phys, right]
 
@@ -233,143 +470,170 @@ def MPS_compression_variational(mps_trial, mps_target, max_iter=30, tol=1e-4,
             it should be normalized.
         mps_target: The target to approximate.
             It is not necessary in canonical form and not necessarily
-            normalized.
+            normalized. It can also be a list of MPS, in which case
+            the sum of them is the target, e.g. to fit U|psi> + ...
+            without forming the sum.
+        max_iter: maximal number of sweeps (right and left)
+        tol: converged if the change of trunc_err in a sweep is below tol
+        method: 'one_site' keeps the bond dimensions of mps_trial;
+            'two_site' updates two sites at a time, and the bond dimension
+            is set per bond by chi and trunc_err_target.
+        chi: the maximal bond dimension for 'two_site'
+        trunc_err_target: for 'two_site', keep the smallest number of singular
+            values such that the discarded weight on the bond is below
+            trunc_err_target; the bond grows or shrinks accordingly.
+
+    The environments of each target term are kept over the sweeps, and
+    only the ones of the updated sites are recomputed.
 
     Output:
-        trunc_err
+        trunc_err, i.e. 1 - |<trial|target>|^2 / <target|target>
         modification mps_trial inplace still in right canonical form
     '''
+    assert method in ['one_site', 'two_site']
     L = len(mps_trial)
+    if isinstance(mps_target[0], (list, tuple)):
+        target_list = mps_target
+    else:
+        target_list = [mps_target]
+
     # Check normalization
     if np.abs(overlap_lpr(mps_trial, mps_trial) - 1.) > 1e-8:
         print(('mps_comp_var not normalized', overlap_lpr(mps_trial, mps_trial)))
         raise
-    elif np.abs(overlap_lpr(mps_target, mps_target) - 1.) > 1e-8:
-        print(('mps_comp_var not normalized', overlap_lpr(mps_target, mps_target)))
-        mps_target[-1] /= np.sqrt(overlap_lpr(mps_target, mps_target))
+
+    target_norm_sq = np.abs(sum([overlap_lpr(t1, t2) for t1 in target_list
+                                 for t2 in target_list]))
+
+    # left_env_list[k][i]: sites 0, ..., i-1 of <trial|target_k>, [trial, target]
+    # right_env_list[k][i]: sites i+1, ..., L-1 of <trial|target_k>, [trial, target]
+    left_env_list = [[None] * L for target in target_list]
+    right_env_list = [[None] * L for target in target_list]
+    for k, target in enumerate(target_list):
+        left_env_list[k][0] = np.eye(1)
+        right_env_list[k][L-1] = np.eye(1)
+        for site in range(L-1, 0, -1):
+            right_env_list[k][site-1] = update_right_env(right_env_list[k][site],
+                                                         mps_trial[site], target[site])
+
+    def effective_tensor(site, num_sites):
+        '''
+        the contraction of the target with the environments of
+        sites, ..., site+num_sites-1, [l, p, (q,) r] of the trial.
+        '''
+        tensor = 0.
+        for k, target in enumerate(target_list):
+            theta = np.tensordot(left_env_list[k][site], target[site], axes=([1], [0]))
+            for i in range(site + 1, site + num_sites):
+                theta = np.tensordot(theta, target[i], axes=([-1], [0]))
+
+            theta = np.tensordot(theta, right_env_list[k][site + num_sites - 1],
+                                 axes=([-1], [1]))
+            tensor = tensor + theta
+
+        return tensor
+
+    def update_site(site, direction):
+        if method == 'one_site':
+            theta = effective_tensor(site, 1)
+            l_dim, d, r_dim = theta.shape
+            if direction == 'right':
+                U, s, Vh = np.linalg.svd(theta.reshape((l_dim * d, r_dim)),
+                                         full_matrices=False)
+                s_norm = np.linalg.norm(s)
+                mps_trial[site] = U.reshape((l_dim, d, s.size))
+                mps_trial[site + 1] = np.tensordot(np.diag(s / s_norm).dot(Vh),
+                                                   mps_trial[site + 1], axes=([1], [0]))
+            else:
+                U, s, Vh = np.linalg.svd(theta.reshape((l_dim, d * r_dim)),
+                                         full_matrices=False)
+                s_norm = np.linalg.norm(s)
+                mps_trial[site] = Vh.reshape((s.size, d, r_dim))
+                mps_trial[site - 1] = np.tensordot(mps_trial[site - 1],
+                                                   U.dot(np.diag(s / s_norm)), axes=([2], [0]))
+        else:
+            theta = effective_tensor(site, 2)
+            l_dim, d1, d2, r_dim = theta.shape
+            U, s, Vh = np.linalg.svd(theta.reshape((l_dim * d1, d2 * r_dim)),
+                                     full_matrices=False)
+            num_keep = np.sum(s > 1e-14 * np.linalg.norm(s))
+            if trunc_err_target is not None:
+                # discarded[n] = weight discarded when keeping n singular values
+                discarded = np.cumsum((s ** 2)[::-1])[::-1] / np.sum(s ** 2)
+                num_keep = min(num_keep, max(1, np.sum(discarded > trunc_err_target)))
+
+            if chi is not None:
+                num_keep = min(num_keep, chi)
+
+            s = s[:num_keep]
+            s_norm = np.linalg.norm(s)
+            U = U[:, :num_keep]
+            Vh = Vh[:num_keep, :]
+            if direction == 'right':
+                mps_trial[site] = U.reshape((l_dim, d1, num_keep))
+                mps_trial[site + 1] = np.diag(s / s_norm).dot(Vh).reshape((num_keep, d2, r_dim))
+            else:
+                mps_trial[site + 1] = Vh.reshape((num_keep, d2, r_dim))
+                mps_trial[site] = U.dot(np.diag(s / s_norm)).reshape((l_dim, d1, num_keep))
+
+        return s_norm
+
+    if method == 'one_site':
+        right_sweep = list(range(0, L-1))
+        left_sweep = list(range(L-1, 0, -1))
     else:
-        pass
-        # all normalized
+        right_sweep = list(range(0, L-2))
+        left_sweep = list(range(L-2, -1, -1))
 
     conv = False
     num_iter = 0
     old_trunc_err = 1.
     while (num_iter < max_iter and not conv):
         num_iter += 1
-        # Creat cache of environment
-        cache_env_list = [None] * L
-        MPS_dot_right_env(mps_trial,
-                          mps_target,
-                          0,
-                          cache_env_list=cache_env_list)
-
-        # site = 0
-        right_env = cache_env_list[1]
-        left_env = np.eye(1)
-        update_tensor = einsum('ij,jkl->ikl', left_env, mps_target[0])
-        update_tensor = einsum('ikl,ml->ikm', update_tensor, right_env)
-        mps_trial[0] = update_tensor
-        # svd to shift central site
-        l_dim, d, r_dim = mps_trial[0].shape
-        U, s, Vh = np.linalg.svd(mps_trial[0].reshape((l_dim * d, r_dim)),
-                                 full_matrices=False)
-        rank = s.size
-        s /= np.linalg.norm(s)
-        mps_trial[0] = U.reshape((l_dim, d, rank))
-        mps_trial[1] = einsum('ij,jkl->ikl',
-                              np.diag(s).dot(Vh), mps_trial[1])
-        # update env
-        left_env = einsum('ijk,ijl->kl', mps_trial[0].conjugate(),
-                             mps_target[0])
-        cache_env_list[0] = left_env
-        cache_env_list[1] = None
-
-        for site in range(1, L - 1):
-            right_env = cache_env_list[site + 1]
-            left_env = cache_env_list[site - 1]
-            update_tensor = einsum('ij,jkl->ikl', left_env,
-                                   mps_target[site])
-            update_tensor = einsum('ikl,ml->ikm', update_tensor, right_env)
-            mps_trial[site] = update_tensor
-            # svd to shift central site
-            l_dim, d, r_dim = mps_trial[site].shape
-            U, s, Vh = np.linalg.svd(mps_trial[site].reshape(
-                (l_dim * d, r_dim)),
-                                     full_matrices=False)
-            rank = s.size
-            s /= np.linalg.norm(s)
-            mps_trial[site] = U.reshape((l_dim, d, rank))
-            mps_trial[site + 1] = einsum('ij,jkl->ikl',
-                                         np.diag(s).dot(Vh),
-                                         mps_trial[site + 1])
-            # update env
-            left_env = einsum('ij,ikl->jkl', left_env,
-                              mps_trial[site].conjugate())
-            left_env = einsum('ijk,ijl->kl', left_env, mps_target[site])
-            cache_env_list[site] = left_env
-            cache_env_list[site + 1] = None
-
-        # site = L-1
-        right_env = np.eye(1)
-        left_env = cache_env_list[L - 2]
-        update_tensor = einsum('ij,jkl->ikl', left_env, mps_target[L - 1])
-        update_tensor = einsum('ikl,ml->ikm', update_tensor, right_env)
-        mps_trial[L - 1] = update_tensor
-        # svd to shift central site
-        l_dim, d, r_dim = mps_trial[L - 1].shape
-        U, s, Vh = np.linalg.svd(mps_trial[L - 1].reshape((l_dim, d * r_dim)),
-                                 full_matrices=False)
-        rank = s.size
-        s /= np.linalg.norm(s)
-        mps_trial[L - 1] = Vh.reshape((rank, d, r_dim))
-        mps_trial[L - 2] = einsum('ijk,kl->ijl', mps_trial[L - 2],
-                                  U.dot(np.diag(s)))
-        # No update for left_env
-
-        # site = L-1
-        # But update for right_env
-        right_env = einsum('ijk,ljk->il', mps_trial[L - 1].conjugate(),
-                           mps_target[L - 1])
-        cache_env_list[L - 1] = right_env
-        cache_env_list[L - 2] = None
-
-        for site in range(L - 2, 0, -1):
-            right_env = cache_env_list[site + 1]
-            left_env = cache_env_list[site - 1]
-            update_tensor = einsum('ij,jkl->ikl', left_env,
-                                   mps_target[site])
-            update_tensor = einsum('ikl,ml->ikm', update_tensor, right_env)
-            mps_trial[site] = update_tensor
-            # svd to shift central site
-            l_dim, d, r_dim = mps_trial[site].shape
-            U, s, Vh = np.linalg.svd(mps_trial[site].reshape(
-                (l_dim, d * r_dim)),
-                                     full_matrices=False)
-            rank = s.size
-            s /= np.linalg.norm(s)
-            mps_trial[site] = Vh.reshape((rank, d, r_dim))
-            mps_trial[site - 1] = einsum('ijk,kl->ijl', mps_trial[site - 1],
-                                         U.dot(np.diag(s)))
-            # update env
-            right_env = einsum('kli, ij ->klj', mps_trial[site].conjugate(),
-                               right_env)
-            right_env = einsum('klj,mlj->km', right_env, mps_target[site])
-            cache_env_list[site] = right_env
-            cache_env_list[site - 1] = None
-
-        # site = 0
-        trunc_err = 1. - np.square(np.abs(overlap_lpr(mps_trial, mps_target)))
+        for site in right_sweep:
+            update_site(site, 'right')
+            for k, target in enumerate(target_list):
+                left_env_list[k][site + 1] = update_left_env(left_env_list[k][site],
+                                                             mps_trial[site], target[site])
+
+        for site in left_sweep:
+            s_norm = update_site(site, 'left')
+            right_site = site if method == 'one_site' else site + 1
+            for k, target in enumerate(target_list):
+                right_env_list[k][right_site - 1] = update_right_env(
+                    right_env_list[k][right_site], mps_trial[right_site], target[right_site])
+
+        # mps_trial is normalized, and the overlap with the target is s_norm
+        trunc_err = 1. - s_norm ** 2 / target_norm_sq
         if verbose:
             print(('var_trunc_err = ', trunc_err))
 
-        if np.abs(old_trunc_err - trunc_err) < 1e-6:
+        if np.abs(old_trunc_err - trunc_err) < tol:
             conv = True
 
         old_trunc_err = trunc_err
 
     return trunc_err
 
-def MPS_2_state(mps):
+def update_left_env(left_env, A_trial, A_target):
+    '''
+    [left, phys, right]
+
+    extend the left environment [trial, target] of <trial|target> by one site.
+    '''
+    left_env = np.tensordot(left_env, A_trial.conjugate(), axes=([0], [0]))  # [target, p, trial]
+    return np.tensordot(left_env, A_target, axes=([0, 1], [0, 1]))
+
+def update_right_env(right_env, A_trial, A_target):
+    '''
+    [left, phys, right]
+
+    extend the right environment [trial, target] of <trial|target> by one site.
+    '''
+    right_env = np.tensordot(A_trial.conjugate(), right_env, axes=([2], [0]))  # [trial, p, target]
+    return np.tensordot(right_env, A_target, axes=([1, 2], [1, 2]))
+
+def MPS_2_state(mps, out=None, start=0, stop=None, max_chunk_size=None):
     '''
     [phys, left, right]
 
@@ -377,7 +641,22 @@ def MPS_2_state(mps):
         Return the full tensor representation (vector) of the state
     Input:
         MPS: in [p,l,r] form
+        out: preallocated vector of size stop-start to write the amplitudes
+            into, e.g. a np.memmap from np.lib.format.open_memmap.
+        start, stop: only compute the amplitudes psi[start:stop].
+        max_chunk_size: the amplitudes are computed in chunks of at most
+            this size; default 2**20 if any of the options above is given.
+
+    Without the options, the whole vector is built by repeated einsum.
+    Otherwise the contraction of the last sites is computed once, and each
+    chunk of amplitudes is a vector-matrix product written into out, so
+    that no intermediate larger than about max_chunk_size is allocated,
+    see MPS_2_state_chunked.
     '''
+    if out is not None or start != 0 or stop is not None or max_chunk_size is not None:
+        return MPS_2_state_chunked(mps, out=out, start=start, stop=stop,
+                                   max_chunk_size=max_chunk_size or 2**20)
+
     Vec = mps[0][:,0,:]
     for idx in range(1, len(mps)):
         Vec = einsum('pa,qal->pql', Vec, mps[idx])
@@ -386,22 +665,198 @@ def MPS_2_state(mps):
 
     return Vec.flatten()
 
-def state_2_MPS(psi, L, chimax, eps=1e-15):
+def split_sites_for_chunks(dims, max_chunk_size, bond_dims=None):
+    '''
+    Input:
+        dims: the dimensions of the sites
+        bond_dims: the left bond dimensions of the sites, if given, the
+            matrix [bond_dims[k], product of dims[k:]] of the contracted
+            remaining sites is bounded instead of the product alone.
+    return:
+        the number of leading sites k, such that the product of the
+        dimensions of the remaining sites dims[k:], times bond_dims[i]
+        for each of the sites i >= k, is at most max_chunk_size, though at
+        least the last site remains, and the product of dims[k:].
+    '''
+    if bond_dims is None:
+        bond_dims = [1] * len(dims)
+
+    k = len(dims) - 1
+    block_size = dims[-1]
+    while k > 0 and bond_dims[k-1] * block_size * dims[k-1] <= max_chunk_size:
+        k -= 1
+        block_size *= dims[k]
+
+    return k, block_size
+
+def get_prefix_vectors(mps, k, prefix_start, prefix_stop):
+    '''
+    [phys, left, right]
+
+    return:
+        the vectors [prefix_stop - prefix_start, chi_k] of the first k sites
+        of the mps for the configurations prefix_start, ..., prefix_stop-1
+        of these sites, in the order of MPS_2_state. Only the partial
+        configurations which these extend are contracted, instead of all
+        the d**k configurations.
+    '''
+    dims = [A.shape[0] for A in mps[:k]]
+    vec = np.ones([1, 1], dtype=mps[0].dtype)
+    lo = 0
+    for idx in range(k):
+        rest = int(np.prod(dims[idx+1:]))
+        new_lo = prefix_start // rest
+        new_hi = (prefix_stop - 1) // rest + 1
+        parent_lo = new_lo // dims[idx]
+        parent_hi = (new_hi - 1) // dims[idx] + 1
+        ## one product per physical index, on the [l, r] views of mps[idx]
+        vec = np.stack([np.dot(vec[parent_lo - lo: parent_hi - lo], A)
+                        for A in mps[idx]], axis=1)  # [n, p, r]
+        vec = vec.reshape([-1, mps[idx].shape[2]])
+        vec = vec[new_lo - parent_lo * dims[idx]: new_hi - parent_lo * dims[idx]]
+        lo = new_lo
+
+    return vec
+
+def MPS_2_state_chunked(mps, out=None, start=0, stop=None, max_chunk_size=2**20):
+    '''
+    [phys, left, right]
+
+    Goal:
+        see MPS_2_state(out, start, stop, max_chunk_size).
+        The sites are split into the first k sites and the rest, see
+        split_sites_for_chunks; the rest is contracted into a matrix R of
+        shape [chi_k, block_size], with chi_k * block_size at most
+        max_chunk_size, and the first k sites into the vectors
+        [n, chi_k] of the configurations of the first k sites in
+        [start, stop), see get_prefix_vectors, in batches with n * d * chi
+        and n * block_size at most max_chunk_size. Each chunk
+        psi[prefix * block_size: (prefix+n) * block_size] is then vec R.
+    Return:
+        out, the vector of psi[start:stop]
+    '''
+    L = len(mps)
+    dims = [A.shape[0] for A in mps]
+    total_dim = int(np.prod(dims))
+    if stop is None:
+        stop = total_dim
+
+    dtype = np.result_type(*mps)
+    if out is None:
+        out = np.empty([stop - start], dtype=dtype)
+
+    assert out.shape == (stop - start,)
+
+    k, block_size = split_sites_for_chunks(dims, max_chunk_size,
+                                           bond_dims=[A.shape[1] for A in mps])
+    R = mps[-1][:, :, 0].T  # [l, p]
+    for idx in range(L-2, k-1, -1):
+        R = np.tensordot(mps[idx], R, axes=([2], [0]))  # [p, l, rest]
+        R = np.transpose(R, [1, 0, 2]).reshape([mps[idx].shape[1], -1])
+
+    prefix_stop = (stop - 1) // block_size + 1
+    batch_size = max(1, max_chunk_size // max([block_size] +
+                                              [A.shape[0] * A.shape[2] for A in mps[:k]]))
+    for batch_start in range(start // block_size, prefix_stop, batch_size):
+        batch_stop = min(batch_start + batch_size, prefix_stop)
+        vec = get_prefix_vectors(mps, k, batch_start, batch_stop)
+        ## psi[batch_start * block_size: batch_stop * block_size]
+        chunk = np.dot(vec, R).reshape([-1])
+        lo = max(start, batch_start * block_size)
+        hi = min(stop, batch_stop * block_size)
+        out[lo - start: hi - start] = chunk[lo - batch_start * block_size:
+                                            hi - batch_start * block_size]
+
+    return out
+
+def sample_mps(A_list, num_samples, seed=None):
+    '''
+    [phys, left, right]
+    [right canonical form]
+
+    Goal:
+        Draw num_samples configurations from |psi(config)|^2 by perfect
+        sampling, i.e. sampling site 0, 1, ..., L-1 one after another from
+        the conditional probabilities. All samples are drawn together;
+        the cost is O(num_samples L chi^2) instead of O(2^L) for the
+        full state vector.
+    Input:
+        A_list: mps in right canonical form, which need not be normalized.
+            If A_list is a MPS with a known center other than 0, the center
+            is moved to 0 on a copy of the list.
+        num_samples: number of samples
+        seed: seed of the np.random.RandomState used for sampling
+    Return:
+        config: int array of shape [num_samples, L]
+        amp: the amplitudes psi(config) of the samples
+    '''
+    if get_center(A_list) not in [None, 0]:
+        A_list = move_orthogonality_center(MPS(A_list), None, 0)
+
+    assert A_list[0].shape[1] == 1 and A_list[-1].shape[2] == 1
+    rng = np.random.RandomState(seed)
+    L = len(A_list)
+    config = np.zeros([num_samples, L], dtype=int)
+    vec = np.ones([num_samples, 1])  # [N, l]
+    amp = np.ones([num_samples])
+    samples_idx = np.arange(num_samples)
+    with np.errstate(under='ignore'):
+        for i in range(L):
+            vec = np.einsum('nl,plr->npr', vec, A_list[i])  # [N, p, r]
+            prob = np.sum(np.abs(vec) ** 2, axis=2)  # [N, p]
+            prob = prob / np.sum(prob, axis=1, keepdims=True)
+            r = rng.rand(num_samples, 1)
+            config[:, i] = np.minimum(np.sum(np.cumsum(prob, axis=1) < r, axis=1),
+                                      prob.shape[1] - 1)
+
+            vec = vec[samples_idx, config[:, i], :]  # [N, r]
+            scale = np.linalg.norm(vec, axis=1)
+            vec = vec / scale[:, None]
+            amp = amp * scale
+
+    amp = amp * vec[:, 0]
+    return config, amp
+
+def decompose_wide_matrix(theta, chimax, method='svd'):
+    '''
+    return:
+        U, S, Vh of theta, with method 'svd', 'gram' or 'randomized'
+        as described in state_2_MPS.
+    '''
+    if method == 'svd':
+        return misc.svd(theta, full_matrices=False)
+    elif method == 'gram':
+        return misc.svd(theta, full_matrices=False, method='gram')
+    elif method == 'randomized':
+        return misc.svd(theta, full_matrices=False, rank=chimax, method='randomized')
+    else:
+        raise NotImplementedError
+
+def state_2_MPS(psi, L, chimax, eps=1e-15, method='svd', d=2):
     '''
     [phys, left, right]
 
     Input:
-        psi: the state
+        psi: the state, can be a np.memmap, e.g. from np.load(mmap_mode='r')
         L: the system size
         chimax: the maximum bond dimension
+        method: how the wide matrices (chi_n*d, d**(L-n)) are decomposed;
+            'svd': the full svd
+            'gram': the eigendecomposition of the small Gram matrix, which is
+                accumulated in chunks, so a memmap psi is read chunk by chunk;
+                see misc.gram_svd, singular values below ~1e-7 relative
+                are dropped.
+            'randomized': only the leading chimax singular triplets,
+                see misc.randomized_svd.
+        d: the local dimension
     '''
-    psi_aR = np.reshape(psi, (1, 2**L))
+    psi_aR = np.reshape(psi, (1, d**L))
     Ms = []
     for n in range(1, L+1):
         chi_n, dim_R = psi_aR.shape
-        assert dim_R == 2**(L-(n-1))
-        psi_LR = np.reshape(psi_aR, (chi_n*2, dim_R//2))
-        M_n, lambda_n, psi_tilde = misc.svd(psi_LR, full_matrices=False)
+        assert dim_R == d**(L-(n-1))
+        psi_LR = np.reshape(psi_aR, (chi_n*d, dim_R//d))
+        M_n, lambda_n, psi_tilde = decompose_wide_matrix(psi_LR, chimax, method)
 
         # This truncate the singular values that is raltively smaller than eps.
         chimax_current = np.amin([chimax,
@@ -414,19 +869,30 @@ def state_2_MPS(psi, L, chimax, eps=1e-15):
             psi_tilde = psi_tilde[keep, :]
 
         chi_np1 = len(lambda_n)
-        M_n = np.reshape(M_n, (chi_n, 2, chi_np1))
+        M_n = np.reshape(M_n, (chi_n, d, chi_np1))
         Ms.append(M_n)
         psi_aR = lambda_n[:, np.newaxis] * psi_tilde[:,:]
     assert psi_aR.shape == (1, 1)
     return lpr_2_plr(Ms)
 
-def MPO_2_operator(mpo):
+def MPO_2_operator(mpo, out=None, row_start=0, row_stop=None, max_chunk_size=None):
     '''
     Goal:
         Return the full operator (2**L, 2**L)
     Input:
         MPO: in [p, l, r, q] form
+        out: preallocated array of shape [row_stop-row_start, 2**L] to write
+            the operator into, e.g. a np.memmap.
+        row_start, row_stop: only compute the rows Op[row_start:row_stop, :].
+        max_chunk_size: the operator is computed in blocks of at most this
+            size; default 2**20 if any of the options above is given.
+            See MPS_2_state.
     '''
+    if (out is not None or row_start != 0 or row_stop is not None or
+            max_chunk_size is not None):
+        return MPO_2_operator_chunked(mpo, out=out, row_start=row_start, row_stop=row_stop,
+                                      max_chunk_size=max_chunk_size or 2**20)
+
     Op = mpo[0][:, 0, :, :]
     for idx in range(1, len(mpo)):
         Op = einsum('paq,PalQ->pPlqQ', Op, mpo[idx])
@@ -436,23 +902,92 @@ def MPO_2_operator(mpo):
     assert Op.shape[1] == 1
     return Op[:,0,:]
 
-def operator_2_MPO(op, L, chimax):
+def MPO_2_operator_chunked(mpo, out=None, row_start=0, row_stop=None, max_chunk_size=2**20):
+    '''
+    Goal:
+        see MPO_2_operator(out, row_start, row_stop, max_chunk_size).
+        As in MPS_2_state_chunked, the last sites are contracted into
+        R [chi_k, P, Q], the first k sites into [n, q**k, chi_k] for the n
+        row prefixes p of [row_start, row_stop) in batches, and each
+        block Op[p*P:(p+1)*P, q*Q:(q+1)*Q] is a vector-tensor product.
+    Return:
+        out, the array of Op[row_start:row_stop, :]
+    '''
+    L = len(mpo)
+    p_dims = [A.shape[0] for A in mpo]
+    q_dims = [A.shape[3] for A in mpo]
+    if row_stop is None:
+        row_stop = int(np.prod(p_dims))
+
+    dtype = np.result_type(*mpo)
+    if out is None:
+        out = np.empty([row_stop - row_start, int(np.prod(q_dims))], dtype=dtype)
+
+    assert out.shape == (row_stop - row_start, int(np.prod(q_dims)))
+
+    k, block_size = split_sites_for_chunks([p * q for p, q in zip(p_dims, q_dims)],
+                                           max_chunk_size,
+                                           bond_dims=[A.shape[1] for A in mpo])
+    P = int(np.prod(p_dims[k:]))
+    Q = int(np.prod(q_dims[k:]))
+    R = np.transpose(mpo[-1][:, :, 0, :], [1, 0, 2])  # [l, p, q]
+    for idx in range(L-2, k-1, -1):
+        R = np.tensordot(mpo[idx], R, axes=([2], [0]))  # [p, l, q, P, Q]
+        p, l, r, q = mpo[idx].shape
+        R = np.transpose(R, [1, 0, 3, 2, 4]).reshape([l, p * R.shape[3], q * R.shape[4]])
+
+    ## the row prefixes in [row_start, row_stop) only, in batches, and only
+    ## the partial row prefixes which these extend, see get_prefix_vectors
+    p_prefix_stop = (row_stop - 1) // P + 1
+    batch_size = max(1, max_chunk_size // (int(np.prod(q_dims[:k])) * mpo[k].shape[1]))
+    for batch_start in range(row_start // P, p_prefix_stop, batch_size):
+        batch_stop = min(batch_start + batch_size, p_prefix_stop)
+        left = np.ones([1, 1, 1], dtype=dtype)  # [p, q, a]
+        left_lo = 0
+        for idx in range(k):
+            p, l, r, q = mpo[idx].shape
+            rest = int(np.prod(p_dims[idx+1:k]))
+            new_lo = batch_start // rest
+            new_hi = (batch_stop - 1) // rest + 1
+            parent_lo = new_lo // p
+            parent_hi = (new_hi - 1) // p + 1
+            left = np.tensordot(left[parent_lo - left_lo: parent_hi - left_lo], mpo[idx],
+                                axes=([2], [1]))  # [p, q, P, r, Q]
+            left = np.transpose(left, [0, 2, 1, 4, 3]).reshape([left.shape[0] * p,
+                                                                 left.shape[1] * q, r])
+            left = left[new_lo - parent_lo * p: new_hi - parent_lo * p]
+            left_lo = new_lo
+
+        for p_prefix in range(batch_start, batch_stop):
+            lo = max(row_start, p_prefix * P)
+            hi = min(row_stop, (p_prefix + 1) * P)
+            R_rows = R[:, lo - p_prefix * P: hi - p_prefix * P, :]
+            for q_prefix in range(left.shape[1]):
+                out[lo - row_start: hi - row_start, q_prefix * Q: (q_prefix + 1) * Q] = \
+                        np.tensordot(left[p_prefix - batch_start, q_prefix], R_rows,
+                                     axes=([0], [0]))
+
+    return out
+
+def operator_2_MPO(op, L, chimax, method='svd', d=2):
     '''
     Input:
-        op: the operator in matrix of size (2**L, 2**L)
+        op: the operator in matrix of size (d**L, d**L)
         L: system size
         chimax: the maximum bond dimension
+        method: 'svd', 'gram' or 'randomized', see state_2_MPS
+        d: the local dimension
     Return:
         MPO in [p, l, r, q] form
     '''
-    op_aR = np.reshape(op, (1, 2**L, 2**L))
+    op_aR = np.reshape(op, (1, d**L, d**L))
     Ms = []
     for n in range(1, L+1):
         chi_n, dim_R1, dim_R2 = op_aR.shape
-        assert dim_R1 == 2**(L-(n-1))
-        op_LR = np.reshape(op_aR, [chi_n*2, dim_R1//2, 2, dim_R2//2])
-        op_LR = np.transpose(op_LR, [0, 2, 1, 3]).reshape([chi_n*4, (dim_R1//2) * (dim_R2//2)])
-        M_n, lambda_n, op_tilde = misc.svd(op_LR, full_matrices=False)
+        assert dim_R1 == d**(L-(n-1))
+        op_LR = np.reshape(op_aR, [chi_n*d, dim_R1//d, d, dim_R2//d])
+        op_LR = np.transpose(op_LR, [0, 2, 1, 3]).reshape([chi_n*d*d, (dim_R1//d) * (dim_R2//d)])
+        M_n, lambda_n, op_tilde = decompose_wide_matrix(op_LR, chimax, method)
         if len(lambda_n) > chimax:
             keep = np.argsort(lambda_n)[::-1][:chimax]
             M_n = M_n[:, keep]
@@ -460,15 +995,201 @@ def operator_2_MPO(op, L, chimax):
             op_tilde = op_tilde[keep, :]
 
         chi_np1 = len(lambda_n)
-        M_n = np.reshape(M_n, (chi_n, 2, 2, chi_np1))
+        M_n = np.reshape(M_n, (chi_n, d, d, chi_np1))
         Ms.append(M_n.transpose([1, 0, 3, 2]))
         op_aR = lambda_n[:, np.newaxis] * op_tilde[:,:]
-        op_aR = op_aR.reshape([chi_np1, (dim_R1//2), (dim_R2//2)])
+        op_aR = op_aR.reshape([chi_np1, (dim_R1//d), (dim_R2//d)])
 
     assert op_aR.shape == (1, 1, 1)
     Ms[-1] = Ms[-1] * op_aR[0, 0, 0]
     return Ms
 
+def apply_mpo_to_mps(mpo, A_list, chi=None, method='density', max_iter=30, tol=1e-10,
+                     slack=2):
+    '''
+    [phys, left, right] for the MPS
+    [p, l, r, q] for the MPO, as from operator_2_MPO
+
+    Goal:
+        Compute an MPS with bond dimension at most chi approximating
+        MPO |A_list>, without the norm or the phase being changed.
+    Input:
+        mpo: list of MPO tensors; q is contracted with the MPS phys index.
+        A_list: the MPS, not modified.
+        chi: maximal bond dimension of the result; None means no truncation
+            other than dropping the zero singular values.
+        method:
+            'naive': contract the MPO into the MPS, bond chi_mpo * chi_mps,
+                followed by a QR sweep and a SVD sweep truncating to chi.
+            'zipup': a single sweep from the left on the right canonical MPS,
+                truncating with SVDs in a non-orthogonal basis [Stoudenmire
+                and White, New J. Phys. 12, 055026 (2010)]. Since the basis
+                is not orthogonal, the zip-up only truncates to slack * chi,
+                and a SVD sweep on its left canonical result truncates to
+                chi. Cheapest, but the loss of fidelity can still be much
+                larger than for the other methods unless slack is about the
+                bond dimension of the MPO, e.g. for the MPO of exp(-iHt)
+                from operator_2_MPO.
+            'density': the density matrix algorithm of the same paper; the
+                truncation is optimal with respect to the exact state up to
+                the sites on the right. The default.
+            'variational': initialized from 'zipup', then optimized with
+                MPS_compression_variational with max_iter, tol.
+        slack: see 'zipup'
+    Output:
+        new_A_list: MPS, in left canonical form for 'density', and in
+            right canonical form for 'naive', 'zipup' and 'variational'
+        trunc_err: the sum of the discarded weights of the bonds relative to
+            the norm square, or 1 - fidelity for 'variational'. For 'zipup'
+            the weights discarded in the zip-up are relative to a
+            non-orthogonal basis, so they are only an estimate.
+    '''
+    L = len(A_list)
+    assert len(mpo) == L
+    if method == 'naive':
+        new_A_list = MPS(contract_mpo_mps(mpo, A_list))
+        left_canonicalize(new_A_list, no_trunc=True, normalized=False)
+        return right_canonicalize(new_A_list, chi=chi, normalized=False)
+    elif method == 'zipup':
+        return apply_mpo_to_mps_zipup(mpo, A_list, chi, slack=slack)
+    elif method == 'density':
+        return apply_mpo_to_mps_density(mpo, A_list, chi)
+    elif method == 'variational':
+        trial, _ = apply_mpo_to_mps_zipup(mpo, A_list, chi, slack=slack)
+        trial[0] = trial[0] / np.linalg.norm(trial[0])
+        trial = plr_2_lpr(trial)
+        target = plr_2_lpr(contract_mpo_mps(mpo, A_list))
+        trunc_err = MPS_compression_variational(trial, target, max_iter=max_iter,
+                                                tol=tol, method='one_site')
+        # restore the norm and the phase on the center
+        trial[0] = trial[0] * overlap_lpr(trial, target)
+        return MPS(lpr_2_plr(trial), center=0), trunc_err
+    else:
+        raise NotImplementedError
+
+def contract_mpo_mps(mpo, A_list):
+    '''
+    [phys, left, right] for the MPS
+    [p, l, r, q] for the MPO
+
+    return:
+        the exact MPO |A_list> as a list of tensors with bond dimension
+        chi_mpo * chi_mps, the MPO index being the outer one.
+    '''
+    new_A_list = []
+    for W, A in zip(mpo, A_list):
+        p, l, r, _ = W.shape
+        _, a, b = A.shape
+        B = np.tensordot(W, A, axes=([3], [0]))  # [p, l, r, a, b]
+        B = np.transpose(B, [0, 1, 3, 2, 4])
+        new_A_list.append(np.reshape(B, [p, l * a, r * b]))
+
+    return new_A_list
+
+def apply_mpo_to_mps_zipup(mpo, A_list, chi=None, slack=2):
+    '''
+    [phys, left, right] for the MPS
+    [p, l, r, q] for the MPO
+
+    see apply_mpo_to_mps. The sweep goes from the left, so the MPS is brought
+    into right canonical form first, on a copy, which only costs QRs.
+    The zip-up truncates to slack * chi, and the final right_canonicalize
+    to chi.
+    '''
+    zipup_chi = None if chi is None else slack * chi
+    L = len(A_list)
+    A_list = MPS(A_list)
+    right_canonicalize(A_list, no_trunc=True, normalized=False)
+
+    new_A_list = [None] * L
+    tot_trunc_err = 0.
+    # C: the part to the right of the new site i-1, [new, l_mpo, l_mps]
+    C = np.ones([1, 1, 1])
+    for i in range(L):
+        T = np.tensordot(C, mpo[i], axes=([1], [1]))  # [new, l_mps, p, r, q]
+        T = np.tensordot(T, A_list[i], axes=([1, 4], [1, 0]))  # [new, p, r, r_mps]
+        new, p, r, b = T.shape
+        if i == L - 1:
+            new_A_list[i] = np.transpose(np.reshape(T, [new, p, 1]), [1, 0, 2])
+            break
+
+        theta = np.reshape(T, [new * p, r * b])
+        X, Y, Z = misc.svd(theta, full_matrices=0, rank=zipup_chi)
+        if np.size(Y) < min(theta.shape):
+            Y_norm = np.linalg.norm(theta)
+        else:
+            Y_norm = np.linalg.norm(Y)
+
+        if Y_norm == 0.:
+            new_chi = 1
+        else:
+            new_chi = max(np.sum((Y / Y_norm) > 1e-14), 1)
+
+        if zipup_chi is not None:
+            new_chi = min(new_chi, zipup_chi)
+
+        if Y_norm > 0.:
+            tot_trunc_err += max(1. - np.sum(Y[:new_chi]**2) / Y_norm**2, 0.)
+
+        new_A_list[i] = np.transpose(np.reshape(X[:, :new_chi], [new, p, new_chi]), [1, 0, 2])
+        C = np.reshape(Y[:new_chi, None] * Z[:new_chi, :], [new_chi, r, b])
+
+    new_A_list = MPS(new_A_list, center=L-1)
+    _, trunc_err = right_canonicalize(new_A_list, chi=chi, normalized=False)
+    return new_A_list, tot_trunc_err + trunc_err
+
+def apply_mpo_to_mps_density(mpo, A_list, chi=None):
+    '''
+    [phys, left, right] for the MPS
+    [p, l, r, q] for the MPO
+
+    see apply_mpo_to_mps. The reduced density matrices of the exact state are
+    taken from the environments of <phi|phi>, phi = MPO |A_list>, with the
+    sites on the left already projected on the kept states.
+    '''
+    L = len(A_list)
+    B_list = contract_mpo_mps(mpo, A_list)
+
+    # R_list[i]: sites i, ..., L-1 of <phi|phi>, [ket, bra]
+    R_list = [None] * (L + 1)
+    R_list[L] = np.ones([1, 1])
+    for i in range(L - 1, 0, -1):
+        R = np.tensordot(B_list[i], R_list[i + 1], axes=([2], [0]))  # [p, l, bra]
+        R_list[i] = np.tensordot(R, B_list[i].conjugate(), axes=([0, 2], [0, 2]))
+
+    new_A_list = [None] * L
+    tot_trunc_err = 0.
+    # C: the new site i-1 contracted with the exact state, [new, l]
+    C = np.ones([1, 1])
+    for i in range(L):
+        T = np.tensordot(C, B_list[i], axes=([1], [1]))  # [new, p, r]
+        new, p, r = T.shape
+        if i == L - 1:
+            new_A_list[i] = np.transpose(np.reshape(T, [new, p, 1]), [1, 0, 2])
+            break
+
+        T = np.reshape(T, [new * p, r])
+        rho = np.dot(np.dot(T, R_list[i + 1]), T.T.conjugate())
+        w, U = np.linalg.eigh((rho + rho.T.conjugate()) / 2.)
+        w, U = w[::-1], U[:, ::-1]
+        w_norm = np.sum(np.maximum(w, 0.))
+        if w_norm == 0.:
+            new_chi = 1
+        else:
+            new_chi = max(np.sum((w / w_norm) > 1e-28), 1)
+
+        if chi is not None:
+            new_chi = min(new_chi, chi)
+
+        if w_norm > 0.:
+            tot_trunc_err += max(1. - np.sum(w[:new_chi]) / w_norm, 0.)
+
+        U = U[:, :new_chi]
+        new_A_list[i] = np.transpose(np.reshape(U, [new, p, new_chi]), [1, 0, 2])
+        C = np.dot(U.T.conjugate(), T)
+
+    return MPS(new_A_list, center=L-1), tot_trunc_err
+
 def overlap(psi1, psi2):
     '''
     [phys, left, right]
@@ -476,7 +1197,16 @@ def overlap(psi1, psi2):
     psi1 is not taken complex conjugate beforehand.
     psi1 : with dimension [p, l, r]
     psi2 : with dimension [p, l, r]
+
+    If psi1 is psi2 and is a MPS with known center, only the
+    center tensor is used.
     '''
+    if isinstance(psi1[0], symmetric_tensor.BlockTensor):
+        return symmetric_tensor.overlap(psi1, psi2)
+
+    if psi1 is psi2 and get_center(psi1) is not None:
+        return np.linalg.norm(psi1[psi1.center]) ** 2
+
     N = np.ones([1,1]) # a ap 
     L = len(psi1)
     for i in np.arange(L):
@@ -511,70 +1241,457 @@ def expectation_values_1_site(A_list, Op_list, check_norm=True):
     '''
     [phys, left, right]
 
+    return:
+        np.array of <Op_list[i]> on each site i, see expectation_values_multi.
+
+    Op[p, q] is the matrix element <p|Op|q>, i.e. q is contracted with the
+    ket. Up to the multi-observable rewrite, q was contracted with the bra,
+    which gives <Op^T>; so the results for operators with Op^T != Op, e.g.
+    the real part of <sigma_y>, change sign compared to older runs.
+    '''
+    L = len(A_list)
+    return expectation_values_multi(A_list, [(i, Op_list[i]) for i in range(L)],
+                                    check_norm=check_norm)
+
+def expectation_values(A_list, H_list, check_norm=True):
+    '''
+    [phys, left, right]
+
+    return:
+        list of <H_list[i]> on the bonds i = L-2, ..., 1, 0, i.e. in reversed
+        order, see expectation_values_multi.
     '''
-    if check_norm:
-        assert np.isclose(overlap(A_list, A_list), 1.)
-    else:
-        pass
+    if isinstance(A_list[0], symmetric_tensor.BlockTensor):
+        return symmetric_tensor.expectation_values(A_list, H_list)
 
     L = len(A_list)
-    Lp = np.ones([1, 1])
-    Lp_list = [Lp]
+    E_list = expectation_values_multi(A_list, [(i, H_list[i]) for i in range(L-1)],
+                                      check_norm=check_norm)
+    return list(E_list[::-1])
 
-    for i in range(L):
-        Lp = np.tensordot(Lp, A_list[i], axes=(0, 1)) # ap i b
-        Lp = np.tensordot(Lp, np.conj(A_list[i]), axes=([0, 1], [1,0])) # b bp
-        Lp_list.append(Lp)
+def expectation_values_multi(A_list, term_list, check_norm=True):
+    '''
+    [phys, left, right]
+
+    Goal:
+        Evaluate <psi|O|psi> for all the terms O in term_list with a single
+        set of environments, see MPSEnvironments, instead of two sweeps
+        per observable.
+        If A_list is a MPS with known center, the environments on the
+        canonical side are identities and are not computed, e.g. the
+        terms around the center cost nothing beyond the local contraction.
+    Input:
+        term_list: list of terms, each being
+            (i, Op): Op [p, q] on the site i, with the matrix element
+                <p|Op|q>, i.e. the ket index q, see expectation_values_1_site;
+                or Op [i', j', i, j] on the sites (i, i+1), as in H_list;
+            (site_list, Op_list): the product of the one-site operators
+                Op_list on the increasing sites site_list, e.g. the
+                correlations or the string operators.
+        check_norm: assert that the state is normalized.
+    Return:
+        np.array of the expectation values, in the order of term_list.
+    '''
+    envs = MPSEnvironments(A_list)
+    if check_norm:
+        assert np.isclose(np.abs(envs.get_norm_sq()), 1.)
+
+    value_list = np.zeros([len(term_list)], dtype=np.complex128)
+    for term_idx, (sites, Op) in enumerate(term_list):
+        if np.ndim(sites) == 0 and np.ndim(Op) == 4:
+            value_list[term_idx] = envs.get_value(sites, sites + 1, two_site_Op=Op)
+        elif np.ndim(sites) == 0:
+            value_list[term_idx] = envs.get_value(sites, sites, {sites: Op})
+        else:
+            value_list[term_idx] = envs.get_value(sites[0], sites[-1], dict(zip(sites, Op)))
 
-    Rp = np.ones([1, 1])
+    return value_list
 
-    Op_per_site = np.zeros([L], dtype=np.complex)
-    for i in range(L - 2, -2, -1):
-        Rp = np.tensordot(np.conj(A_list[i+1]), Rp, axes=(2, 1)) #[p,l,r] [d,u] -> [p,l,d]
-        Op = np.tensordot(Op_list[i+1], Rp, axes=(1, 0)) #[p,q], [q,l,d] -> [p,l,d]
-        Op = np.tensordot(Op, A_list[i+1], axes=([0,2], [0,2])) #[p,ul,d], [p,dl,rr] -> [ul, dl]
-        Op = np.tensordot(Lp_list[i+1], Op, axes=([0,1], [1,0]))
-        Op_per_site[i+1] = Op[None][0]
+class MPSEnvironments(object):
+    '''
+    [phys, left, right]
 
-        Rp = np.tensordot(A_list[i+1],Rp,axes=([0,2], [0,2]))
+    The environments of <psi|psi>, computed on demand and cached,
+        get_left(i): the sites 0, ..., i-1, [ket, bra]
+        get_right(j): the sites j+1, ..., L-1, [ket, bra]
+    If A_list is a MPS with known center, get_left(i) for i <= center and
+    get_right(j) for j >= center are identities.
+    The tensors of A_list should not be changed while the object is used.
+    '''
+    def __init__(self, A_list):
+        self.A_list = A_list
+        self.center = get_center(A_list)
+        L = len(A_list)
+        self.left = [None] * (L + 1)
+        self.right = [None] * (L + 1)  # right[j + 1] = get_right(j)
+
+    def get_left(self, i):
+        k = i
+        while self.left[k] is None:
+            if k == 0 or (self.center is not None and k <= self.center):
+                self.left[k] = np.eye(self.A_list[k].shape[1])
+            else:
+                k -= 1
+
+        for k in range(k, i):
+            self.left[k + 1] = misc.contract('ab,pac,pbd->cd', self.left[k], self.A_list[k],
+                                             np.conj(self.A_list[k]))
+
+        return self.left[i]
+
+    def get_right(self, j):
+        L = len(self.A_list)
+        k = j
+        while self.right[k + 1] is None:
+            if k == L - 1 or (self.center is not None and k >= self.center):
+                self.right[k + 1] = np.eye(self.A_list[k].shape[2])
+            else:
+                k += 1
+
+        for k in range(k, j, -1):
+            self.right[k] = misc.contract('pac,cd,pbd->ab', self.A_list[k], self.right[k + 1],
+                                          np.conj(self.A_list[k]))
+
+        return self.right[j + 1]
+
+    def get_norm_sq(self):
+        if self.center is not None:
+            A = self.A_list[self.center]
+            return np.vdot(A, A)
+        else:
+            return np.sum(self.get_left(len(self.A_list)))
+
+    def get_value(self, i, j, Op_dict=None, two_site_Op=None):
+        '''
+        return:
+            <psi|O|psi> for O the product of the one-site operators Op_dict
+            {site: Op} on the sites i, ..., j, or the two-site operator
+            two_site_Op on (i, j=i+1).
+        The contractions follow the orders from misc.get_contraction_plan,
+        so the two-site tensors are not formed.
+        '''
+        A_list = self.A_list
+        Lp = self.get_left(i)  # [ket, bra]
+        if two_site_Op is not None:
+            assert j == i + 1
+            Lp = misc.contract('ab,pac,qce,PQpq,Pbd,Qdf->ef', Lp, A_list[i], A_list[j],
+                               two_site_Op, np.conj(A_list[i]), np.conj(A_list[j]))
+        else:
+            if Op_dict is None:
+                Op_dict = {}
 
-    return Op_per_site
+            for k in range(i, j + 1):
+                if k in Op_dict:
+                    Lp = misc.contract('ab,pac,Pp,Pbd->cd', Lp, A_list[k], Op_dict[k],
+                                       np.conj(A_list[k]))
+                else:
+                    Lp = misc.contract('ab,pac,pbd->cd', Lp, A_list[k], np.conj(A_list[k]))
 
-def expectation_values(A_list, H_list, check_norm=True):
+        return np.sum(Lp * self.get_right(j))
+
+class MPS(list):
     '''
     [phys, left, right]
 
+    A list of tensors which also records its gauge, i.e. the orthogonality
+    center: center=0 is the right canonical form, center=L-1 the left
+    canonical form, 0 < center < L-1 the mixed canonical form, and None
+    means the gauge is unknown.
+
+    Replacing, inserting, removing or reordering tensors, with any of the
+    list methods, makes the gauge unknown.
+    The functions which keep track of the gauge, i.e. apply_gate,
+    left_canonicalize, right_canonicalize and move_orthogonality_center,
+    set the center afterwards, and skip the work that is not needed.
+    The tensors themselves should not be modified inplace.
+
+    MPS(A_list) takes the center of A_list if A_list is a MPS.
+
+    schmidt_values caches the result of get_schmidt_spectrum, and is
+    reset to None as well when the tensors are changed.
     '''
-    if check_norm:
-        assert np.isclose(np.abs(overlap(A_list, A_list)), 1.)
-    else:
-        pass
+    def __init__(self, A_list=(), center=None):
+        list.__init__(self, A_list)
+        if center is None:
+            center = get_center(A_list)
+
+        self.center = center
+        self.schmidt_values = getattr(A_list, 'schmidt_values', None)
+
+    def __setitem__(self, key, value):
+        list.__setitem__(self, key, value)
+        self.center = None
+        self.schmidt_values = None
+
+    def __delitem__(self, key):
+        list.__delitem__(self, key)
+        self.center = None
+        self.schmidt_values = None
+
+    def append(self, value):
+        list.append(self, value)
+        self.center = None
+        self.schmidt_values = None
+
+    def extend(self, values):
+        list.extend(self, values)
+        self.center = None
+        self.schmidt_values = None
+
+    def insert(self, key, value):
+        list.insert(self, key, value)
+        self.center = None
+        self.schmidt_values = None
+
+    def pop(self, *args):
+        value = list.pop(self, *args)
+        self.center = None
+        self.schmidt_values = None
+        return value
+
+    def remove(self, value):
+        list.remove(self, value)
+        self.center = None
+        self.schmidt_values = None
+
+    def reverse(self):
+        list.reverse(self)
+        self.center = None
+        self.schmidt_values = None
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self.center = None
+        self.schmidt_values = None
+
+    def clear(self):
+        list.clear(self)
+        self.center = None
+        self.schmidt_values = None
+
+    def __iadd__(self, values):
+        list.__iadd__(self, values)
+        self.center = None
+        self.schmidt_values = None
+        return self
+
+    def __imul__(self, n):
+        list.__imul__(self, n)
+        self.center = None
+        self.schmidt_values = None
+        return self
+
+    @property
+    def form(self):
+        '''
+        'left', 'right', 'mixed' or None if the gauge is unknown.
+        '''
+        if self.center is None:
+            return None
+        elif self.center == 0:
+            return 'right'
+        elif self.center == len(self) - 1:
+            return 'left'
+        else:
+            return 'mixed'
+
+    def get_bond_dims(self):
+        return get_bond_dims(self)
+
+    def get_norm(self):
+        '''
+        the norm of the state; only the center tensor is needed if the
+        gauge is known.
+        '''
+        if self.center is not None:
+            return np.linalg.norm(self[self.center])
+        else:
+            return np.sqrt(np.abs(overlap(self, self)))
 
-    L = len(A_list)
-    Lp = np.ones([1, 1])
-    Lp_list = [Lp]
+def get_center(A_list):
+    '''
+    return:
+        the orthogonality center recorded in A_list if it is a MPS,
+        otherwise None.
+    '''
+    return getattr(A_list, 'center', None)
 
-    for i in range(L):
-        Lp = np.tensordot(Lp, A_list[i], axes=(0, 1)) # ap i b
-        Lp = np.tensordot(Lp, np.conj(A_list[i]), axes=([0, 1], [1,0])) # b bp
-        Lp_list.append(Lp)
+def set_center(A_list, center):
+    '''
+    record the orthogonality center if A_list is a MPS.
+    '''
+    if isinstance(A_list, MPS):
+        A_list.center = center
 
-    Rp = np.ones([1, 1])
+def get_bond_dims(A_list):
+    '''
+    [phys, left, right]
 
-    E_list = []
-    for i in range(L - 2, -1, -1):
-        Rp = np.tensordot(np.conj(A_list[i+1]), Rp, axes=(2, 1)) #[p,l,r] [d,u] -> [p,l,d]
-        E = np.tensordot(np.conj(A_list[i]), Rp, axes=(2, 1)) #[p,l,r] [q,L,R] -> [p,l,q,R]
-        E = np.tensordot(H_list[i],E, axes=([0,1], [0,2])) # [p,q, r,s] , [p,l,q,R] -> [r,s, l,R]
-        E = np.tensordot(A_list[i+1],E, axes=([0,2], [1,3])) # [s, L, R], [r,s, l,R] -> [L, r, l]
-        E = np.tensordot(A_list[i],E, axes=([0,2], [1,0])) # [r, ll, L] [L, r, l] -> [ll, l]
-        E = np.tensordot(Lp_list[i],E, axes=([0,1],[0,1]))
-        Rp = np.tensordot(A_list[i+1],Rp,axes=([0,2], [0,2]))
-        E_list.append(E[None][0])
+    return:
+        list of the bond dimensions [(0,1), (1,2), ..., (L-2, L-1)]
+    '''
+    return [A.shape[2] for A in A_list[:-1]]
+
+class VidalMPS(object):
+    '''
+    [phys, left, right]
 
-    return E_list
+    The Vidal form of a mps, stored as in [Hastings, J. Math. Phys. 50,
+    095207 (2009)], i.e. the right canonical tensors B_list[i] = Gamma_i
+    Lambda_{i+1} and the Schmidt values Lambda_list[i] on the bond between
+    the sites i-1 and i, Lambda_list[0] = Lambda_list[L] = [1.].
+    The state is norm * Lambda_0 B_0 B_1 ... B_{L-1}, and Lambda_i B_i is
+    the orthogonality center if it is at the site i, so the Schmidt
+    values, the entanglement and the truncation errors of all the bonds,
+    and the center tensor of any site, are read without any SVD.
+
+    See mps_2_vidal and vidal_2_mps for the conversions.
+
+    truncated is set once a gate is truncated, see apply_gate. The B_list
+    is then no longer exactly right canonical and the Lambda_list only
+    approximates the Schmidt values, so both are recomputed from the
+    state when they are read out.
+    '''
+    def __init__(self, B_list, Lambda_list, norm=1., truncated=False):
+        self.B_list = B_list
+        self.Lambda_list = Lambda_list
+        self.norm = norm
+        self.truncated = truncated
+
+    def __len__(self):
+        return len(self.B_list)
+
+    @property
+    def schmidt_values(self):
+        '''
+        the Schmidt values of the cuts as in get_schmidt_spectrum, so that
+        get_entanglement, get_entanglement_spectrum etc. take a VidalMPS.
+        If truncated, they are recomputed by get_schmidt_spectrum.
+        '''
+        if self.truncated:
+            return get_schmidt_spectrum(vidal_2_mps(self))
+
+        return [np.abs(self.norm) * Lambda for Lambda in self.Lambda_list[1:-1]]
+
+    def get_center_tensor(self, i):
+        '''
+        return:
+            the tensor at site i of the mps with orthogonality center i.
+        '''
+        return self.norm * self.Lambda_list[i][None, :, None] * self.B_list[i]
+
+    def apply_gate(self, gate, idx, no_trunc=False, chi=None, trunc_err_target=None,
+                   normalized=False):
+        '''
+        [modification inplace]
+        Goal:
+            Apply gate [i', j', i, j] on the sites (idx, idx+1), as
+            circuit_func.apply_gate. Only B_idx, B_idx+1 and the Schmidt
+            values between them are updated, and Lambda_idx is not inverted.
+        Input:
+            no_trunc, chi, trunc_err_target: the truncation, see
+                circuit_func.apply_gate; with no_trunc, even the numerical
+                zeros are kept, and chi, trunc_err_target play no role.
+            normalized: if True, the norm is kept instead of updated
+            Any truncation beyond the numerical zeros sets truncated.
+        Return:
+            trunc_error
+        '''
+        B1, B2 = self.B_list[idx], self.B_list[idx + 1]
+        theta = np.tensordot(B1, B2, axes=(2, 1))  # [d1, chi1, d2, chi3]
+        theta = np.tensordot(gate, theta, axes=([2, 3], [0, 2]))  # [i',j',i,j] [i, D1, j, D2] -> [i',j',D1, D2]
+        theta = np.transpose(theta, (0, 2, 1, 3))  # [i',D1,j',D2]
+        d1, chi1, d2, chi3 = theta.shape
+
+        center = self.Lambda_list[idx][None, :, None, None] * theta
+        X, Y, Z = misc.svd(np.reshape(center, (d1 * chi1, d2 * chi3)), full_matrices=0)
+        Y_norm = np.linalg.norm(Y)
+        if no_trunc:
+            chi2 = np.size(Y)
+        else:
+            chi2 = num_nonzero = np.sum((Y/Y_norm)>1e-14)
+            if chi is not None:
+                chi2 = np.amin([chi2, chi])
+
+            if trunc_err_target is not None:
+                # discarded[n] = weight discarded when keeping n singular values
+                Y_sq = Y ** 2
+                discarded = (Y_norm ** 2 - np.cumsum(Y_sq) + Y_sq) / Y_norm ** 2
+                chi2 = min(chi2, max(1, np.sum(discarded > trunc_err_target)))
+
+            if chi2 < num_nonzero:
+                self.truncated = True
+
+        trunc_error = np.sum(Y[chi2:] ** 2) / Y_norm ** 2
+        Y = Y[:chi2]
+        Z = Z[:chi2, :]
+        kept_norm = np.linalg.norm(Y)
+
+        ## Hastings: B_idx = theta Z^dagger, instead of Lambda_idx^-1 X Y
+        B2 = np.reshape(Z, [chi2, d2, chi3])
+        B1 = np.tensordot(theta, np.conj(B2), axes=([2, 3], [1, 2])) / kept_norm  # [d1, chi1, chi2]
+        self.B_list[idx] = B1
+        self.B_list[idx + 1] = np.transpose(B2, [1, 0, 2])
+        self.Lambda_list[idx + 1] = Y / kept_norm
+        if not normalized:
+            self.norm = self.norm * kept_norm
+
+        return trunc_error
+
+def mps_2_vidal(A_list):
+    '''
+    [phys, left, right]
 
-def right_canonicalize(A_list, no_trunc=False, chi=None, normalized=True):
+    Goal:
+        Convert the mps into the VidalMPS, with a QR sweep to the right
+        canonical form and a SVD sweep back. Only the numerical zeros of
+        the Schmidt values are dropped, i.e. the state is unchanged.
+        A_list is not modified.
+    '''
+    L = len(A_list)
+    B_list = MPS(A_list)
+    right_canonicalize(B_list, no_trunc=True, normalized=False)
+    norm = np.linalg.norm(B_list[0])
+    B_list = list(B_list)
+    B_list[0] = B_list[0] / norm
+    Lambda_list = [np.ones([1])] + [None] * (L - 1) + [np.ones([1])]
+    for i in range(L - 1):
+        d1, chi1, chi2 = B_list[i].shape
+        center = Lambda_list[i][None, :, None] * B_list[i]
+        X, Y, Z = misc.svd(np.reshape(center, [d1 * chi1, chi2]), full_matrices=0)
+        chi2 = np.sum((Y/np.linalg.norm(Y))>1e-14)
+        Z = Z[:chi2, :]
+        B_list[i] = np.tensordot(B_list[i], np.conj(Z), axes=([2], [1]))  # [p, l, (r)], [new, (r)]
+        B_list[i+1] = np.transpose(np.tensordot(Z, B_list[i+1], axes=([1], [1])), [1, 0, 2])
+        Lambda_list[i+1] = Y[:chi2] / np.linalg.norm(Y[:chi2])
+
+    return VidalMPS(B_list, Lambda_list, norm=norm)
+
+def vidal_2_mps(vidal, center=0):
+    '''
+    [phys, left, right]
+
+    Goal:
+        Convert the VidalMPS into a MPS with orthogonality center center,
+        with QRs from the site 0 if center > 0; the Schmidt values are
+        kept in the schmidt_values cache of the MPS.
+        If vidal is truncated, the B_list is first brought back into the
+        right canonical form with a LQ sweep from the site L-1, and the
+        Schmidt values are left to get_schmidt_spectrum.
+    '''
+    A_list = MPS([vidal.get_center_tensor(0)] + list(vidal.B_list[1:]))
+    if vidal.truncated:
+        move_orthogonality_center(A_list, len(A_list) - 1, 0)
+    else:
+        set_center(A_list, 0)
+
+    move_orthogonality_center(A_list, 0, center)
+    if not vidal.truncated:
+        A_list.schmidt_values = vidal.schmidt_values
+
+    return A_list
+
+def right_canonicalize(A_list, no_trunc=False, chi=None, normalized=True, svd_method='full'):
     '''
     [phys, left, right]
     [left canonical form]
@@ -583,30 +1700,59 @@ def right_canonicalize(A_list, no_trunc=False, chi=None, normalized=True):
     left canonical form already.
     - The requirement of left canonical form is not necessary, if
     there is no truncation.
+    - If no_trunc is True and chi is None, only the gauge is fixed,
+    with LQ decompositions instead of the SVD, see move_orthogonality_center.
+    - If A_list is a MPS with known center k, only the sites 0, ..., k
+    are touched, unless a bond larger than chi has to be truncated.
+    - svd_method: the method of misc.svd, with chi as the rank; 'auto'
+    or 'randomized' are faster for chi << d*chi_bond but approximate.
 
 
     modification in place
     '''
+    if isinstance(A_list[0], symmetric_tensor.BlockTensor):
+        result = symmetric_tensor.right_canonicalize(A_list, no_trunc=no_trunc, chi=chi,
+                                     normalized=normalized)
+        set_center(A_list, 0)
+        return result
+
     L = len(A_list)
+    center = get_center(A_list)
+    if center is None or (chi is not None and np.amax(get_bond_dims(A_list)) > chi):
+        center = L-1
+
+    if no_trunc and chi is None:
+        move_orthogonality_center(A_list, center, 0, normalized=normalized)
+        return A_list, 0.
+
     tot_trunc_err = 0.
-    for i in range(L-1, 0, -1):
+    for i in range(center, 0, -1):
         d1, chi1, chi2 = A_list[i].shape
-        X, Y, Z = misc.svd(np.reshape(np.transpose(A_list[i], [1, 0, 2]), [chi1, d1 * chi2]),
-                                full_matrices=0)
+        theta = np.reshape(np.transpose(A_list[i], [1, 0, 2]), [chi1, d1 * chi2])
+        X, Y, Z = misc.svd(theta, full_matrices=0, rank=chi, method=svd_method)
+        if np.size(Y) < min(theta.shape):
+            ## truncated svd; the norm and the discarded weight come from theta
+            Y_norm = np.linalg.norm(theta)
+        else:
+            Y_norm = np.linalg.norm(Y)
 
         if no_trunc:
             chi1 = np.size(Y)
         else:
-            chi1 = np.sum((Y/np.linalg.norm(Y))>1e-14)
+            chi1 = np.sum((Y/Y_norm)>1e-14)
 
         if chi is not None:
             chi1 = np.amin([chi1, chi])
 
         trunc_idx = (np.argsort(Y)[::-1])[chi1:]
-        trunc_error = np.sum(Y[trunc_idx] ** 2) / np.sum(Y ** 2)
+        arg_sorted_idx = (np.argsort(Y)[::-1])[:chi1]
+        if np.size(Y) < min(theta.shape):
+            trunc_error = max(1. - np.sum(Y[arg_sorted_idx] ** 2) / Y_norm ** 2, 0.)
+        else:
+            trunc_error = np.sum(Y[trunc_idx] ** 2) / np.sum(Y ** 2)
+
         tot_trunc_err = tot_trunc_err + trunc_error
 
-        arg_sorted_idx = (np.argsort(Y)[::-1])[:chi1]
         Y = Y[arg_sorted_idx]
         if normalized:
             Y = Y / np.linalg.norm(Y)
@@ -622,9 +1768,10 @@ def right_canonicalize(A_list, no_trunc=False, chi=None, normalized=True):
     if normalized:
         A_list[0] = A_list[0] / np.linalg.norm(A_list[0])
 
+    set_center(A_list, 0)
     return A_list, tot_trunc_err
 
-def left_canonicalize(A_list, no_trunc=False, chi=None, normalized=True):
+def left_canonicalize(A_list, no_trunc=False, chi=None, normalized=True, svd_method='full'):
     '''
     [phys, left, right]
     [right canonical form]
@@ -633,29 +1780,57 @@ def left_canonicalize(A_list, no_trunc=False, chi=None, normalized=True):
     right canonical form already.
     - The requirement of right canonical form is not necessary, if
     there is no truncation.
+    - If no_trunc is True and chi is None, only the gauge is fixed,
+    with QR decompositions instead of the SVD, see move_orthogonality_center.
+    - If A_list is a MPS with known center k, only the sites k, ..., L-1
+    are touched, unless a bond larger than chi has to be truncated.
+    - svd_method: see right_canonicalize.
 
     modification in place
     '''
+    if isinstance(A_list[0], symmetric_tensor.BlockTensor):
+        result = symmetric_tensor.left_canonicalize(A_list, no_trunc=no_trunc, chi=chi,
+                                     normalized=normalized)
+        set_center(A_list, len(A_list) - 1)
+        return result
+
     L = len(A_list)
+    center = get_center(A_list)
+    if center is None or (chi is not None and np.amax(get_bond_dims(A_list)) > chi):
+        center = 0
+
+    if no_trunc and chi is None:
+        move_orthogonality_center(A_list, center, L-1, normalized=normalized)
+        return A_list, 0.
+
     tot_trunc_err = 0
-    for i in range(L-1):
+    for i in range(center, L-1):
         d1, chi1, chi2 = A_list[i].shape
-        X, Y, Z = misc.svd(np.reshape(A_list[i], [d1 * chi1, chi2]),
-                                full_matrices=0)
+        theta = np.reshape(A_list[i], [d1 * chi1, chi2])
+        X, Y, Z = misc.svd(theta, full_matrices=0, rank=chi, method=svd_method)
+        if np.size(Y) < min(theta.shape):
+            ## truncated svd; the norm and the discarded weight come from theta
+            Y_norm = np.linalg.norm(theta)
+        else:
+            Y_norm = np.linalg.norm(Y)
 
         if no_trunc:
             chi2 = np.size(Y)
         else:
-            chi2 = np.sum((Y/np.linalg.norm(Y))>1e-14)
+            chi2 = np.sum((Y/Y_norm)>1e-14)
 
         if chi is not None:
             chi2 = np.amin([chi2, chi])
 
         trunc_idx = (np.argsort(Y)[::-1])[chi2:]
-        trunc_error = np.sum(Y[trunc_idx] ** 2) / np.sum(Y ** 2)
+        arg_sorted_idx = (np.argsort(Y)[::-1])[:chi2]
+        if np.size(Y) < min(theta.shape):
+            trunc_error = max(1. - np.sum(Y[arg_sorted_idx] ** 2) / Y_norm ** 2, 0.)
+        else:
+            trunc_error = np.sum(Y[trunc_idx] ** 2) / np.sum(Y ** 2)
+
         tot_trunc_err = tot_trunc_err + trunc_error
 
-        arg_sorted_idx = (np.argsort(Y)[::-1])[:chi2]
         Y = Y[arg_sorted_idx]
         if normalized:
             Y = Y / np.linalg.norm(Y)
@@ -671,43 +1846,76 @@ def left_canonicalize(A_list, no_trunc=False, chi=None, normalized=True):
     if normalized:
         A_list[-1] = A_list[-1] / np.linalg.norm(A_list[-1])
 
+    set_center(A_list, L-1)
     return A_list, tot_trunc_err
 
-def get_entanglement(A_list):
+def move_orthogonality_center(A_list, i, j, normalized=False):
     '''
     [phys, left, right]
+    [mixed canonical form]
+
+    - Move the orthogonality center of the mps from site i to site j,
+    with QR decompositions if i < j and LQ decompositions if i > j.
+    Only the sites between i and j are touched, and no truncation is made.
+    - The sites left to i (right to i) should be left (right) canonical
+    already; with i=0, j=L-1 or i=L-1, j=0 any mps is brought into the
+    left or right canonical form.
+    - If A_list is a MPS, i=None takes its recorded center.
+    - The mps of symmetric_tensor.BlockTensor are dispatched to
+    symmetric_tensor, which is the case for the functions
+    right_canonicalize, left_canonicalize, overlap and expectation_values
+    as well.
 
-    Goal:
-        Compute the bibpartite entanglement at each cut.
-    Input:
-        mps in left canonical form
-    Output:
-        list of bipartite entanglement [(0,1...), (01,2...), (012,...)]
+    modification in place
     '''
     L = len(A_list)
-    copy_A_list = [A.copy() for A in A_list]
-    ent_list = [None] * (L-1)
-    for i in range(L-1, 0, -1):
-        d1, chi1, chi2 = copy_A_list[i].shape
-        X, Y, Z = misc.svd(np.reshape(np.transpose(copy_A_list[i], [1, 0, 2]), [chi1, d1 * chi2]),
-                                full_matrices=0)
+    center = get_center(A_list)
+    if i is None:
+        i = center
+
+    valid = ((i, j) in [(0, L-1), (L-1, 0)] or
+             (center is not None and min(i, j) <= center <= max(i, j)))
+    if isinstance(A_list[0], symmetric_tensor.BlockTensor):
+        symmetric_tensor.move_orthogonality_center(A_list, i, j, normalized=normalized)
+        if valid:
+            set_center(A_list, j)
+
+        return A_list
+
+    for site in range(i, j):
+        d1, chi1, chi2 = A_list[site].shape
+        Q, R = np.linalg.qr(np.reshape(A_list[site], [d1 * chi1, chi2]))
+        A_list[site] = Q.reshape([d1, chi1, Q.shape[1]])
+        new_A = np.tensordot(R, A_list[site+1], axes=([1], [1]))  #[1l,(1r)],[p, (2l), 2r]
+        A_list[site+1] = np.transpose(new_A, [1, 0, 2])
+
+    for site in range(i, j, -1):
+        d1, chi1, chi2 = A_list[site].shape
+        theta = np.reshape(np.transpose(A_list[site], [1, 0, 2]), [chi1, d1 * chi2])
+        Q, R = np.linalg.qr(theta.T)  # theta = R^T Q^T
+        A_list[site] = np.transpose(Q.T.reshape([Q.shape[1], d1, chi2]), [1, 0, 2])
+        A_list[site-1] = np.tensordot(A_list[site-1], R.T, axes=([2], [0]))  #[p, 1l, (1r)] [(2l), 2r]
 
-        chi1 = np.sum(Y>1e-14)
+    if normalized:
+        A_list[j] = A_list[j] / np.linalg.norm(A_list[j])
 
-        arg_sorted_idx = (np.argsort(Y)[::-1])[:chi1]
-        Y = Y[arg_sorted_idx]
-        X = X[: ,arg_sorted_idx]
-        Z = Z[arg_sorted_idx, :]
+    if valid:
+        set_center(A_list, j)
 
-        copy_A_list[i]   = np.transpose(Z.reshape([chi1, d1, chi2]), [1, 0, 2])
-        R = np.dot(X, np.diag(Y))
-        new_A = np.tensordot(copy_A_list[i-1], R, axes=([2], [0]))  #[p, 1l, (1r)] [(2l), 2r]
-        copy_A_list[i-1] = new_A
+    return A_list
 
-        bi_ent = -(Y**2).dot(np.log(Y**2))
-        ent_list[i-1] = bi_ent
+def get_entanglement(A_list):
+    '''
+    [phys, left, right]
 
-    return ent_list
+    Goal:
+        Compute the bibpartite entanglement at each cut.
+    Input:
+        mps in left canonical form, or a MPS with known center
+    Output:
+        list of bipartite entanglement [(0,1...), (01,2...), (012,...)]
+    '''
+    return [get_renyi_entropy(Y, 1) for Y in get_schmidt_spectrum(A_list)]
 
 def get_renyi_n_entanglement(A_list, n):
     '''
@@ -716,14 +1924,46 @@ def get_renyi_n_entanglement(A_list, n):
     Goal:
         Compute the renyi-n entanglement at each cut.
     Input:
-        mps in left canonical form
+        mps in left canonical form, or a MPS with known center
     Output:
         list of bipartite entanglement [(0,1...), (01,2...), (012,...)]
     '''
+    return [get_renyi_entropy(Y, n) for Y in get_schmidt_spectrum(A_list)]
+
+def get_schmidt_spectrum(A_list):
+    '''
+    [phys, left, right]
+
+    Goal:
+        Compute the Schmidt values at each cut with a single sweep of SVDs
+        from the orthogonality center outwards, on a shallow copy.
+        If A_list is a MPS, the result is cached in A_list.schmidt_values
+        until A_list is modified, and is then returned without any SVD.
+    Input:
+        mps in left canonical form, or a MPS with known center
+    Output:
+        list of the Schmidt values in descending order, without the
+        numerical zeros, at the cuts [(0,1...), (01,2...), (012,...)]
+    '''
+    Y_list = getattr(A_list, 'schmidt_values', None)
+    if Y_list is not None:
+        return Y_list
+
     L = len(A_list)
-    copy_A_list = [A.copy() for A in A_list]
-    ent_list = [None] * (L-1)
-    for i in range(L-1, 0, -1):
+    center = get_center(A_list)
+    if center is None:
+        center = L-1
+
+    if isinstance(A_list[0], symmetric_tensor.BlockTensor):
+        Y_list = symmetric_tensor.get_schmidt_spectrum(A_list, center)
+        if isinstance(A_list, MPS):
+            A_list.schmidt_values = Y_list
+
+        return Y_list
+
+    Y_list = [None] * (L-1)
+    copy_A_list = list(A_list)
+    for i in range(center, 0, -1):
         d1, chi1, chi2 = copy_A_list[i].shape
         X, Y, Z = misc.svd(np.reshape(np.transpose(copy_A_list[i], [1, 0, 2]), [chi1, d1 * chi2]),
                                 full_matrices=0)
@@ -733,15 +1973,74 @@ def get_renyi_n_entanglement(A_list, n):
         arg_sorted_idx = (np.argsort(Y)[::-1])[:chi1]
         Y = Y[arg_sorted_idx]
         X = X[: ,arg_sorted_idx]
-        Z = Z[arg_sorted_idx, :]
 
-        copy_A_list[i]   = np.transpose(Z.reshape([chi1, d1, chi2]), [1, 0, 2])
         R = np.dot(X, np.diag(Y))
-        new_A = np.tensordot(copy_A_list[i-1], R, axes=([2], [0]))  #[p, 1l, (1r)] [(2l), 2r]
-        copy_A_list[i-1] = new_A
+        copy_A_list[i-1] = np.tensordot(copy_A_list[i-1], R, axes=([2], [0]))  #[p, 1l, (1r)] [(2l), 2r]
+        Y_list[i-1] = Y
 
-        bi_ent = np.log(np.sum(Y**(2*n))) / (1-n)
-        ent_list[i-1] = bi_ent
+    copy_A_list = list(A_list)
+    for i in range(center, L-1):
+        d1, chi1, chi2 = copy_A_list[i].shape
+        X, Y, Z = misc.svd(np.reshape(copy_A_list[i], [d1 * chi1, chi2]), full_matrices=0)
 
-    return ent_list
+        chi2 = np.sum(Y>1e-14)
 
+        arg_sorted_idx = (np.argsort(Y)[::-1])[:chi2]
+        Y = Y[arg_sorted_idx]
+        Z = Z[arg_sorted_idx, :]
+
+        R = np.dot(np.diag(Y), Z)
+        new_A = np.tensordot(R, copy_A_list[i+1], axes=([1], [1]))  #[1l,(1r)],[p, (2l), 2r]
+        copy_A_list[i+1] = np.transpose(new_A, [1, 0, 2])
+        Y_list[i] = Y
+
+    if isinstance(A_list, MPS):
+        A_list.schmidt_values = Y_list
+
+    return Y_list
+
+def get_renyi_entropy(Y, n):
+    '''
+    Goal:
+        The Renyi-n entropy of the Schmidt values Y, which are normalized
+        first; n=1 is the von Neumann entropy, n=np.inf the min-entropy.
+    '''
+    p = Y ** 2 / np.sum(Y ** 2)
+    if n == 1:
+        return -p.dot(np.log(p))
+    elif n == np.inf:
+        return -np.log(np.amax(p))
+    else:
+        return np.log(np.sum(p ** n)) / (1 - n)
+
+def get_entanglement_spectrum(A_list, n_list=(1,), chi=None):
+    '''
+    [phys, left, right]
+
+    Goal:
+        Everything derived from the Schmidt values of all cuts, which are
+        computed once, see get_schmidt_spectrum.
+    Input:
+        mps in left canonical form, or a MPS with known center
+        n_list: the Renyi orders, 1 for the von Neumann entropy
+        chi: if given, the truncation error of each cut at bond dimension chi
+    Output:
+        dict of lists over the cuts [(0,1...), (01,2...), (012,...)]
+        'schmidt_values': the normalized Schmidt values
+        'renyi': {n: Renyi-n entropies}
+        'discarded': the truncation profile, discarded[k] being the weight
+            discarded when keeping k Schmidt values
+        'effective_chi': exp of the von Neumann entropy
+        'trunc_err': discarded[chi], if chi is given
+    '''
+    Y_list = [Y / np.linalg.norm(Y) for Y in get_schmidt_spectrum(A_list)]
+    result = {'schmidt_values': Y_list}
+    result['renyi'] = {n: [get_renyi_entropy(Y, n) for Y in Y_list] for n in n_list}
+    # discarded[k] = weight discarded when keeping k singular values
+    result['discarded'] = [np.append(np.cumsum((Y ** 2)[::-1])[::-1], 0.) for Y in Y_list]
+    result['effective_chi'] = [np.exp(get_renyi_entropy(Y, 1)) for Y in Y_list]
+    if chi is not None:
+        result['trunc_err'] = [discarded[min(chi, discarded.size - 1)]
+                               for discarded in result['discarded']]
+
+    return result
@@ -0,0 +1,524 @@
+'''
+This file contains the block-sparse tensors with an abelian symmetry,
+i.e. U(1) (sym=0) or Z_n (sym=n), and the mps functions on them.
+
+Each leg carries a charge for each of its indices and a direction,
++1 for the charge flowing into the tensor and -1 for flowing out. Only the
+blocks of charges with
+
+    sum(direction * charge) = 0 (mod n for Z_n)
+
+are stored, as dense arrays in a dict keyed by the tuple of charges.
+Contracted legs should have opposite directions.
+
+The conventions for the mps and the gates are the same as for the dense
+tensors, with the directions
+    mps [phys, left, right]: [+1, +1, -1], i.e. the right leg carries the
+        total charge of the sites to the left,
+    gate [i', j', i, j] and operators [p', p]: +1 for the outgoing (primed)
+        and -1 for the incoming legs.
+The functions apply_gate, left_canonicalize, right_canonicalize,
+move_orthogonality_center, overlap, expectation_values and
+get_schmidt_spectrum of
+circuit_func and mps_func dispatch to the functions here if the mps
+consists of BlockTensor, e.g. from product_state. The dense gates and
+operators are converted with from_dense, which asserts that they respect
+the symmetry. The SVDs are done block by block, with the truncation
+to chi over all the blocks together.
+'''
+import itertools
+import numpy as np
+from tensor_network_functions import misc
+
+class Leg(object):
+    '''
+    index_charges: the charge of each index of the leg
+    direction: +1 (in) or -1 (out)
+    sym: 0 for U(1), n for Z_n
+
+    sectors: dict {charge: the indices with this charge}
+    '''
+    def __init__(self, index_charges, direction, sym=0):
+        index_charges = np.asarray(index_charges, dtype=int)
+        if sym:
+            index_charges = index_charges % sym
+
+        self.index_charges = index_charges
+        self.direction = direction
+        self.sym = sym
+        self.sectors = {int(c): np.nonzero(index_charges == c)[0]
+                        for c in np.unique(index_charges)}
+
+    @property
+    def dim(self):
+        return self.index_charges.size
+
+    def get_dim(self, charge):
+        return self.sectors[charge].size
+
+    def conj(self):
+        return Leg(self.index_charges, -self.direction, self.sym)
+
+def fuse_charges(charges, legs):
+    '''
+    return:
+        the total charge sum(direction * charge) of the legs.
+    '''
+    total = sum([leg.direction * q for q, leg in zip(charges, legs)])
+    if legs and legs[0].sym:
+        total = total % legs[0].sym
+
+    return total
+
+class BlockTensor(object):
+    '''
+    legs: list of Leg
+    blocks: dict {tuple of charges: np.ndarray}, the blocks not in the
+        dict are zero.
+
+    The blocks should not be modified inplace, since they can be shared
+    between tensors, e.g. by transpose or conj.
+    '''
+    def __init__(self, legs, blocks):
+        self.legs = legs
+        self.blocks = blocks
+
+    @property
+    def shape(self):
+        return tuple(leg.dim for leg in self.legs)
+
+    @property
+    def ndim(self):
+        return len(self.legs)
+
+    @property
+    def dtype(self):
+        if not self.blocks:
+            return np.dtype(float)
+
+        return np.result_type(*self.blocks.values())
+
+    def conj(self):
+        return BlockTensor([leg.conj() for leg in self.legs],
+                           {key: np.conj(b) for key, b in self.blocks.items()})
+
+    conjugate = conj
+
+    def transpose(self, axes):
+        return BlockTensor([self.legs[a] for a in axes],
+                           {tuple(key[a] for a in axes): np.transpose(b, axes)
+                            for key, b in self.blocks.items()})
+
+    def norm(self):
+        return np.sqrt(sum([np.sum(np.abs(b) ** 2) for b in self.blocks.values()]))
+
+    def __mul__(self, factor):
+        return BlockTensor(self.legs, {key: b * factor for key, b in self.blocks.items()})
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, factor):
+        return BlockTensor(self.legs, {key: b / factor for key, b in self.blocks.items()})
+
+    def to_dense(self):
+        T = np.zeros(self.shape, dtype=self.dtype)
+        for key, b in self.blocks.items():
+            T[np.ix_(*[leg.sectors[q] for q, leg in zip(key, self.legs)])] = b
+
+        return T
+
+def from_dense(T, legs, atol=1e-10):
+    '''
+    Goal:
+        Convert the dense tensor T into a BlockTensor with the given legs.
+        The entries outside the allowed blocks should be zero, i.e.
+        T should respect the symmetry, which is asserted.
+    '''
+    T = np.asarray(T)
+    blocks = {}
+    for key in itertools.product(*[list(leg.sectors) for leg in legs]):
+        if fuse_charges(key, legs) == 0:
+            blocks[key] = T[np.ix_(*[leg.sectors[q] for q, leg in zip(key, legs)])]
+
+    T_block = BlockTensor(legs, blocks)
+    assert np.isclose(T_block.norm(), np.linalg.norm(T), rtol=0, atol=atol), \
+        "the tensor does not respect the symmetry"
+    return T_block
+
+def eye(leg):
+    '''
+    return:
+        the identity [leg, leg.conj()], e.g. the trivial environment.
+    '''
+    return BlockTensor([leg, leg.conj()],
+                       {(q, q): np.eye(leg.get_dim(q)) for q in leg.sectors})
+
+def tensordot(A, B, axes):
+    '''
+    The blockwise np.tensordot(A, B, axes) with axes = (A_axes, B_axes);
+    returns a scalar if all the legs are contracted.
+    '''
+    A_axes, B_axes = [list(np.atleast_1d(a)) for a in axes]
+    for a, b in zip(A_axes, B_axes):
+        assert A.legs[a].direction == -B.legs[b].direction
+
+    A_free = [i for i in range(A.ndim) if i not in A_axes]
+    B_free = [i for i in range(B.ndim) if i not in B_axes]
+    legs = [A.legs[i] for i in A_free] + [B.legs[i] for i in B_free]
+
+    B_groups = {}
+    for key, b in B.blocks.items():
+        B_groups.setdefault(tuple(key[i] for i in B_axes), []).append((key, b))
+
+    blocks = {}
+    for A_key, a in A.blocks.items():
+        for B_key, b in B_groups.get(tuple(A_key[i] for i in A_axes), []):
+            key = tuple(A_key[i] for i in A_free) + tuple(B_key[i] for i in B_free)
+            block = np.tensordot(a, b, axes=(A_axes, B_axes))
+            if key in blocks:
+                blocks[key] = blocks[key] + block
+            else:
+                blocks[key] = block
+
+    if not legs:
+        return blocks.get((), 0.)
+
+    return BlockTensor(legs, blocks)
+
+def scale_leg(T, axis, S_dict):
+    '''
+    return:
+        T with the blocks multiplied by the singular values S_dict
+        {charge: array} along the axis.
+    '''
+    shape = [1] * T.ndim
+    blocks = {}
+    for key, b in T.blocks.items():
+        shape[axis] = b.shape[axis]
+        blocks[key] = b * np.reshape(S_dict[key[axis]], shape)
+
+    return BlockTensor(T.legs, blocks)
+
+def get_block_matrices(T, num_row_legs):
+    '''
+    Goal:
+        Group the blocks of T by the fused charge c of the first
+        num_row_legs legs, and form the dense matrix of each group.
+    Return:
+        dict {c: (rows, cols, M)}, with rows (cols) the dict
+        {row_key (col_key): (offset, dim)} of the rows (columns) of M.
+    '''
+    row_legs = T.legs[:num_row_legs]
+    groups = {}
+    for key, b in T.blocks.items():
+        row_key, col_key = key[:num_row_legs], key[num_row_legs:]
+        rows, cols, block_list = groups.setdefault(fuse_charges(row_key, row_legs), ({}, {}, []))
+        rows[row_key] = int(np.prod(b.shape[:num_row_legs]))
+        cols[col_key] = int(np.prod(b.shape[num_row_legs:]))
+        block_list.append((row_key, col_key, b))
+
+    matrices = {}
+    for c, (rows, cols, block_list) in groups.items():
+        rows = dict(zip(rows, zip(np.cumsum([0] + list(rows.values())), rows.values())))
+        cols = dict(zip(cols, zip(np.cumsum([0] + list(cols.values())), cols.values())))
+        M = np.zeros([sum([d for _, d in rows.values()]), sum([d for _, d in cols.values()])],
+                     dtype=T.dtype)
+        for row_key, col_key, b in block_list:
+            (r0, dr), (c0, dc) = rows[row_key], cols[col_key]
+            M[r0:r0+dr, c0:c0+dc] = np.reshape(b, [dr, dc])
+
+        matrices[c] = (rows, cols, M)
+
+    return matrices
+
+def split_block_matrices(T, num_row_legs, matrices, X_dict, Z_dict):
+    '''
+    Goal:
+        The inverse of get_block_matrices for a decomposition M = X Z of
+        each group c, i.e. X_dict[c] [rows, k_c] and Z_dict[c] [k_c, cols].
+    Return:
+        U [row legs, new (-1)], V [new (+1), col legs] with the sector c of
+        the new leg of dimension k_c.
+    '''
+    row_legs, col_legs = T.legs[:num_row_legs], T.legs[num_row_legs:]
+    new_charges = []
+    U_blocks, V_blocks = {}, {}
+    for c in X_dict:
+        rows, cols, _ = matrices[c]
+        X, Z = X_dict[c], Z_dict[c]
+        k = X.shape[1]
+        new_charges += [c] * k
+        for row_key, (r0, dim) in rows.items():
+            shape = [leg.get_dim(q) for q, leg in zip(row_key, row_legs)]
+            U_blocks[row_key + (c,)] = np.reshape(X[r0:r0+dim], shape + [k])
+
+        for col_key, (c0, dim) in cols.items():
+            shape = [leg.get_dim(q) for q, leg in zip(col_key, col_legs)]
+            V_blocks[(c,) + col_key] = np.reshape(Z[:, c0:c0+dim], [k] + shape)
+
+    sym = T.legs[0].sym
+    U = BlockTensor(list(row_legs) + [Leg(new_charges, -1, sym)], U_blocks)
+    V = BlockTensor([Leg(new_charges, +1, sym)] + list(col_legs), V_blocks)
+    return U, V
+
+def svd(T, num_row_legs, chi=None, no_trunc=False, cutoff=1e-14, trunc_err_target=None):
+    '''
+    Goal:
+        T = U S V with the first num_row_legs legs of T as the rows,
+        decomposed block by block: the blocks with the same fused charge c
+        of the row legs form a dense matrix, whose SVD gives the sector c
+        of the new leg. The singular values of all the sectors are
+        truncated together to chi and trunc_err_target, as in apply_gate.
+    Return:
+        U [row legs, new (-1)], S {charge: array}, V [new (+1), col legs],
+        trunc_error
+    '''
+    matrices = get_block_matrices(T, num_row_legs)
+    decomposition = {c: misc.svd(M, full_matrices=False) for c, (_, _, M) in matrices.items()}
+
+    charges = list(decomposition)
+    Y_all = np.concatenate([decomposition[c][1] for c in charges])
+    sector_all = np.concatenate([[c] * decomposition[c][1].size for c in charges]).astype(int)
+    Y_norm = np.linalg.norm(Y_all)
+    order = np.argsort(Y_all)[::-1]
+    if no_trunc:
+        num_keep = Y_all.size
+    else:
+        num_keep = np.sum((Y_all / Y_norm) > cutoff)
+        if chi is not None:
+            num_keep = min(num_keep, chi)
+
+        if trunc_err_target is not None:
+            # discarded[n] = weight discarded when keeping n singular values
+            Y_sq = Y_all[order] ** 2
+            discarded = (Y_norm ** 2 - np.cumsum(Y_sq) + Y_sq) / Y_norm ** 2
+            num_keep = min(num_keep, np.sum(discarded > trunc_err_target))
+
+    num_keep = max(num_keep, 1)
+    trunc_error = np.sum(Y_all[order[num_keep:]] ** 2) / Y_norm ** 2
+    kept = sector_all[order[:num_keep]]
+
+    X_dict, Z_dict, S_dict = {}, {}, {}
+    for c in charges:
+        X, Y, Z = decomposition[c]
+        k = np.sum(kept == c)
+        if k > 0:
+            X_dict[c], S_dict[c], Z_dict[c] = X[:, :k], Y[:k], Z[:k]
+
+    U, V = split_block_matrices(T, num_row_legs, matrices, X_dict, Z_dict)
+    return U, S_dict, V, trunc_error
+
+def qr(T, num_row_legs, mode='qr'):
+    '''
+    Goal:
+        The blockwise QR (mode='qr') T = Q R, with Q [row legs, new (-1)]
+        an isometry, or LQ (mode='lq') T = L Q, with Q [new (+1), col legs]
+        having orthonormal rows, see get_block_matrices.
+    Return:
+        Q, R or L, Q
+    '''
+    matrices = get_block_matrices(T, num_row_legs)
+    X_dict, Z_dict = {}, {}
+    for c, (_, _, M) in matrices.items():
+        if mode == 'qr':
+            X_dict[c], Z_dict[c] = np.linalg.qr(M)
+        else:
+            Q, R = np.linalg.qr(M.T.conj())  # M = R^dagger Q^dagger
+            X_dict[c], Z_dict[c] = R.T.conj(), Q.T.conj()
+
+    return split_block_matrices(T, num_row_legs, matrices, X_dict, Z_dict)
+
+def normalize_S(S_dict):
+    S_norm = np.sqrt(sum([np.sum(S ** 2) for S in S_dict.values()]))
+    return {c: S / S_norm for c, S in S_dict.items()}
+
+def product_state(config, phys_charges, sym=0):
+    '''
+    [phys, left, right]
+
+    Goal:
+        The mps of the product state of the basis states config, e.g.
+        product_state([0, 1, 0, 1], [0, 1]) for the U(1) charge being
+        the number of 1s, or sym=2 for its parity.
+    Return:
+        list of BlockTensor
+    '''
+    A_list = []
+    left_charge = 0
+    for s in config:
+        right_charge = left_charge + phys_charges[s]
+        if sym:
+            right_charge = right_charge % sym
+
+        legs = [Leg(phys_charges, +1, sym), Leg([left_charge], +1, sym),
+                Leg([right_charge], -1, sym)]
+        A_list.append(from_dense(np.eye(len(phys_charges))[s].reshape([-1, 1, 1]), legs))
+        left_charge = right_charge
+
+    return A_list
+
+def operator_from_dense(Op, phys_legs):
+    '''
+    return:
+        the dense operator Op [p'..., p...], e.g. a gate, as a BlockTensor
+        acting on the physical legs phys_legs.
+    '''
+    if isinstance(Op, BlockTensor):
+        return Op
+
+    dims = [leg.dim for leg in phys_legs]
+    return from_dense(np.reshape(Op, dims + dims),
+                      list(phys_legs) + [leg.conj() for leg in phys_legs])
+
+def apply_gate(A_list, gate, idx, move, no_trunc=False, chi=None, normalized=False,
+               trunc_err_target=None):
+    '''
+    [modification inplace]
+    see circuit_func.apply_gate
+    '''
+    gate = operator_from_dense(gate, [A_list[idx].legs[0], A_list[idx + 1].legs[0]])
+    theta = tensordot(A_list[idx], A_list[idx + 1], axes=([2], [1]))  # [p1, l, p2, r]
+    theta = tensordot(gate, theta, axes=([2, 3], [0, 2]))  # [p1', p2', l, r]
+    theta = theta.transpose([0, 2, 1, 3])  # [p1', l, p2', r]
+    U, S, V, trunc_error = svd(theta, 2, chi=chi, no_trunc=no_trunc,
+                               trunc_err_target=trunc_err_target)
+    if normalized:
+        S = normalize_S(S)
+
+    if move == 'right':
+        A_list[idx] = U
+        A_list[idx + 1] = scale_leg(V, 0, S).transpose([1, 0, 2])
+    elif move == 'left':
+        A_list[idx + 1] = V.transpose([1, 0, 2])
+        A_list[idx] = scale_leg(U, 2, S)
+    else:
+        raise
+
+    return trunc_error
+
+def right_canonicalize(A_list, no_trunc=False, chi=None, normalized=True):
+    '''
+    [modification inplace]
+    see mps_func.right_canonicalize
+    '''
+    L = len(A_list)
+    tot_trunc_err = 0.
+    for i in range(L - 1, 0, -1):
+        U, S, V, trunc_error = svd(A_list[i].transpose([1, 0, 2]), 1, chi=chi,
+                                   no_trunc=no_trunc)  # [l | p, r]
+        if normalized:
+            S = normalize_S(S)
+
+        tot_trunc_err = tot_trunc_err + trunc_error
+        A_list[i] = V.transpose([1, 0, 2])
+        A_list[i - 1] = tensordot(A_list[i - 1], scale_leg(U, 1, S), axes=([2], [0]))
+
+    if normalized:
+        A_list[0] = A_list[0] / A_list[0].norm()
+
+    return A_list, tot_trunc_err
+
+def left_canonicalize(A_list, no_trunc=False, chi=None, normalized=True):
+    '''
+    [modification inplace]
+    see mps_func.left_canonicalize
+    '''
+    L = len(A_list)
+    tot_trunc_err = 0.
+    for i in range(L - 1):
+        U, S, V, trunc_error = svd(A_list[i], 2, chi=chi, no_trunc=no_trunc)  # [p, l | r]
+        if normalized:
+            S = normalize_S(S)
+
+        tot_trunc_err = tot_trunc_err + trunc_error
+        A_list[i] = U
+        A_list[i + 1] = tensordot(scale_leg(V, 0, S), A_list[i + 1],
+                                  axes=([1], [1])).transpose([1, 0, 2])
+
+    if normalized:
+        A_list[L - 1] = A_list[L - 1] / A_list[L - 1].norm()
+
+    return A_list, tot_trunc_err
+
+def move_orthogonality_center(A_list, i, j, normalized=False):
+    '''
+    [modification inplace]
+    see mps_func.move_orthogonality_center
+    '''
+    for site in range(i, j):
+        Q, R = qr(A_list[site], 2)  # [p, l | r]
+        A_list[site] = Q
+        A_list[site + 1] = tensordot(R, A_list[site + 1], axes=([1], [1])).transpose([1, 0, 2])
+
+    for site in range(i, j, -1):
+        L, Q = qr(A_list[site].transpose([1, 0, 2]), 1, mode='lq')  # [l | p, r]
+        A_list[site] = Q.transpose([1, 0, 2])
+        A_list[site - 1] = tensordot(A_list[site - 1], L, axes=([2], [0]))
+
+    if normalized:
+        A_list[j] = A_list[j] / A_list[j].norm()
+
+    return A_list
+
+def get_schmidt_spectrum(A_list, center):
+    '''
+    see mps_func.get_schmidt_spectrum; the singular values of all the
+    sectors are sorted together.
+    '''
+    L = len(A_list)
+    Y_list = [None] * (L - 1)
+    copy_A_list = list(A_list)
+    for i in range(center, 0, -1):
+        U, S, V, _ = svd(copy_A_list[i].transpose([1, 0, 2]), 1)
+        copy_A_list[i - 1] = tensordot(copy_A_list[i - 1], scale_leg(U, 1, S), axes=([2], [0]))
+        Y_list[i - 1] = np.sort(np.concatenate(list(S.values())))[::-1]
+
+    copy_A_list = list(A_list)
+    for i in range(center, L - 1):
+        U, S, V, _ = svd(copy_A_list[i], 2)
+        copy_A_list[i + 1] = tensordot(scale_leg(V, 0, S), copy_A_list[i + 1],
+                                       axes=([1], [1])).transpose([1, 0, 2])
+        Y_list[i] = np.sort(np.concatenate(list(S.values())))[::-1]
+
+    return Y_list
+
+def overlap(psi1, psi2):
+    '''
+    return:
+        <psi1|psi2>
+    '''
+    E = tensordot(psi1[0].conj(), psi2[0], axes=([0, 1], [0, 1]))  # [r1, r2]
+    for i in range(1, len(psi1)):
+        E = tensordot(E, psi1[i].conj(), axes=([0], [1]))  # [r2, p, r1]
+        E = tensordot(E, psi2[i], axes=([0, 1], [1, 0]))  # [r1, r2]
+
+    return sum([np.sum(b) for b in E.blocks.values()])
+
+def expectation_values(A_list, H_list):
+    '''
+    return:
+        list of <H_list[i]> on the bonds i = L-2, ..., 1, 0, i.e. in
+        reversed order as mps_func.expectation_values.
+    '''
+    L = len(A_list)
+    # Lp_list[i]: sites 0, ..., i-1, [bra, ket]
+    Lp_list = [eye(A_list[0].legs[1])]
+    for i in range(L - 2):
+        T = tensordot(Lp_list[i], A_list[i], axes=([1], [1]))  # [bra, p, r]
+        Lp_list.append(tensordot(A_list[i].conj(), T, axes=([1, 0], [0, 1])))
+
+    # Rp: sites i+2, ..., L-1, [bra, ket]
+    Rp = eye(A_list[L - 1].legs[2])
+    E_list = []
+    for i in range(L - 2, -1, -1):
+        H = operator_from_dense(H_list[i], [A_list[i].legs[0], A_list[i + 1].legs[0]])
+        theta = tensordot(A_list[i], A_list[i + 1], axes=([2], [1]))  # [p1, l, p2, r]
+        T = tensordot(H, theta, axes=([2, 3], [0, 2]))  # [p1', p2', l, r]
+        T = tensordot(Lp_list[i], T, axes=([1], [2]))  # [bra, p1', p2', r]
+        T = tensordot(T, Rp, axes=([3], [1]))  # [bra, p1', p2', r_bra]
+        E_list.append(tensordot(theta.conj(), T, axes=([1, 0, 2, 3], [0, 1, 2, 3])))
+
+        T = tensordot(A_list[i + 1], Rp, axes=([2], [1]))  # [p, l, bra]
+        Rp = tensordot(A_list[i + 1].conj(), T, axes=([0, 2], [0, 2]))
+
+    return E_list